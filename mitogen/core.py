@@ -5,9 +5,14 @@ import cStringIO
 import collections
 import errno
 import fcntl
+import hashlib
+import heapq
 import imp
+import io
 import itertools
 import logging
+import marshal
+import math
 import os
 import select
 import signal
@@ -17,6 +22,7 @@ import sys
 import threading
 import time
 import traceback
+import weakref
 import zlib
 
 
@@ -30,9 +36,27 @@ FORWARD_LOG = 102
 ADD_ROUTE = 103
 ALLOCATE_ID = 104
 SHUTDOWN = 105
+LOAD_MODULE = 106
+KEEPALIVE = 107
+GET_STATS = 108
+
+#: Handles from this value on are allocated by :py:meth:`Router.add_handler`.
+FIRST_DYNAMIC_HANDLE = 1000
 
 CHUNK_SIZE = 16384
 
+#: Message flag indicating :py:attr:`Message.data` is a plain bytestring
+#: rather than a pickle.
+FLAG_RAW = 0x01
+
+#: Message flag indicating :py:attr:`Message.data` is one fragment of a larger
+#: message, and more fragments follow.
+FLAG_MORE = 0x02
+
+#: Message flag indicating :py:attr:`Message.data` was compressed by the
+#: sending stream, and must be decompressed by the receiving stream.
+FLAG_COMPRESSED = 0x04
+
 
 if __name__ == 'mitogen.core':
     # When loaded using import mechanism, ExternalContext.main() will not have
@@ -111,9 +135,16 @@ def listen(obj, name, func):
     signals.setdefault(name, []).append(func)
 
 
+def unlisten(obj, name, func):
+    signals = vars(obj).get('_signals', {})
+    if func in signals.get(name, ()):
+        signals[name].remove(func)
+
+
 def fire(obj, name, *args, **kwargs):
     signals = vars(obj).get('_signals', {})
-    return [func(*args, **kwargs) for func in signals.get(name, ())]
+    # Copied, since a listener may remove itself or another.
+    return [func(*args, **kwargs) for func in list(signals.get(name, ()))]
 
 
 def takes_econtext(func):
@@ -139,7 +170,7 @@ def set_nonblock(fd):
 def io_op(func, *args):
     try:
         return func(*args), False
-    except OSError, e:
+    except (OSError, IOError), e:
         IOLOG.debug('io_op(%r) -> OSError: %s', func, e)
         if e.errno not in (errno.EIO, errno.ECONNRESET, errno.EPIPE):
             raise
@@ -186,6 +217,7 @@ class Message(object):
     src_id = None
     handle = None
     reply_to = None
+    flags = 0
     data = ''
 
     router = None
@@ -212,7 +244,14 @@ class Message(object):
 
     @classmethod
     def pickled(cls, obj, **kwargs):
+        """Construct a message whose data is `obj` serialized with
+        :py:mod:`cPickle`. Plain bytestrings are instead sent as-is and
+        marked with :py:data:`FLAG_RAW`."""
         self = cls(**kwargs)
+        if type(obj) is str:
+            self.data = obj
+            self.flags |= FLAG_RAW
+            return self
         try:
             self.data = cPickle.dumps(obj, protocol=2)
         except cPickle.PicklingError, e:
@@ -222,6 +261,8 @@ class Message(object):
     def unpickle(self):
         """Deserialize `data` into an object."""
         IOLOG.debug('%r.unpickle()', self)
+        if self.flags & FLAG_RAW:
+            return self.data
         fp = cStringIO.StringIO(self.data)
         unpickler = cPickle.Unpickler(fp)
         unpickler.find_global = self._find_global
@@ -266,26 +307,160 @@ class Sender(object):
         )
 
 
-def _queue_interruptible_get(queue, timeout=None, block=True):
-    # bool is subclass of int, cannot use isinstance!
-    assert timeout is None or type(timeout) in (int, long, float)
-    assert isinstance(block, bool)
+def _wait_readable(fd, deadline=None):
+    """Block until `fd` is readable or the absolute UNIX timestamp `deadline`
+    passes, restarting the wait with the remaining time if interrupted by an
+    unrelated signal."""
+    while True:
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
+        try:
+            if hasattr(select, 'poll'):
+                pollobj = select.poll()
+                pollobj.register(fd, select.POLLIN)
+                if timeout is not None:
+                    # Round up, otherwise sub-millisecond remainders spin.
+                    timeout = int(math.ceil(timeout * 1000))
+                return bool(pollobj.poll(timeout))
+            return bool(select.select([fd], [], [], timeout)[0])
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
 
-    if timeout is not None:
-        timeout += time.time()
 
-    msg = None
-    while msg is None and (timeout is None or timeout > time.time()):
+class Latch(object):
+    """
+    A thread-safe queue whose :py:meth:`get` sleeps without polling until an
+    item is available or an exact deadline passes.
+
+    Each sleeping thread waits on its own socketpair, which :py:meth:`put`
+    writes a byte to, so idle threads cost no CPU and are woken immediately.
+    Since the wait is an ordinary system call, :py:exc:`KeyboardInterrupt` is
+    still delivered promptly to a main thread blocked in :py:meth:`get`.
+    Socketpairs are returned to a process-wide free list after use, so only
+    as many exist as there have ever been simultaneously sleeping threads.
+    """
+    #: Free list of `(rsock, wsock)` pairs for sleeping threads.
+    _sockets = []
+    _sockets_lock = threading.Lock()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = []
+        #: wsocks of threads sleeping in :py:meth:`get`, oldest first.
+        self._sleeping = []
+
+    def __repr__(self):
+        return 'Latch(%#x, size=%d, sleeping=%d)' % (
+            id(self), len(self._queue), len(self._sleeping))
+
+    @classmethod
+    def _get_socketpair(cls):
+        cls._sockets_lock.acquire()
         try:
-            msg = queue.get(block, 0.5)
-        except Queue.Empty:
-            if not block:
-                break
+            if cls._sockets:
+                return cls._sockets.pop()
+        finally:
+            cls._sockets_lock.release()
+
+        rsock, wsock = socket.socketpair()
+        set_cloexec(rsock.fileno())
+        set_cloexec(wsock.fileno())
+        return rsock, wsock
+
+    @classmethod
+    def _put_socketpair(cls, pair):
+        cls._sockets_lock.acquire()
+        try:
+            cls._sockets.append(pair)
+        finally:
+            cls._sockets_lock.release()
+
+    @classmethod
+    def _on_fork(cls):
+        """Called in a forked child to discard socketpairs shared with the
+        parent, and a lock another thread may have held during the fork."""
+        cls._sockets_lock = threading.Lock()
+        for rsock, wsock in cls._sockets:
+            rsock.close()
+            wsock.close()
+        cls._sockets = []
+
+    def empty(self):
+        """Return ``True`` if no items are queued."""
+        return not self._queue
 
-    if msg is None:
-        raise TimeoutError('deadline exceeded.')
+    def put(self, obj):
+        """Enqueue `obj` and wake the longest sleeping thread, if any."""
+        self._lock.acquire()
+        try:
+            self._queue.append(obj)
+            if self._sleeping:
+                self._sleeping.pop(0).send('\x7f')
+        finally:
+            self._lock.release()
 
-    return msg
+    def get(self, timeout=None, block=True):
+        """
+        Return the next queued item, sleeping for up to `timeout` seconds, or
+        forever if ``None``, for one to arrive.
+
+        :raises TimeoutError:
+            No item arrived before the timeout expired, or `block` was
+            ``False`` and the queue was empty.
+        """
+        # bool is subclass of int, cannot use isinstance!
+        assert timeout is None or type(timeout) in (int, long, float)
+        assert isinstance(block, bool)
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        pair = None
+        try:
+            while True:
+                self._lock.acquire()
+                try:
+                    if self._queue:
+                        return self._queue.pop(0)
+                    if not (block and (deadline is None or
+                                       deadline > time.time())):
+                        raise TimeoutError('deadline exceeded.')
+                    if pair is None:
+                        pair = self._get_socketpair()
+                    self._sleeping.append(pair[1])
+                finally:
+                    self._lock.release()
+                self._sleep(pair, deadline)
+        finally:
+            if pair is not None:
+                self._put_socketpair(pair)
+
+    def _sleep(self, pair, deadline):
+        try:
+            _wait_readable(pair[0].fileno(), deadline)
+        except:
+            self._unsleep(pair, interrupted=True)
+            raise
+        self._unsleep(pair, interrupted=False)
+
+    def _unsleep(self, pair, interrupted):
+        rsock, wsock = pair
+        self._lock.acquire()
+        try:
+            if wsock in self._sleeping:
+                self._sleeping.remove(wsock)
+                return
+            # put() chose this thread; consume its wakeup. If the wait was
+            # interrupted, pass the wakeup on so the item it announced does
+            # not strand other sleepers.
+            rsock.recv(1)
+            if interrupted and self._queue and self._sleeping:
+                self._sleeping.pop(0).send('\x7f')
+        finally:
+            self._lock.release()
 
 
 class Receiver(object):
@@ -297,7 +472,7 @@ class Receiver(object):
         self.handle = handle  # Avoid __repr__ crash in add_handler()
         self.handle = router.add_handler(self._on_receive, handle,
                                          persist, respondent)
-        self._queue = Queue.Queue()
+        self._latch = Latch()
 
     def __repr__(self):
         return 'Receiver(%r, %r)' % (self.router, self.handle)
@@ -305,20 +480,20 @@ class Receiver(object):
     def _on_receive(self, msg):
         """Callback from the Stream; appends data to the internal queue."""
         IOLOG.debug('%r._on_receive(%r)', self, msg)
-        self._queue.put(msg)
+        self._latch.put(msg)
         if self.notify:
             self.notify(self)
 
     def close(self):
-        self._queue.put(_DEAD)
+        self._latch.put(_DEAD)
 
     def empty(self):
-        return self._queue.empty()
+        return self._latch.empty()
 
     def get(self, timeout=None, block=True):
         IOLOG.debug('%r.get(timeout=%r, block=%r)', self, timeout, block)
 
-        msg = _queue_interruptible_get(self._queue, timeout, block=block)
+        msg = self._latch.get(timeout=timeout, block=block)
         IOLOG.debug('%r.get() got %r', self, msg)
 
         if msg == _DEAD:
@@ -362,16 +537,36 @@ class Importer(object):
     Import protocol implementation that fetches modules from the parent
     process.
 
+    :param router: Router on which :py:data:`LOAD_MODULE` is received.
     :param context: Context to communicate via.
+    :param cache_dir: If not ``None``, directory in which compressed module
+        sources are cached between processes, in files named for the module
+        and the SHA-1 of its compressed source. The parent is sent the hash of
+        any cached copy with each request, and omits the source from its reply
+        when the hash matches.
+
+    Each request also carries the magic number of the running interpreter.
+    When it matches the parent's, the reply includes a code object compiled
+    and marshalled by the parent, which is loaded instead of compiling the
+    source.
     """
-    def __init__(self, context, core_src):
+    #: :py:func:`imp.get_magic` of the running interpreter.
+    magic = imp.get_magic()
+
+    def __init__(self, router, context, core_src, cache_dir=None):
         self._context = context
+        self._cache_dir = cache_dir and os.path.expanduser(cache_dir)
+        #: fullname -> SHA-1 of the copy in :py:attr:`_cache_dir`, or ``None``
+        #: until the directory is first listed.
+        self._disk_index = None
         self._present = {'mitogen': [
             'mitogen.ansible',
             'mitogen.compat',
             'mitogen.compat.pkgutil',
             'mitogen.fakessh',
+            'mitogen.fork',
             'mitogen.master',
+            'mitogen.shm',
             'mitogen.ssh',
             'mitogen.sudo',
             'mitogen.utils',
@@ -384,10 +579,121 @@ class Importer(object):
                 'mitogen/core.py',
                 zlib.compress(core_src),
             )
+        router.add_handler(self._on_load_module, LOAD_MODULE)
 
     def __repr__(self):
         return 'Importer()'
 
+    def _on_load_module(self, msg):
+        """Cache a module pushed by the parent ahead of it being requested."""
+        if msg == _DEAD:
+            return
+        if msg.src_id not in mitogen.parent_ids:
+            LOG.warning('LOAD_MODULE from non-parent %r', msg.src_id)
+            return
+
+        tup = msg.unpickle()
+        LOG.debug('%r._on_load_module(%r)', self, tup[0])
+        self._cache[tup[0]] = tup[1:]
+        if self._cache_dir:
+            self._write_cached(tup[0], tup[3])
+
+    def _get_cached_sha(self, fullname):
+        """Return the SHA-1 of the disk cache's copy of `fullname`, or
+        ``None``."""
+        if not self._cache_dir:
+            return None
+
+        if self._disk_index is None:
+            index = {}
+            try:
+                filenames = os.listdir(self._cache_dir)
+            except OSError:
+                filenames = []
+            for filename in filenames:
+                name, _, sha = filename.rpartition('.')
+                if name and len(sha) == 40:
+                    index[name] = sha
+            self._disk_index = index
+        return self._disk_index.get(fullname)
+
+    def _read_cached(self, fullname, sha):
+        path = os.path.join(self._cache_dir, '%s.%s' % (fullname, sha))
+        try:
+            fp = open(path, 'rb')
+            try:
+                compressed = fp.read()
+            finally:
+                fp.close()
+        except IOError:
+            return None
+
+        if hashlib.sha1(compressed).hexdigest() == sha:
+            return compressed
+
+    def _write_cached(self, fullname, compressed):
+        """Save `compressed` to the disk cache. Since other processes may be
+        reading or writing the same file, it is written to a private
+        temporary file then atomically renamed into place."""
+        sha = hashlib.sha1(compressed).hexdigest()
+        if self._get_cached_sha(fullname) == sha:
+            return
+
+        path = os.path.join(self._cache_dir, '%s.%s' % (fullname, sha))
+        tmp_path = '%s.%d.%d' % (path, os.getpid(),
+                                 threading.currentThread().ident)
+        try:
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir, 448)  # 0700
+            fp = open(tmp_path, 'wb')
+            try:
+                fp.write(compressed)
+            finally:
+                fp.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            LOG.debug('%r: could not cache %r', self, fullname, exc_info=True)
+            return
+        self._disk_index[fullname] = sha
+
+    def _get_request_name(self, fullname):
+        """Return `fullname` as it should appear in :py:data:`GET_MODULE`,
+        suffixed by the hash of any cached copy, along with the hash."""
+        sha = self._get_cached_sha(fullname)
+        if sha:
+            return '%s\x01%s' % (fullname, sha), sha
+        return fullname, None
+
+    def _add_magic(self, data):
+        """Append :py:attr:`magic` to the data of a :py:data:`GET_MODULE`
+        request, so the reply may include bytecode."""
+        return '%s\x02%s' % (data, self.magic.encode('hex'))
+
+    def _complete(self, fullname, tup, sha):
+        """Fill in the source of a reply tuple from the disk cache if the
+        parent omitted it, otherwise cache the source it sent."""
+        if tup is None or not self._cache_dir:
+            return tup
+
+        if tup[2] is not None:
+            self._write_cached(fullname, tup[2])
+            return tup
+
+        compressed = sha and self._read_cached(fullname, sha)
+        if not compressed:
+            # The cached copy vanished since it was advertised; ask again.
+            LOG.debug('%r: cached %r disappeared', self, fullname)
+            self._disk_index.pop(fullname, None)
+            return self._request(fullname)
+        return tup[:2] + (compressed,) + tup[3:]
+
+    def _request(self, fullname):
+        data, sha = self._get_request_name(fullname)
+        tup = self._context.send_await(
+            Message(data=self._add_magic(data), handle=GET_MODULE)
+        )
+        return self._complete(fullname, tup, sha)
+
     def find_module(self, fullname, path=None):
         if hasattr(self.tls, 'running'):
             return None
@@ -437,6 +743,31 @@ class Importer(object):
             # later.
             os.environ['PBR_VERSION'] = '0.0.0'
 
+    def prefetch(self, names):
+        """
+        Fetch any modules named in `names` that are not already cached, using
+        a single :py:data:`GET_MODULE` round trip rather than one per module.
+        For example, to fetch every submodule of an imported package::
+
+            importer.prefetch(importer._present['django.utils'])
+
+        Names the master cannot locate are cached as missing, so a later
+        import of them fails without asking again.
+        """
+        missing = [name for name in names if name not in self._cache]
+        if len(missing) < 2:
+            # A single name is indistinguishable from the non-batch form.
+            return
+
+        LOG.debug('%r.prefetch(%r)', self, missing)
+        requests = [self._get_request_name(name) for name in missing]
+        data = '\x00'.join(name for name, _ in requests)
+        tups = self._context.send_await(
+            Message(data=self._add_magic(data), handle=GET_MODULE)
+        )
+        for name, (_, sha), tup in zip(missing, requests, tups):
+            self._cache.setdefault(name, self._complete(name, tup, sha))
+
     def load_module(self, fullname):
         LOG.debug('Importer.load_module(%r)', fullname)
         self._load_module_hacks(fullname)
@@ -444,11 +775,7 @@ class Importer(object):
         try:
             ret = self._cache[fullname]
         except KeyError:
-            self._cache[fullname] = ret = (
-                self._context.send_await(
-                    Message(data=fullname, handle=GET_MODULE)
-                )
-            )
+            self._cache[fullname] = ret = self._request(fullname)
 
         if ret is None:
             raise ImportError('Master does not have %r' % (fullname,))
@@ -463,10 +790,23 @@ class Importer(object):
             self._present[fullname] = pkg_present
         else:
             mod.__package__ = fullname.rpartition('.')[0] or None
-        code = compile(self.get_source(fullname), mod.__file__, 'exec')
-        exec code in vars(mod)
+        exec self._get_code(fullname, ret) in vars(mod)
         return mod
 
+    def _get_code(self, fullname, tup):
+        """Return the code object for `fullname`, unmarshalled from `tup` if
+        the parent compiled it with the same interpreter version, otherwise
+        compiled from source."""
+        code = tup[4:] and tup[4]
+        if code and code[0] == self.magic:
+            try:
+                return marshal.loads(zlib.decompress(code[1]))
+            except Exception:
+                LOG.debug('%r: bad bytecode for %r', self, fullname,
+                          exc_info=True)
+        return compile(self.get_source(fullname), self.get_filename(fullname),
+                       'exec', 0, True)
+
     def get_filename(self, fullname):
         if fullname in self._cache:
             return 'master:' + self._cache[fullname][1]
@@ -497,11 +837,24 @@ class LogHandler(logging.Handler):
 
 
 class Side(object):
+    _fileio = None
+
+    #: Every live Side, so a forked child can close those it inherited.
+    _fork_refs = weakref.WeakValueDictionary()
+
     def __init__(self, stream, fd, keep_alive=True):
         self.stream = stream
         self.fd = fd
         self.keep_alive = keep_alive
         set_nonblock(fd)
+        self._fork_refs[id(self)] = self
+
+    @classmethod
+    def _on_fork(cls):
+        """Called in a forked child to close every file descriptor belonging
+        to the parent's streams."""
+        for side in cls._fork_refs.values():
+            side.close()
 
     def __repr__(self):
         return '<Side of %r fd %s>' % (self.stream, self.fd)
@@ -516,6 +869,7 @@ class Side(object):
             IOLOG.debug('%r.close()', self)
             os.close(self.fd)
             self.fd = None
+            self._fileio = None
 
     def read(self, n=CHUNK_SIZE):
         s, disconnected = io_op(os.read, self.fd, n)
@@ -523,11 +877,19 @@ class Side(object):
             return ''
         return s
 
+    def readinto(self, buf):
+        if self._fileio is None:
+            self._fileio = io.FileIO(self.fd, 'r', closefd=False)
+        n, disconnected = io_op(self._fileio.readinto, buf)
+        if disconnected:
+            return 0
+        return n
+
     def write(self, s):
         if self.fd is None:
             return None
 
-        written, disconnected = io_op(os.write, self.fd, s[:CHUNK_SIZE])
+        written, disconnected = io_op(os.write, self.fd, s)
         if disconnected:
             return None
         return written
@@ -556,39 +918,241 @@ class Stream(BasicStream):
     :py:class:`BasicStream` subclass implementing mitogen's :ref:`stream
     protocol <stream-protocol>`.
     """
-    _input_buf = ''
+    #: Initial size of the receive buffer. It grows to fit the largest
+    #: message received.
+    input_buf_size = 4 * CHUNK_SIZE
+
+    #: Size above which a grown receive buffer is released, once it is empty
+    #: and the most recent message would have fit in the initial buffer.
+    input_buf_max = 64 * CHUNK_SIZE
+
+    #: When more than this many bytes are queued for transmission, threads
+    #: other than the broker routing messages via the stream block until it
+    #: drains to :py:attr:`output_low_water`. ``None`` disables flow control.
+    output_high_water = 256 * CHUNK_SIZE
+
+    #: Queued byte count at which blocked senders resume, and the ``drain``
+    #: signal fires.
+    output_low_water = 64 * CHUNK_SIZE
+
+    #: Messages to these handles are transmitted ahead of any others queued
+    #: but not yet being written. Order is preserved among messages of the
+    #: same priority.
+    priority_handles = frozenset([
+        SHUTDOWN,
+        ADD_ROUTE,
+        ALLOCATE_ID,
+        FORWARD_LOG,
+        KEEPALIVE,
+    ])
+
+    #: Messages with larger bodies are written as a series of fragments no
+    #: larger than this, interleaved with fragments of messages queued for
+    #: other handles and destinations.
+    frame_size = 4 * CHUNK_SIZE
+
+    #: If ``True``, fragments of at least :py:attr:`compress_threshold` bytes
+    #: are compressed using a zlib stream shared by every message sent, and
+    #: flushed after each fragment. Received fragments are decompressed
+    #: regardless of this setting.
+    compress = False
+
+    #: Fragments shorter than this are never compressed.
+    compress_threshold = 512
+
+    #: If not ``None``, seconds between :py:data:`KEEPALIVE` probes sent by
+    #: :py:meth:`start_keepalive`.
+    keepalive_interval = None
+
+    #: Number of whole intervals that may pass without receiving anything
+    #: before the peer is considered dead and the stream disconnected.
+    keepalive_count = 3
+
+    _keepalive_timer = None
 
     def __init__(self, router, remote_id, **kwargs):
         self._router = router
         self.remote_id = remote_id
         self.name = 'default'
         self.construct(**kwargs)
+        self._input_buf = bytearray(self.input_buf_size)
+        self._input_start = 0
+        self._input_end = 0
+        self._input_want = self.HEADER_LEN
+        self._input_last = 0
+        #: Time anything was last read from the stream.
+        self.last_receive = time.time()
+        #: Whole messages read from the stream, counted as their final
+        #: fragment arrives, and bytes as they appeared on the wire.
+        self.messages_in = 0
+        self.bytes_in = 0
+        #: Messages queued for transmission, and bytes written to the stream.
+        self.messages_out = 0
+        self.bytes_out = 0
+        #: Largest number of bytes ever queued for transmission.
+        self.output_peak = 0
+        #: Seconds the stream spent unable to write queued output because
+        #: the peer, or the link to it, was not accepting more.
+        self.write_blocked_secs = 0.0
+        self._write_blocked_since = None
+        # Messages awaiting transfer to _output_buf, priority messages first.
+        # Each class has a FIFO of whole messages, a rotation of [msg, offset]
+        # pairs for partially sent messages larger than frame_size, and a
+        # flag indicating whether the rotation is served next.
+        self._output_queues = (collections.deque(), collections.deque())
+        self._output_active = (collections.deque(), collections.deque())
+        self._output_turn = [False, False]
         self._output_buf = collections.deque()
+        self._output_buf_len = 0
+        self._output_offset = 0
+        self._reserved = 0
+        self._throttled = False
+        self._throttle_lock = threading.Lock()
+        self._drain_latches = []
+        self._compressor = None
+        self._decompressor = None
+        #: Bytes passed to and returned by the compressor for transmitted
+        #: fragments.
+        self.compress_bytes_in = 0
+        self.compress_bytes_out = 0
+        #: Bytes passed to and returned by the decompressor for received
+        #: fragments.
+        self.decompress_bytes_in = 0
+        self.decompress_bytes_out = 0
 
     def construct(self):
         pass
 
+    @property
+    def pending_bytes(self):
+        """Number of bytes queued for transmission, including messages routed
+        by other threads that the broker has yet to queue."""
+        return self._output_buf_len + self._reserved
+
+    def _reserve(self, n):
+        """Account for `n` bytes routed toward the stream by a thread other
+        than the broker, or release them once the broker queued them."""
+        self._throttle_lock.acquire()
+        try:
+            self._reserved += n
+        finally:
+            self._throttle_lock.release()
+        self._update_throttle()
+
+    def wait_drained(self, timeout=None):
+        """
+        If more than :py:attr:`output_high_water` bytes were queued, block
+        until the queue shrinks to :py:attr:`output_low_water` or the stream
+        disconnects. Must not be called on the broker thread.
+
+        :raises mitogen.core.TimeoutError:
+            The queue did not drain before `timeout` seconds passed.
+        """
+        latch = Latch()
+        self._throttle_lock.acquire()
+        try:
+            if not self._throttled:
+                return
+            self._drain_latches.append(latch)
+        finally:
+            self._throttle_lock.release()
+
+        try:
+            latch.get(timeout=timeout)
+        finally:
+            self._throttle_lock.acquire()
+            try:
+                if latch in self._drain_latches:
+                    self._drain_latches.remove(latch)
+            finally:
+                self._throttle_lock.release()
+
+    def _update_throttle(self):
+        """Enter or leave the throttled state according to the number of bytes
+        queued. Leaving it wakes blocked senders and fires ``drain``."""
+        if self.output_high_water is None:
+            return
+
+        self._throttle_lock.acquire()
+        try:
+            pending = self._output_buf_len + self._reserved
+            if not self._throttled:
+                if pending > self.output_high_water:
+                    LOG.debug('%r: %d bytes queued, throttling senders',
+                              self, pending)
+                    self._throttled = True
+                return
+            if pending > self.output_low_water:
+                return
+            self._throttled = False
+            latches = self._drain_latches
+            self._drain_latches = []
+        finally:
+            self._throttle_lock.release()
+
+        for latch in latches:
+            latch.put(None)
+        fire(self, 'drain')
+
+    def _reserve_input(self):
+        """Ensure the receive buffer has room following the last byte received
+        for the remainder of the message currently being received, and ideally
+        for another :py:data:`CHUNK_SIZE` bytes. Unconsumed bytes are moved at
+        most once per message, so receive cost remains linear in the message
+        size."""
+        buf = self._input_buf
+        start = self._input_start
+        pending = self._input_end - start
+        if (not pending and len(buf) > self.input_buf_max and
+                self._input_last < self.input_buf_size):
+            # Traffic returned to small messages, release the large buffer.
+            buf = self._input_buf = bytearray(self.input_buf_size)
+
+        required = self._input_want - pending
+        desired = max(CHUNK_SIZE, required)
+        free = len(buf) - self._input_end
+        if free >= desired:
+            return
+
+        if start and (len(buf) - pending) >= desired:
+            buf[:pending] = buf[start:self._input_end]
+        elif free >= required > 0:
+            return
+        else:
+            new = bytearray(max(2 * len(buf), pending + desired))
+            new[:pending] = memoryview(buf)[start:self._input_end]
+            self._input_buf = new
+        self._input_start = 0
+        self._input_end = pending
+
     def on_receive(self, broker):
         """Handle the next complete message on the stream. Raise
         :py:class:`StreamError` on failure."""
         IOLOG.debug('%r.on_receive()', self)
 
-        buf = self.receive_side.read()
-        if buf is None:
-            buf = ''
+        self._reserve_input()
+        n = self.receive_side.readinto(
+            memoryview(self._input_buf)[self._input_end:]
+        )
+        if n is None:
+            return  # EAGAIN
 
-        self._input_buf += buf
+        self.last_receive = time.time()
+        self._input_end += n
         while self._receive_one(broker):
             pass
 
-        if not buf:
+        if not n:
             return self.on_disconnect(broker)
 
-    HEADER_FMT = '>hhLLL'
+    HEADER_FMT = '>hhLLBL'
     HEADER_LEN = struct.calcsize(HEADER_FMT)
 
     def _receive_one(self, broker):
-        if len(self._input_buf) < self.HEADER_LEN:
+        start = self._input_start
+        avail = self._input_end - start
+        if avail < self.HEADER_LEN:
+            self._input_want = self.HEADER_LEN
             return False
 
         msg = Message()
@@ -596,46 +1160,197 @@ class Stream(BasicStream):
         msg.router = self._router
 
         (msg.dst_id, msg.src_id,
-         msg.handle, msg.reply_to, msg_len) = struct.unpack(
+         msg.handle, msg.reply_to, msg.flags, msg_len) = struct.unpack_from(
             self.HEADER_FMT,
-            self._input_buf[:self.HEADER_LEN]
+            self._input_buf,
+            start
         )
 
-        if (len(self._input_buf) - self.HEADER_LEN) < msg_len:
+        if (avail - self.HEADER_LEN) < msg_len:
             IOLOG.debug('%r: Input too short (want %d, got %d)',
-                        self, msg_len, len(self._input_buf) - self.HEADER_LEN)
+                        self, msg_len, avail - self.HEADER_LEN)
+            self._input_want = self.HEADER_LEN + msg_len
             return False
 
-        msg.data = self._input_buf[self.HEADER_LEN:self.HEADER_LEN+msg_len]
-        self._input_buf = self._input_buf[self.HEADER_LEN+msg_len:]
+        start += self.HEADER_LEN
+        # The only copy made of the message body.
+        msg.data = memoryview(self._input_buf)[start:start+msg_len].tobytes()
+        self._input_start = start + msg_len
+        self._input_last = msg_len
+        if self._input_start == self._input_end:
+            self._input_start = self._input_end = 0
+        if not msg.flags & FLAG_MORE:
+            self.messages_in += 1
+        self.bytes_in += self.HEADER_LEN + msg_len
+        if msg.flags & FLAG_COMPRESSED:
+            msg.data = self._decompress(msg.data)
+            msg.flags &= ~FLAG_COMPRESSED
         self._router._async_route(msg, self)
         return True
 
+    def _compress(self, data):
+        if self._compressor is None:
+            self._compressor = zlib.compressobj()
+        out = (self._compressor.compress(data) +
+               self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.compress_bytes_in += len(data)
+        self.compress_bytes_out += len(out)
+        return out
+
+    def _decompress(self, data):
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+        out = self._decompressor.decompress(data)
+        self.decompress_bytes_in += len(data)
+        self.decompress_bytes_out += len(out)
+        return out
+
+    #: Small queued headers and bodies are coalesced into a single write of up
+    #: to this many bytes. Pieces at least this large are written directly.
+    gather_size = 4 * CHUNK_SIZE
+
+    def _gather(self):
+        """Return the next buffer to write: either a zero-copy
+        :py:func:`buffer` over the remainder of a large queued piece, or many
+        small pieces joined together, topped up with the head of any large
+        piece that follows them."""
+        bufs = self._output_buf
+        piece = bufs[0]
+        if len(piece) - self._output_offset >= self.gather_size:
+            return buffer(piece, self._output_offset)
+
+        chunks = [piece[self._output_offset:]]
+        size = len(chunks[0])
+        for piece in itertools.islice(bufs, 1, None):
+            if size >= self.gather_size:
+                break
+            # Slicing also turns a fragment's buffer into a joinable string.
+            piece = piece[:self.gather_size - size]
+            chunks.append(piece)
+            size += len(piece)
+        return ''.join(chunks)
+
+    def _consume_output(self, n):
+        """Discard `n` written bytes from the head of the output buffer. A
+        partially written piece is tracked by offset rather than sliced."""
+        self._output_buf_len -= n
+        n += self._output_offset
+        bufs = self._output_buf
+        while n and n >= len(bufs[0]):
+            n -= len(bufs.popleft())
+        self._output_offset = n
+        if self._throttled:
+            self._update_throttle()
+
+    def _next_entry(self, klass):
+        """Return the `[msg, offset]` pair whose fragment should be sent next
+        from a priority class. The head of the FIFO and the rotation of
+        partially sent messages take turns. The head waits while a message
+        with the same destination, source and handle is partially sent, since
+        the peer reassembles fragments by source and handle."""
+        queue = self._output_queues[klass]
+        active = self._output_active[klass]
+        if queue and not (active and self._output_turn[klass]):
+            msg = queue[0]
+            key = (msg.dst_id, msg.src_id, msg.handle)
+            if not any(key == (m.dst_id, m.src_id, m.handle)
+                       for m, _ in active):
+                queue.popleft()
+                self._output_turn[klass] = True
+                return [msg, 0]
+        self._output_turn[klass] = False
+        return active.popleft()
+
+    def _next_frame(self, klass):
+        """Append the next fragment of a message from a priority class to the
+        output buffer, returning the number of bytes appended."""
+        entry = self._next_entry(klass)
+        msg, offset = entry
+        n = min(self.frame_size, len(msg.data) - offset)
+        flags = msg.flags
+        if offset + n < len(msg.data):
+            flags |= FLAG_MORE
+            entry[1] += n
+            self._output_active[klass].append(entry)
+
+        if offset:
+            # Only the first fragment's header was counted by _send().
+            self._output_buf_len += self.HEADER_LEN
+        if n == len(msg.data):
+            data = msg.data
+        else:
+            data = buffer(msg.data, offset, n)
+
+        if self.compress and n >= self.compress_threshold:
+            # Compress only as fragments are committed to the output buffer,
+            # so the peer's decompressor sees them in the same order.
+            data = self._compress(data)
+            flags |= FLAG_COMPRESSED
+            self._output_buf_len += len(data) - n
+
+        self._output_buf.append(struct.pack(self.HEADER_FMT, msg.dst_id,
+                                            msg.src_id, msg.handle,
+                                            msg.reply_to or 0, flags,
+                                            len(data)))
+        if data:
+            self._output_buf.append(data)
+        return self.HEADER_LEN + len(data)
+
+    def _refill_output(self):
+        """Move up to :py:attr:`gather_size` bytes of message fragments into
+        the empty output buffer, taking priority messages before any others.
+        Within each class, messages are sent in the order they were queued,
+        except that messages larger than :py:attr:`frame_size` are sent a
+        fragment at a time, taking turns with the messages queued after them,
+        so one large message cannot stall the rest. Keeping the buffer short
+        bounds how long a priority message waits behind fragments already
+        committed to it."""
+        size = 0
+        for klass in 0, 1:
+            queue = self._output_queues[klass]
+            active = self._output_active[klass]
+            while (queue or active) and size < self.gather_size:
+                size += self._next_frame(klass)
+
     def on_transmit(self, broker):
         """Transmit buffered messages."""
         IOLOG.debug('%r.on_transmit()', self)
 
+        if self._write_blocked_since is not None:
+            self.write_blocked_secs += time.time() - self._write_blocked_since
+            self._write_blocked_since = None
+
+        if not self._output_buf:
+            self._refill_output()
+
         if self._output_buf:
-            buf = self._output_buf.popleft()
+            buf = self._gather()
             written = self.transmit_side.write(buf)
             if not written:
                 LOG.debug('%r.on_transmit(): disconnection detected', self)
                 self.on_disconnect(broker)
                 return
-            elif written != len(buf):
-                self._output_buf.appendleft(buf[written:])
 
+            if written < len(buf):
+                # The descriptor cannot accept more until it is writable.
+                self._write_blocked_since = time.time()
+            self.bytes_out += written
+            self._consume_output(written)
             IOLOG.debug('%r.on_transmit() -> len %d', self, written)
 
-        if not self._output_buf:
+        if not self._output_buf_len:
             broker.stop_transmit(self)
+            fire(self, 'flushed')
 
     def _send(self, msg):
         IOLOG.debug('%r._send(%r)', self, msg)
-        pkt = struct.pack('>hhLLL', msg.dst_id, msg.src_id,
-                          msg.handle, msg.reply_to or 0, len(msg.data)
-        ) + msg.data
-        self._output_buf.append(pkt)
+        klass = int(msg.handle not in self.priority_handles)
+        self._output_queues[klass].append(msg)
+        self._output_buf_len += self.HEADER_LEN + len(msg.data)
+        self.messages_out += 1
+        if self._output_buf_len > self.output_peak:
+            self.output_peak = self._output_buf_len
+        self._update_throttle()
         self._router.broker.start_transmit(self)
 
     def send(self, msg):
@@ -643,8 +1358,75 @@ class Stream(BasicStream):
         be called from any thread."""
         self._router.broker.defer(self._send, msg)
 
+    def get_stats(self):
+        """Return a dict containing the current value of each counter."""
+        return {
+            'name': self.name,
+            'remote_id': self.remote_id,
+            'messages_in': self.messages_in,
+            'bytes_in': self.bytes_in,
+            'messages_out': self.messages_out,
+            'bytes_out': self.bytes_out,
+            'output_queued': self._output_buf_len,
+            'output_peak': self.output_peak,
+            'write_blocked_secs': self.write_blocked_secs,
+            'compress_bytes_in': self.compress_bytes_in,
+            'compress_bytes_out': self.compress_bytes_out,
+            'decompress_bytes_in': self.decompress_bytes_in,
+            'decompress_bytes_out': self.decompress_bytes_out,
+        }
+
+    def start_keepalive(self):
+        """
+        If :py:attr:`keepalive_interval` is set, send a :py:data:`KEEPALIVE`
+        probe to the peer every interval, and disconnect the stream if nothing
+        was received for :py:attr:`keepalive_count` intervals. Since the peer
+        answers each probe, an idle but healthy connection always has traffic,
+        while a connection whose link silently stopped delivering is noticed
+        long before TCP gives up. Must be called on the broker thread.
+        """
+        if self.keepalive_interval:
+            self.last_receive = time.time()
+            self._keepalive_timer = self._router.broker.timer(
+                self.keepalive_interval, self._on_keepalive_timer
+            )
+
+    def stop_keepalive(self):
+        """Stop sending :py:data:`KEEPALIVE` probes."""
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+            self._keepalive_timer = None
+
+    def _on_keepalive_timer(self):
+        broker = self._router.broker
+        limit = self.keepalive_interval * self.keepalive_count
+        if (time.time() - self.last_receive) > limit:
+            LOG.error('%r: nothing received for %.1f seconds, disconnecting',
+                      self, time.time() - self.last_receive)
+            self._keepalive_timer = None
+            return self.on_disconnect(broker)
+
+        self._send(
+            Message(
+                dst_id=self.remote_id,
+                handle=KEEPALIVE,
+                reply_to=KEEPALIVE,
+            )
+        )
+        self._keepalive_timer = broker.timer(self.keepalive_interval,
+                                             self._on_keepalive_timer)
+
     def on_disconnect(self, broker):
+        self.stop_keepalive()
         super(Stream, self).on_disconnect(broker)
+        # Nothing more will be written, so release any blocked senders.
+        for queue, active in zip(self._output_queues, self._output_active):
+            queue.clear()
+            active.clear()
+        self._output_buf.clear()
+        self._output_buf_len = 0
+        self._output_offset = 0
+        self._update_throttle()
         self._router.on_disconnect(self, broker)
 
     def on_shutdown(self, broker):
@@ -708,6 +1490,11 @@ class Context(object):
         IOLOG.debug('%r._send_await() -> %r', self, response)
         return response
 
+    def get_stats(self, deadline=None):
+        """Return the result of :py:meth:`Router.get_stats` in this
+        context."""
+        return self.send_await(Message(handle=GET_STATS), deadline)
+
     def __repr__(self):
         return 'Context(%s, %r)' % (self.context_id, self.name)
 
@@ -770,12 +1557,15 @@ class IoLogger(BasicStream):
         self._name = name
         self._log = logging.getLogger(name)
 
-        self._rsock, self._wsock = socket.socketpair()
+        rsock, self._wsock = socket.socketpair()
         os.dup2(self._wsock.fileno(), dest_fd)
-        set_cloexec(self._rsock.fileno())
         set_cloexec(self._wsock.fileno())
 
-        self.receive_side = Side(self, self._rsock.fileno())
+        # The Side is the sole owner of the read end, so nothing else closes
+        # its descriptor after Side._on_fork() has done so.
+        self.receive_side = Side(self, os.dup(rsock.fileno()))
+        set_cloexec(self.receive_side.fd)
+        rsock.close()
         self.transmit_side = Side(self, dest_fd)
         self._broker.start_receive(self)
 
@@ -813,22 +1603,38 @@ class Router(object):
         self._stream_by_id = {}
         #: List of contexts to notify of shutdown.
         self._context_by_id = {}
-        self._last_handle = itertools.count(1000)
+        self._last_handle = itertools.count(FIRST_DYNAMIC_HANDLE)
         #: handle -> (persistent?, func(msg))
         self._handle_map = {
-            ADD_ROUTE: (True, self._on_add_route)
+            ADD_ROUTE: (True, self._on_add_route),
+            KEEPALIVE: (True, self._on_keepalive),
+            GET_STATS: (True, self._on_get_stats),
         }
+        #: handle -> number of messages dispatched to its handler.
+        self._dispatch_counts = {}
+        #: (src_id, handle) -> list of fragments received so far.
+        self._fragments = {}
 
     def __repr__(self):
         return 'Router(%r)' % (self.broker,)
 
     def on_disconnect(self, stream, broker):
-        """Invoked by Stream.on_disconnect()."""
-        for context in self._context_by_id.itervalues():
-            stream_ = self._stream_by_id.get(context.context_id)
+        """Invoked by Stream.on_disconnect(). Forget every route via `stream`,
+        including those to contexts it merely forwarded messages to, and
+        notify the affected contexts, so receivers awaiting replies from them
+        fail immediately."""
+        for context_id, stream_ in self._stream_by_id.items():
             if stream_ is stream:
-                del self._stream_by_id[context.context_id]
-                context.on_disconnect(broker)
+                del self._stream_by_id[context_id]
+                context = self._context_by_id.get(context_id)
+                if context is not None:
+                    context.on_disconnect(broker)
+
+        # Discard partial messages whose remaining fragments can never arrive.
+        parent_stream = self._stream_by_id.get(mitogen.parent_id)
+        for key in self._fragments.keys():
+            if self._stream_by_id.get(key[0], parent_stream) is None:
+                del self._fragments[key]
 
     def on_broker_shutdown(self):
         for context in self._context_by_id.itervalues():
@@ -847,6 +1653,40 @@ class Router(object):
             target_id, via_id = map(int, msg.data.split('\x00'))
             self.add_route(target_id, via_id)
 
+    def get_stats(self):
+        """
+        Return a snapshot of traffic statistics for this context: a dict
+        containing its `context_id`, `handles`, a dict mapping each well-known
+        handle to the number of messages dispatched to it, with those for
+        allocated handles counted together under ``'dynamic'``, and
+        `streams`, a list
+        containing the result of :py:meth:`Stream.get_stats` for every
+        connected stream. Safe to call from any thread.
+        """
+        streams = []
+        for stream in self._stream_by_id.values():
+            if stream not in streams:
+                streams.append(stream)
+        return {
+            'context_id': mitogen.context_id,
+            'handles': dict(self._dispatch_counts),
+            'streams': [stream.get_stats() for stream in streams],
+        }
+
+    def _on_get_stats(self, msg):
+        """Reply to a :py:data:`GET_STATS` request with :py:meth:`get_stats`."""
+        if msg != _DEAD and msg.reply_to:
+            self._async_route(
+                Message.pickled(self.get_stats(), dst_id=msg.src_id,
+                                handle=msg.reply_to)
+            )
+
+    def _on_keepalive(self, msg):
+        """Answer a :py:data:`KEEPALIVE` probe. Answers are sent with no
+        `reply_to`, and are otherwise ignored."""
+        if msg != _DEAD and msg.reply_to:
+            self._async_route(Message(dst_id=msg.src_id, handle=msg.reply_to))
+
     def register(self, context, stream):
         LOG.debug('register(%r, %r)', context, stream)
         self._stream_by_id[context.context_id] = stream
@@ -867,6 +1707,10 @@ class Router(object):
 
         return handle
 
+    def del_handler(self, handle):
+        """Remove the handler registered for `handle`, if any."""
+        self._handle_map.pop(handle, None)
+
     def on_shutdown(self, broker):
         """Called during :py:meth:`Broker.shutdown`, informs callbacks
         registered with :py:meth:`add_handle_cb` the connection is dead."""
@@ -887,37 +1731,299 @@ class Router(object):
         if not persist:
             del self._handle_map[msg.handle]
 
+        # Handles allocated for each call share a count, since keeping one
+        # for each would grow the table without bound.
+        key = msg.handle
+        if key >= FIRST_DYNAMIC_HANDLE:
+            key = 'dynamic'
+        counts = self._dispatch_counts
+        counts[key] = counts.get(key, 0) + 1
+
         try:
             fn(msg)
         except Exception:
             LOG.exception('%r._invoke(%r): %r crashed', self, msg, fn)
 
+    def _reassemble(self, msg):
+        """Collect a fragment of a message written in pieces by
+        :py:class:`Stream`, returning the complete message once its final
+        fragment arrives, or ``None`` while more are expected. Fragments of a
+        message are never reordered, since every hop transmits messages
+        sharing a source, destination and handle in turn."""
+        key = (msg.src_id, msg.handle)
+        if msg.flags & FLAG_MORE:
+            self._fragments.setdefault(key, []).append(msg.data)
+            return None
+
+        fragments = self._fragments.pop(key, None)
+        if fragments is not None:
+            fragments.append(msg.data)
+            msg.data = ''.join(fragments)
+        return msg
+
     def _async_route(self, msg, stream=None):
         IOLOG.debug('%r._async_route(%r, %r)', self, msg, stream)
-        # Perform source verification.
+        # Perform source verification. Any stream connected to the expected
+        # peer is accepted, since one may be replacing another.
         if stream is not None:
             expected_stream = self._stream_by_id.get(msg.src_id,
                 self._stream_by_id.get(mitogen.parent_id))
-            if stream != expected_stream:
+            if stream != expected_stream and (expected_stream is None or
+                    stream.remote_id != expected_stream.remote_id):
                 LOG.error('%r: bad source: got %r from %r, should be from %r',
                           self, msg, stream, expected_stream)
 
         if msg.dst_id == mitogen.context_id:
+            if (msg.flags & FLAG_MORE) or self._fragments:
+                msg = self._reassemble(msg)
+                if msg is None:
+                    return
             return self._invoke(msg)
 
-        stream = self._stream_by_id.get(msg.dst_id)
-        if stream is None:
-            stream = self._stream_by_id.get(mitogen.parent_id)
+        out_stream = self._stream_by_id.get(msg.dst_id)
+        if out_stream is None:
+            out_stream = self._stream_by_id.get(mitogen.parent_id)
 
-        if stream is None:
+        if out_stream is None or (stream is not None and out_stream is stream):
+            # The latter occurs for messages to a context that was reachable
+            # via a stream that since disconnected, and prevents them bouncing
+            # between parent and child.
             LOG.error('%r: no route for %r, my ID is %r',
                       self, msg, mitogen.context_id)
             return
 
-        stream.send(msg)
+        out_stream.send(msg)
 
     def route(self, msg):
-        self.broker.defer(self._async_route, msg)
+        """
+        Arrange for `msg` to be delivered by the broker thread. When called
+        from any other thread, first block while the stream the message will
+        leave on has more than :py:attr:`Stream.output_high_water` bytes
+        queued.
+        """
+        stream = None
+        if (msg.dst_id != mitogen.context_id and
+                threading.currentThread() is not self.broker._thread):
+            stream = self._stream_by_id.get(msg.dst_id,
+                self._stream_by_id.get(mitogen.parent_id))
+
+        if stream is None:
+            self.broker.defer(self._async_route, msg)
+            return
+
+        # Count the message against the stream immediately, so a thread
+        # cannot queue many messages before the broker gets to run.
+        stream.wait_drained()
+        size = stream.HEADER_LEN + len(msg.data)
+        stream._reserve(size)
+        self.broker.defer(self._route_reserved, msg, stream, size)
+
+    def _route_reserved(self, msg, stream, size):
+        try:
+            self._async_route(msg)
+        finally:
+            stream._reserve(-size)
+
+
+class Poller(object):
+    """
+    Track file descriptors awaiting readability or writability, and block
+    until some become ready. This implementation uses :py:func:`select.select`,
+    so it is limited to descriptors below ``FD_SETSIZE``, but it is available
+    everywhere. Registrations are updated incrementally, so subclasses can
+    maintain kernel-side interest sets.
+    """
+    def __init__(self):
+        #: fd -> data
+        self._rfds = {}
+        #: fd -> data
+        self._wfds = {}
+
+    def __repr__(self):
+        return '%s()' % (type(self).__name__,)
+
+    @property
+    def readers(self):
+        """List of `(fd, data)` tuples for every registered reader."""
+        return self._rfds.items()
+
+    @property
+    def writers(self):
+        """List of `(fd, data)` tuples for every registered writer."""
+        return self._wfds.items()
+
+    def close(self):
+        pass
+
+    def _update(self, fd):
+        """Called after the registration of `fd` changes."""
+
+    def start_receive(self, fd, data=None):
+        self._rfds[fd] = data
+        self._update(fd)
+
+    def stop_receive(self, fd):
+        self._rfds.pop(fd, None)
+        self._update(fd)
+
+    def start_transmit(self, fd, data=None):
+        self._wfds[fd] = data
+        self._update(fd)
+
+    def stop_transmit(self, fd):
+        self._wfds.pop(fd, None)
+        self._update(fd)
+
+    def _poll(self, timeout):
+        try:
+            rfds, wfds, _ = select.select(self._rfds, self._wfds, (), timeout)
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            return (), ()
+        return rfds, wfds
+
+    def poll(self, timeout=None):
+        """Block for up to `timeout` seconds, or forever if ``None``, then
+        yield `data` for each readable descriptor followed by each writable
+        descriptor. A descriptor unregistered by the consumer of an earlier
+        item is skipped."""
+        rfds, wfds = self._poll(timeout)
+        for fd in rfds:
+            if fd in self._rfds:
+                yield self._rfds[fd]
+        for fd in wfds:
+            if fd in self._wfds:
+                yield self._wfds[fd]
+
+
+class PollPoller(Poller):
+    """
+    :py:class:`Poller` implementation using :py:func:`select.poll`, which has
+    no descriptor limit.
+    """
+    _IN = select.POLLIN | select.POLLHUP | select.POLLERR | select.POLLNVAL
+    _OUT = select.POLLOUT | select.POLLHUP | select.POLLERR | select.POLLNVAL
+
+    def __init__(self):
+        super(PollPoller, self).__init__()
+        self._pollobj = select.poll()
+
+    def _update(self, fd):
+        mask = (((fd in self._rfds) and select.POLLIN) |
+                ((fd in self._wfds) and select.POLLOUT))
+        if mask:
+            self._pollobj.register(fd, mask)
+        else:
+            try:
+                self._pollobj.unregister(fd)
+            except KeyError:
+                pass
+
+    def _poll(self, timeout):
+        if timeout is not None:
+            timeout *= 1000
+        try:
+            events = self._pollobj.poll(timeout)
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            return (), ()
+        return ([fd for fd, event in events if event & self._IN],
+                [fd for fd, event in events if event & self._OUT])
+
+
+class EpollPoller(Poller):
+    """
+    :py:class:`Poller` implementation using :py:func:`select.epoll`, whose
+    cost is proportional to the number of ready descriptors rather than the
+    number registered.
+    """
+    _IN = select.POLLIN | select.POLLHUP | select.POLLERR
+    _OUT = select.POLLOUT | select.POLLHUP | select.POLLERR
+
+    def __init__(self):
+        super(EpollPoller, self).__init__()
+        self._epoll = select.epoll(32)
+        set_cloexec(self._epoll.fileno())
+        #: fd -> registered event mask
+        self._registered = {}
+
+    def close(self):
+        self._epoll.close()
+
+    def _control(self, func, fd, *args):
+        try:
+            func(fd, *args)
+        except (IOError, OSError), e:
+            # The descriptor may already have been closed, which silently
+            # removes it from the interest set.
+            if e.errno not in (errno.EBADF, errno.ENOENT):
+                raise
+
+    def _update(self, fd):
+        mask = (((fd in self._rfds) and select.EPOLLIN) |
+                ((fd in self._wfds) and select.EPOLLOUT))
+        old = self._registered.get(fd, 0)
+        if mask == old:
+            return
+        if not mask:
+            del self._registered[fd]
+            self._control(self._epoll.unregister, fd)
+            return
+
+        self._registered[fd] = mask
+        if not old:
+            try:
+                self._epoll.register(fd, mask)
+            except (IOError, OSError), e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self._epoll.modify(fd, mask)
+        else:
+            self._control(self._epoll.modify, fd, mask)
+
+    def _poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._epoll.poll(timeout)
+        except (IOError, OSError), e:
+            if e.errno != errno.EINTR:
+                raise
+            return (), ()
+        return ([fd for fd, event in events if event & self._IN],
+                [fd for fd, event in events if event & self._OUT])
+
+
+if hasattr(select, 'epoll'):
+    PREFERRED_POLLER = EpollPoller
+elif hasattr(select, 'poll') and sys.platform != 'darwin':
+    # OS X poll() is broken for TTYs.
+    PREFERRED_POLLER = PollPoller
+else:
+    PREFERRED_POLLER = Poller
+
+
+class Timer(object):
+    """
+    Represent a call scheduled by :py:meth:`Broker.timer`.
+    """
+    #: ``True`` once the call has been made or :py:meth:`cancel` was called.
+    cancelled = False
+
+    def __init__(self, when, func):
+        #: UNIX timestamp after which the call is made.
+        self.when = when
+        self.func = func
+
+    def __repr__(self):
+        return 'Timer(%r, %r)' % (self.when, self.func)
+
+    def cancel(self):
+        """Prevent the call being made, if it has not been already. Safe to
+        call from any thread."""
+        self.cancelled = True
 
 
 class Broker(object):
@@ -925,11 +2031,16 @@ class Broker(object):
     _thread = None
     shutdown_timeout = 3.0
 
+    #: :py:class:`Poller` subclass used to wait for IO.
+    poller_class = PREFERRED_POLLER
+
     def __init__(self):
         self._alive = True
         self._queue = Queue.Queue()
-        self._readers = set()
-        self._writers = set()
+        #: Heap of `(when, seq, timer)` scheduled by :py:meth:`timer`.
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self.poller = self.poller_class()
         self._waker = Waker(self)
         self.start_receive(self._waker)
         self._thread = threading.Thread(
@@ -948,21 +2059,25 @@ class Broker(object):
 
     def start_receive(self, stream):
         IOLOG.debug('%r.start_receive(%r)', self, stream)
-        assert stream.receive_side and stream.receive_side.fd is not None
-        self.defer(self._readers.add, stream.receive_side)
+        side = stream.receive_side
+        assert side and side.fd is not None
+        self.defer(self.poller.start_receive,
+                   side.fd, (side, stream.on_receive))
 
     def stop_receive(self, stream):
         IOLOG.debug('%r.stop_receive(%r)', self, stream)
-        self.defer(self._readers.discard, stream.receive_side)
+        self.defer(self.poller.stop_receive, stream.receive_side.fd)
 
     def start_transmit(self, stream):
         IOLOG.debug('%r.start_transmit(%r)', self, stream)
-        assert stream.transmit_side and stream.transmit_side.fd is not None
-        self.defer(self._writers.add, stream.transmit_side)
+        side = stream.transmit_side
+        assert side and side.fd is not None
+        self.defer(self.poller.start_transmit,
+                   side.fd, (side, stream.on_transmit))
 
     def stop_transmit(self, stream):
         IOLOG.debug('%r.stop_transmit(%r)', self, stream)
-        self.defer(self._writers.discard, stream.transmit_side)
+        self.defer(self.poller.stop_transmit, stream.transmit_side.fd)
 
     def _call(self, stream, func):
         try:
@@ -981,24 +2096,69 @@ class Broker(object):
                               func, args, kwargs)
                 self.shutdown()
 
+    def timer(self, delay, func):
+        """
+        Arrange for `func()` to be called on the broker thread after `delay`
+        seconds, returning a :py:class:`Timer` that may be used to cancel the
+        call. Safe to call from any thread.
+
+        Timers are kept in a heap whose earliest deadline bounds the time the
+        broker waits for IO, so scheduling or cancelling a timer costs
+        O(log n), and no thread need wake periodically to check for expiry.
+        """
+        timer = Timer(time.time() + delay, func)
+        self.defer(self._push_timer, timer)
+        return timer
+
+    def _push_timer(self, timer):
+        heapq.heappush(self._timers, (timer.when, self._timer_seq.next(),
+                                      timer))
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            timer.cancelled = True
+            try:
+                timer.func()
+            except Exception:
+                LOG.exception('%r: %r crashed', self, timer)
+
+    def _get_timeout(self, timeout):
+        """Return the lesser of `timeout` and the time remaining until the
+        next timer is due."""
+        # Cancelled timers are discarded once they reach the top of the heap,
+        # so they cannot shorten the wait.
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if self._timers:
+            remaining = max(0, self._timers[0][0] - time.time())
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
     def _loop_once(self, timeout=None):
         IOLOG.debug('%r._loop_once(%r)', self, timeout)
         self._run_defer()
+        timeout = self._get_timeout(timeout)
+
+        #IOLOG.debug('readers = %r', self.poller.readers)
+        #IOLOG.debug('writers = %r', self.poller.writers)
+        for side, func in self.poller.poll(timeout):
+            IOLOG.debug('%r: %s for %r', self, func.__name__, side)
+            self._call(side.stream, func)
 
-        #IOLOG.debug('readers = %r', self._readers)
-        #IOLOG.debug('writers = %r', self._writers)
-        rsides, wsides, _ = select.select(self._readers, self._writers,
-                                          (), timeout)
-        for side in rsides:
-            IOLOG.debug('%r: POLLIN for %r', self, side)
-            self._call(side.stream, side.stream.on_receive)
+        self._run_timers()
 
-        for side in wsides:
-            IOLOG.debug('%r: POLLOUT for %r', self, side)
-            self._call(side.stream, side.stream.on_transmit)
+    def _sides(self):
+        return set(side for _, (side, _) in (self.poller.readers +
+                                             self.poller.writers))
 
     def keep_alive(self):
-        return (sum((side.keep_alive for side in self._readers), 0) +
+        return (sum((side.keep_alive for _, (side, _) in self.poller.readers),
+                    0) +
                 (not self._queue.empty()))
 
     def _broker_main(self):
@@ -1009,7 +2169,7 @@ class Broker(object):
             self._run_defer()
             fire(self, 'shutdown')
 
-            for side in self._readers | self._writers:
+            for side in self._sides():
                 self._call(side.stream, side.stream.on_shutdown)
 
             deadline = time.time() + self.shutdown_timeout
@@ -1022,9 +2182,10 @@ class Broker(object):
                           'more child processes still connected to '
                           'our stdout/stderr pipes.', self)
 
-            for side in self._readers | self._writers:
+            for side in self._sides():
                 LOG.error('_broker_main() force disconnecting %r', side)
                 side.stream.on_disconnect(self)
+            self.poller.close()
         except Exception:
             LOG.exception('_broker_main() crashed')
 
@@ -1090,7 +2251,7 @@ class ExternalContext(object):
         if debug:
             enable_debug_logging()
 
-    def _setup_importer(self, core_src_fd):
+    def _setup_importer(self, core_src_fd, cache_dir):
         if core_src_fd:
             with os.fdopen(101, 'r', 1) as fp:
                 core_size = int(fp.readline())
@@ -1101,7 +2262,7 @@ class ExternalContext(object):
         else:
             core_src = None
 
-        self.importer = Importer(self.parent, core_src)
+        self.importer = Importer(self.router, self.parent, core_src, cache_dir)
         sys.meta_path.append(self.importer)
 
     def _setup_package(self, context_id, parent_ids):
@@ -1133,42 +2294,152 @@ class ExternalContext(object):
         finally:
             fp.close()
 
-    def _dispatch_calls(self):
-        for msg, data in self.channel:
-            LOG.debug('_dispatch_calls(%r)', data)
-            if msg.src_id not in mitogen.parent_ids:
-                LOG.warning('CALL_FUNCTION from non-parent %r', msg.src_id)
-
-            modname, klass, func, args, kwargs = data
+    def _invoke(self, data):
+        modname, klass, func, args, kwargs = data
+        obj = __import__(modname, {}, {}, [''])
+        if klass:
+            obj = getattr(obj, klass)
+        fn = getattr(obj, func)
+        if getattr(fn, 'mitogen_takes_econtext', None):
+            kwargs.setdefault('econtext', self)
+        if getattr(fn, 'mitogen_takes_router', None):
+            kwargs.setdefault('router', self.router)
+        return fn(*args, **kwargs)
+
+    def _invoke_many(self, calls):
+        """Run each call of a batch in order, replacing the result of any
+        that fail with a :py:class:`CallError`, so one failure does not
+        prevent the remaining calls from running."""
+        results = []
+        for data in calls:
             try:
-                obj = __import__(modname, {}, {}, [''])
-                if klass:
-                    obj = getattr(obj, klass)
-                fn = getattr(obj, func)
-                if getattr(fn, 'mitogen_takes_econtext', None):
-                    kwargs.setdefault('econtext', self)
-                if getattr(fn, 'mitogen_takes_router', None):
-                    kwargs.setdefault('router', self.router)
-                ret = fn(*args, **kwargs)
-                self.router.route(
-                    Message.pickled(ret, dst_id=msg.src_id, handle=msg.reply_to)
-                )
+                results.append(self._invoke(data))
             except Exception, e:
-                LOG.debug('_dispatch_calls: %s', e)
-                e = CallError(e)
+                LOG.debug('_invoke_many: %s', e)
+                results.append(CallError(e))
+        return results
+
+    def _start_stream(self, msg, data):
+        """Invoke the function named by `data`, then send the items of the
+        iterable it returns from a thread of their own, so a consumer pausing
+        midway does not hold a dispatch worker, which by default is the only
+        one."""
+        it = iter(self._invoke(data[:5]))
+        thread = threading.Thread(
+            target=_profile_hook,
+            args=('stream', self._stream, msg, data, it),
+            name='mitogen-stream'
+        )
+        thread.setDaemon(True)
+        thread.start()
+
+    def _stream(self, msg, data, it):
+        """Send the items of `it` to the caller in lists of up to
+        `chunk_size` items, pausing whenever `window` lists are
+        unacknowledged. The caller is first sent the handle on which it
+        acknowledges each list as it is consumed, or on which it sends
+        :py:data:`_DEAD` to stop the iterable early."""
+        window, chunk_size = data[5]
+        # An unregistered caller is reached via the parent, so its death is
+        # seen as the parent disconnecting.
+        caller = self.router._context_by_id.get(msg.src_id, self.parent)
+        acks = Receiver(self.router, respondent=caller)
+        try:
+            self.router.route(
+                Message.pickled(acks.handle, dst_id=msg.src_id,
+                                handle=msg.reply_to)
+            )
+            unacked = 0
+            end = _DEAD
+            while True:
+                try:
+                    chunk = list(itertools.islice(it, chunk_size))
+                except Exception, e:
+                    LOG.debug('_stream: %s', e)
+                    end = CallError(e)
+                    chunk = []
+                if not chunk:
+                    break
+                while unacked and (unacked == window or not acks.empty()):
+                    acks.get()
+                    unacked -= 1
                 self.router.route(
-                    Message.pickled(e, dst_id=msg.src_id, handle=msg.reply_to)
+                    Message.pickled(chunk, dst_id=msg.src_id,
+                                    handle=msg.reply_to)
                 )
+                unacked += 1
+
+            self.router.route(
+                Message.pickled(end, dst_id=msg.src_id, handle=msg.reply_to)
+            )
+            # Acknowledgements are still in flight.
+            while unacked:
+                acks.get()
+                unacked -= 1
+        except ChannelError:
+            LOG.debug('_stream: %r abandoned by caller', data[2])
+        finally:
+            self.router.del_handler(acks.handle)
+            if hasattr(it, 'close'):
+                it.close()
+
+    def _dispatch_one(self, msg, data):
+        if msg.src_id not in mitogen.parent_ids:
+            LOG.warning('CALL_FUNCTION from non-parent %r', msg.src_id)
+
+        try:
+            if isinstance(data, list):
+                ret = self._invoke_many(data)
+            elif len(data) == 6:
+                return self._start_stream(msg, data)
+            else:
+                ret = self._invoke(data)
+            self.router.route(
+                Message.pickled(ret, dst_id=msg.src_id, handle=msg.reply_to)
+            )
+        except Exception, e:
+            LOG.debug('_dispatch_calls: %s', e)
+            e = CallError(e)
+            self.router.route(
+                Message.pickled(e, dst_id=msg.src_id, handle=msg.reply_to)
+            )
+
+    def _dispatch_calls(self):
+        for msg, data in self.channel:
+            LOG.debug('_dispatch_calls(%r)', data)
+            self._dispatch_one(msg, data)
+        # Only one waiter receives the close; pass it on to the next worker.
+        self.channel.close()
+
+    def _start_workers(self, max_workers):
+        self.workers = []
+        for x in xrange(1, max_workers):
+            thread = threading.Thread(
+                target=_profile_hook,
+                args=('worker%d' % (x,), self._dispatch_calls),
+                name='mitogen-worker-%d' % (x,)
+            )
+            thread.setDaemon(True)
+            thread.start()
+            self.workers.append(thread)
+
+    def _join_workers(self):
+        for thread in self.workers:
+            thread.join()
         self.dispatch_stopped = True
 
     def main(self, parent_ids, context_id, debug, profiling, log_level,
-             in_fd=100, out_fd=1, core_src_fd=101, setup_stdio=True):
+             in_fd=100, out_fd=1, core_src_fd=101, setup_stdio=True,
+             cache_dir=None, max_workers=1, compress=False,
+             setup_package=True):
         self._setup_master(profiling, parent_ids[0], context_id, in_fd, out_fd)
+        self.stream.compress = compress
         try:
             try:
                 self._setup_logging(debug, log_level)
-                self._setup_importer(core_src_fd)
-                self._setup_package(context_id, parent_ids)
+                self._setup_importer(core_src_fd, cache_dir)
+                if setup_package:
+                    self._setup_package(context_id, parent_ids)
                 if setup_stdio:
                     self._setup_stdio()
 
@@ -1179,7 +2450,9 @@ class ExternalContext(object):
                           self.parent, context_id, os.getpid())
                 LOG.debug('Recovered sys.executable: %r', sys.executable)
 
+                self._start_workers(max_workers)
                 _profile_hook('main', self._dispatch_calls)
+                self._join_workers()
                 LOG.debug('ExternalContext.main() normal exit')
             except BaseException:
                 LOG.exception('ExternalContext.main() crashed')
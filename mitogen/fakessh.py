@@ -8,7 +8,6 @@ import socket
 import subprocess
 import sys
 import tempfile
-import threading
 
 import mitogen.core
 import mitogen.master
@@ -90,7 +89,7 @@ class Process(object):
         self.pump = IoPump(router.broker, stdin_fd, stdout_fd)
         self.stdin = None
         self.control = None
-        self.wake_event = threading.Event()
+        self.exit_latch = mitogen.core.Latch()
 
         mitogen.core.listen(self.pump, 'disconnect', self._on_pump_disconnect)
         mitogen.core.listen(self.pump, 'receive', self._on_pump_receive)
@@ -151,7 +150,7 @@ class Process(object):
         LOG.debug('%r._on_pump_disconnect()', self)
         mitogen.core.fire(self, 'disconnect')
         self.stdin.close()
-        self.wake_event.set()
+        self.exit_latch.put(None)
 
     def start_master(self, stdin, control):
         self.stdin = stdin
@@ -160,12 +159,9 @@ class Process(object):
         self.router.broker.start_receive(self.pump)
 
     def wait(self):
-        while not self.wake_event.isSet():
-            # Timeout is used so that sleep is interruptible, as blocking
-            # variants of libc thread operations cannot be interrupted e.g. via
-            # KeyboardInterrupt. isSet() test and wait() are separate since in
-            # <2.7 wait() always returns None.
-            self.wake_event.wait(0.1)
+        # Latch sleeps in select(), so unlike threading.Event.wait() without
+        # a timeout, it remains interruptible e.g. via KeyboardInterrupt.
+        self.exit_latch.get()
 
 
 @mitogen.core.takes_router
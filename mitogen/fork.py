@@ -0,0 +1,112 @@
+"""
+Functionality to create new contexts by forking an existing one, rather than
+starting and bootstrapping a new interpreter.
+"""
+
+import logging
+import os
+import socket
+import sys
+
+import mitogen.core
+import mitogen.master
+
+
+LOG = logging.getLogger(__name__)
+
+
+def reset_logging_framework():
+    """Replace locks the :py:mod:`logging` package may have been holding on
+    another thread during the fork."""
+    logging._lock = logging.threading.RLock()
+    for name in [None] + logging.Logger.manager.loggerDict.keys():
+        for handler in logging.getLogger(name).handlers:
+            handler.createLock()
+
+
+def reopen_stdio():
+    """Point any standard descriptor closed along with the parent's
+    :py:class:`mitogen.core.IoLogger` at ``/dev/null``, so descriptors created
+    later are not allocated in its place."""
+    null = os.open('/dev/null', os.O_RDWR)
+    for fd in 0, 1, 2:
+        try:
+            os.fstat(fd)
+        except OSError:
+            os.dup2(null, fd)
+    if null > 2:
+        os.close(null)
+
+
+def on_fork():
+    """Discard state inherited from the parent that belongs to its threads
+    and streams, none of which exist in the child."""
+    reset_logging_framework()
+    mitogen.core.Latch._on_fork()
+    mitogen.core.Side._on_fork()
+    reopen_stdio()
+    sys.meta_path[:] = [
+        importer for importer in sys.meta_path
+        if not isinstance(importer, mitogen.core.Importer)
+    ]
+
+
+class Stream(mitogen.master.Stream):
+    """
+    Create a new context by forking the current process. The child already
+    has every module its parent imported, so it starts almost immediately.
+    """
+    def _start_child(self):
+        parentfp, childfp = socket.socketpair()
+        pid = os.fork()
+        if not pid:
+            parentfp.close()
+            self._child_main(childfp)
+
+        childfp.close()
+        LOG.debug('%r._start_child() child %d fd %d', self, pid,
+                  parentfp.fileno())
+        self.name = 'fork.%s' % (pid,)
+        fd = os.dup(parentfp.fileno())
+        parentfp.close()
+        self.receive_side = mitogen.core.Side(self, fd)
+        self.transmit_side = mitogen.core.Side(self, os.dup(fd))
+
+    def _start_bootstrap(self):
+        # The child is running as soon as it exists.
+        self._router.broker.start_receive(self)
+        self._finish_connect()
+
+    def _child_main(self, childfp):
+        status = 1
+        try:
+            fd = os.dup(childfp.fileno())
+            childfp.close()
+            on_fork()
+
+            parent_ids = mitogen.parent_ids[:]
+            parent_ids.insert(0, mitogen.context_id)
+            mitogen.is_master = False
+            mitogen.context_id = self.remote_id
+            mitogen.parent_ids = parent_ids
+            mitogen.parent_id = parent_ids[0]
+
+            mitogen.core.ExternalContext().main(
+                parent_ids=parent_ids,
+                context_id=self.remote_id,
+                debug=self.debug,
+                profiling=self.profiling,
+                log_level=(mitogen.core.LOG.level or
+                           logging.getLogger().level or logging.INFO),
+                in_fd=fd,
+                out_fd=fd,
+                core_src_fd=None,
+                max_workers=self.max_workers,
+                compress=self.compress,
+                setup_package=False,
+            )
+            status = 0
+        finally:
+            # Never return into the parent's stack, which may belong to a
+            # ConnectPool thread rather than the main thread.
+            os._exit(status)
@@ -1,10 +1,13 @@
+import cPickle
 import dis
 import errno
 import getpass
+import hashlib
 import imp
 import inspect
 import itertools
 import logging
+import marshal
 import os
 import pkgutil
 import pty
@@ -20,11 +23,6 @@ import time
 import types
 import zlib
 
-try:
-    import Queue
-except ImportError:
-    import queue as Queue
-
 if not hasattr(pkgutil, 'find_loader'):
     # find_loader() was new in >=2.5, but the modern pkgutil.py syntax has
     # been kept intentionally 2.3 compatible so we can reuse it.
@@ -49,11 +47,118 @@ def minimize_source(source):
     return source.replace('    ', '\t')
 
 
+_core_preamble = None
+_core_preamble_lock = threading.Lock()
+
+
+def get_core_preamble():
+    """
+    Return `(source, compressed, compressor)` for the body of the bootstrap
+    preamble: the minimized source of :py:mod:`mitogen.core`, its compressed
+    form ending on a flush point, and the :py:func:`zlib.compressobj` that
+    produced it. These are built once per process, since minimizing and
+    compressing the module is far more expensive than anything else involved
+    in starting a child.
+
+    Each child's preamble is completed by compressing its own arguments using
+    a copy of the compressor, so that appending them to the cached body
+    yields a single valid :py:mod:`zlib` stream.
+    """
+    global _core_preamble
+    _core_preamble_lock.acquire()
+    try:
+        if _core_preamble is None:
+            source = minimize_source(inspect.getsource(mitogen.core))
+            compressor = zlib.compressobj()
+            compressed = (compressor.compress(source) +
+                          compressor.flush(zlib.Z_SYNC_FLUSH))
+            _core_preamble = source, compressed, compressor
+        return _core_preamble
+    finally:
+        _core_preamble_lock.release()
+
+
 def get_child_modules(path, fullname):
     it = pkgutil.iter_modules([os.path.dirname(path)])
     return ['%s.%s' % (fullname, name) for _, name, _ in it]
 
 
+def get_preload_names(fullname, related, sent):
+    """
+    Return the names from `related`, the dependencies of `fullname`, that
+    should be pushed using :py:data:`LOAD_MODULE <mitogen.core.LOAD_MODULE>`
+    to a context already sent the modules named in the set `sent`, ahead of
+    replying with `fullname` itself.
+
+    Only modules within the same top-level package as `fullname` qualify, and
+    only if the context loaded that package from us, since only then are they
+    known to be missing from it.
+    """
+    toplevel = fullname.partition('.')[0]
+    if toplevel != fullname and toplevel not in sent:
+        return []
+
+    return sorted(
+        name
+        for name in related
+        if name.partition('.')[0] == toplevel
+        and name != fullname
+        and name not in sent
+    )
+
+
+def _parse_request(data):
+    """Split the data of a :py:data:`GET_MODULE <mitogen.core.GET_MODULE>`
+    request into `(fullname, sha)` pairs, where `sha` is the SHA-1 of the
+    requester's cached copy of the module, or the empty string."""
+    return [
+        (fullname, sha)
+        for fullname, _, sha in (
+            name.partition('\x01')
+            for name in data.split('\x00')
+        )
+    ]
+
+
+def _split_magic(data):
+    """Split the data of a :py:data:`GET_MODULE <mitogen.core.GET_MODULE>`
+    request from the hex-encoded :py:func:`imp.get_magic` of the requester
+    that may follow it, returning `(data, magic)`. `magic` is the empty
+    string when the requester did not send one."""
+    data, _, magic = data.partition('\x02')
+    return data, magic.decode('hex')
+
+
+def _strip_code(tup, magic):
+    """Return a module tuple with its marshalled code object replaced by
+    ``None``, unless it was compiled by an interpreter with magic number
+    `magic`, and so can be loaded by the requester."""
+    if tup and tup[4:] and tup[4] and tup[4][0] != magic:
+        return tup[:4] + (None,)
+    return tup
+
+
+def _omit_source(tup):
+    """Return a module tuple with its compressed source replaced by ``None``,
+    for a requester that already has an identical cached copy."""
+    return tup[:2] + (None,) + tup[3:]
+
+
+def _get_sent_modules(router, sent_by_id, context_id):
+    """Return the set in `sent_by_id` of module names sent to `context_id`,
+    creating it if necessary. A new set is discarded when the stream
+    `context_id` is reached through disconnects, since the context can no
+    longer request modules. Must be called on the broker thread."""
+    sent = sent_by_id.get(context_id)
+    if sent is None:
+        sent = sent_by_id[context_id] = set()
+        stream = router._stream_by_id.get(context_id)
+        if stream is not None:
+            mitogen.core.listen(stream, 'disconnect',
+                                lambda: sent_by_id.pop(context_id, None))
+    return sent
+
+
 class Argv(object):
     def __init__(self, argv):
         self.argv = argv
@@ -79,8 +184,12 @@ def create_child(*args):
         os.dup2(childfp.fileno(), 1)
         childfp.close()
         parentfp.close()
-        os.execvp(args[0], args)
-        raise SystemExit
+        try:
+            os.execvp(args[0], args)
+        finally:
+            # Never return into the parent's stack, which may belong to a
+            # ConnectPool thread rather than the main thread.
+            os._exit(1)
 
     childfp.close()
     LOG.debug('create_child() child %d fd %d, parent %d, cmd: %s',
@@ -142,8 +251,12 @@ def tty_create_child(*args):
         close_nonstandard_fds()
         os.setsid()
         os.close(os.open(os.ttyname(1), os.O_RDWR))
-        os.execvp(args[0], args)
-        raise SystemExit
+        try:
+            os.execvp(args[0], args)
+        finally:
+            # Never return into the parent's stack, which may belong to a
+            # ConnectPool thread rather than the main thread.
+            os._exit(1)
 
     os.close(slave_fd)
     LOG.debug('tty_create_child() child %d fd %d, parent %d, cmd: %s',
@@ -256,12 +369,12 @@ class Select(object):
     def __init__(self, receivers=(), oneshot=True):
         self._receivers = []
         self._oneshot = oneshot
-        self._queue = Queue.Queue()
+        self._latch = mitogen.core.Latch()
         for recv in receivers:
             self.add(recv)
 
     def _put(self, value):
-        self._queue.put(value)
+        self._latch.put(value)
         if self.notify:
             self.notify(self)
 
@@ -322,7 +435,7 @@ class Select(object):
             self.remove(recv)
 
     def empty(self):
-        return self._queue.empty()
+        return self._latch.empty()
 
     empty_msg = 'Cannot get(), Select instance is empty'
 
@@ -331,7 +444,7 @@ class Select(object):
             raise SelectError(self.empty_msg)
 
         while True:
-            recv = mitogen.core._queue_interruptible_get(self._queue, timeout)
+            recv = self._latch.get(timeout)
             try:
                 msg = recv.get(block=False)
                 if self._oneshot:
@@ -343,6 +456,12 @@ class Select(object):
                 # thread drained it between add() calling recv.empty() and
                 # self._put(). In this case just sleep again.
                 continue
+            except Exception:
+                # The result was an exception, e.g. CallError. It was still
+                # the receiver's result, so a oneshot Select is done with it.
+                if self._oneshot:
+                    self.remove(recv)
+                raise
 
 
 class LogForwarder(object):
@@ -478,10 +597,17 @@ class ModuleFinder(object):
         for method in self.get_module_methods:
             tup = method(self, fullname)
             if tup:
+                self._found_cache[fullname] = tup
                 return tup
 
         return None, None, None
 
+    def invalidate(self, fullname):
+        """Forget any results cached for `fullname`, for example because its
+        source changed on disk."""
+        self._found_cache.pop(fullname, None)
+        self._related_cache.pop(fullname, None)
+
     def resolve_relpath(self, fullname, level):
         """Given an ImportFrom AST node, guess the prefix that should be tacked
         on to an alias name to produce a canonical name. `fullname` is the name
@@ -557,14 +683,34 @@ class ModuleFinder(object):
 
 
 class ModuleResponder(object):
+    #: If ``True``, module replies include a code object compiled and
+    #: marshalled by the master, which requesters running the same
+    #: interpreter version load instead of compiling the source themselves.
+    send_bytecode = True
+
     def __init__(self, router):
         self._router = router
         self._finder = ModuleFinder()
+        #: context_id -> set of module names sent to that context.
+        self._sent_modules_by_id = {}
+        #: fullname -> (mtime, tuple, pickled reply, pickled LOAD_MODULE,
+        #: SHA-1 of compressed source). The pickles include any bytecode.
+        self._cache = {}
+        #: Number of requests satisfied from :py:attr:`_cache`.
+        self.cache_hits = 0
+        #: Number of requests that built a new reply.
+        self.cache_misses = 0
         router.add_handler(self._on_get_module, mitogen.core.GET_MODULE)
 
     def __repr__(self):
         return 'ModuleResponder(%r)' % (self._router,)
 
+    def _get_mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except (OSError, TypeError):
+            return None
+
     MAIN_RE = re.compile(r'^if\s+__name__\s*==\s*.__main__.\s*:', re.M)
 
     def neutralize_main(self, src):
@@ -576,31 +722,146 @@ class ModuleResponder(object):
             return src[:match.start()]
         return src
 
+    def _build_tuple(self, fullname):
+        path, source, is_pkg = self._finder.get_module_source(fullname)
+        if source is None:
+            raise ImportError('could not find %r' % (fullname,))
+
+        if is_pkg:
+            pkg_present = get_child_modules(path, fullname)
+            LOG.debug('get_child_modules(%r, %r) -> %r',
+                      path, fullname, pkg_present)
+        else:
+            pkg_present = None
+
+        if fullname == '__main__':
+            source = self.neutralize_main(source)
+        compressed = zlib.compress(source)
+        related = list(self._finder.find_related(fullname))
+        return pkg_present, path, compressed, related, self._compile(path,
+                                                                     source)
+
+    def _compile(self, path, source):
+        """Return `(magic, compressed marshalled code)` for `source`,
+        compiled with the filename the requester would use, or ``None`` if
+        bytecode is disabled or the source cannot be compiled, in which case
+        the requester compiles it and reports any error itself."""
+        if not self.send_bytecode:
+            return None
+        try:
+            code = compile(source, 'master:' + path, 'exec', 0, True)
+        except Exception:
+            LOG.debug('%r: cannot compile %r', self, path, exc_info=True)
+            return None
+        return imp.get_magic(), zlib.compress(marshal.dumps(code))
+
+    def _get_entry(self, fullname):
+        """Return the cache entry for `fullname`, rebuilding it if the module
+        was never requested or its file was modified since."""
+        entry = self._cache.get(fullname)
+        if entry is not None:
+            if entry[0] == self._get_mtime(entry[1][1]):
+                self.cache_hits += 1
+                return entry
+            self._finder.invalidate(fullname)
+
+        self.cache_misses += 1
+        # Stat before reading, so a concurrent modification causes a rebuild
+        # on the next request rather than caching stale source.
+        mtime = self._get_mtime(self._finder.get_module_source(fullname)[0])
+        tup = self._build_tuple(fullname)
+        entry = self._cache[fullname] = (
+            mtime,
+            tup,
+            cPickle.dumps(tup, protocol=2),
+            cPickle.dumps((fullname,) + tup, protocol=2),
+            hashlib.sha1(tup[2]).hexdigest(),
+        )
+        return entry
+
+    def _get_tuple(self, entry, sha, magic):
+        """Return the tuple of `entry` as it should be sent to a requester
+        with a cached copy matching `sha` and interpreter magic `magic`."""
+        tup = _strip_code(entry[1], magic)
+        if sha == entry[4]:
+            tup = _omit_source(tup)
+        return tup
+
+    def _send_related(self, dst_id, fullname, related, magic):
+        sent = _get_sent_modules(self._router, self._sent_modules_by_id,
+                                 dst_id)
+        for name in get_preload_names(fullname, related, sent):
+            try:
+                entry = self._get_entry(name)
+            except Exception:
+                LOG.debug('While preloading %r', name, exc_info=True)
+                continue
+
+            LOG.debug('%r: preloading %r into %r', self, name, dst_id)
+            data = entry[3]
+            tup = _strip_code(entry[1], magic)
+            if tup is not entry[1]:
+                data = cPickle.dumps((name,) + tup, protocol=2)
+            self._router.route(
+                mitogen.core.Message(
+                    data=data,
+                    dst_id=dst_id,
+                    handle=mitogen.core.LOAD_MODULE,
+                )
+            )
+            sent.add(name)
+        sent.add(fullname)
+
+    def _on_get_modules(self, msg):
+        """Reply to a batch request for several '\\x00'-separated module
+        names with a list of tuples, using ``None`` for any that could not be
+        found."""
+        data, magic = _split_magic(msg.data)
+        requests = _parse_request(data)
+        sent = _get_sent_modules(self._router, self._sent_modules_by_id,
+                                 msg.src_id)
+        # The batch itself delivers these, so they must not be pushed too.
+        sent.update(fullname for fullname, _ in requests)
+
+        tups = []
+        for fullname, sha in requests:
+            try:
+                entry = self._get_entry(fullname)
+            except Exception:
+                LOG.debug('While importing %r', fullname, exc_info=True)
+                tups.append(None)
+                continue
+            self._send_related(msg.src_id, fullname, entry[1][3], magic)
+            tups.append(self._get_tuple(entry, sha, magic))
+
+        self._router.route(
+            mitogen.core.Message.pickled(
+                tups,
+                dst_id=msg.src_id,
+                handle=msg.reply_to,
+            )
+        )
+
     def _on_get_module(self, msg):
         LOG.debug('%r.get_module(%r)', self, msg)
         if msg == mitogen.core._DEAD:
             return
 
-        fullname = msg.data
-        try:
-            path, source, is_pkg = self._finder.get_module_source(fullname)
-            if source is None:
-                raise ImportError('could not find %r' % (fullname,))
-
-            if is_pkg:
-                pkg_present = get_child_modules(path, fullname)
-                LOG.debug('get_child_modules(%r, %r) -> %r',
-                          path, fullname, pkg_present)
-            else:
-                pkg_present = None
+        if '\x00' in msg.data:
+            return self._on_get_modules(msg)
 
-            if fullname == '__main__':
-                source = self.neutralize_main(source)
-            compressed = zlib.compress(source)
-            related = list(self._finder.find_related(fullname))
+        data, magic = _split_magic(msg.data)
+        [(fullname, sha)] = _parse_request(data)
+        try:
+            entry = self._get_entry(fullname)
+            self._send_related(msg.src_id, fullname, entry[1][3], magic)
+            data = entry[2]
+            tup = self._get_tuple(entry, sha, magic)
+            if tup is not entry[1]:
+                data = cPickle.dumps(tup, protocol=2)
             self._router.route(
-                mitogen.core.Message.pickled(
-                    (pkg_present, path, compressed, related),
+                mitogen.core.Message(
+                    data=data,
                     dst_id=msg.src_id,
                     handle=msg.reply_to,
                 )
@@ -625,6 +886,8 @@ class ModuleForwarder(object):
         self.router = router
         self.parent_context = parent_context
         self.importer = importer
+        #: context_id -> set of module names sent to that context.
+        self._sent_modules_by_id = {}
         router.add_handler(self._on_get_module, mitogen.core.GET_MODULE)
 
     def __repr__(self):
@@ -635,22 +898,29 @@ class ModuleForwarder(object):
         if msg == mitogen.core._DEAD:
             return
 
-        fullname = msg.data
+        if '\x00' in msg.data:
+            return self._on_get_modules(msg)
+
+        data, magic = _split_magic(msg.data)
+        [(fullname, sha)] = _parse_request(data)
         cached = self.importer._cache.get(fullname)
         if cached:
             LOG.debug('%r._on_get_module(): using cached %r', self, fullname)
+            self._send_related(msg.src_id, fullname, cached, magic)
             self.router.route(
                 mitogen.core.Message.pickled(
-                    cached,
+                    self._get_tuple(cached, sha, magic),
                     dst_id=msg.src_id,
                     handle=msg.reply_to,
                 )
             )
         else:
+            # Our own cache needs the source, so the requester's hash is not
+            # passed on, and it keeps bytecode our own interpreter can use.
             LOG.debug('%r._on_get_module(): requesting %r', self, fullname)
             self.parent_context.send(
                 mitogen.core.Message(
-                    data=msg.data,
+                    data=self.importer._add_magic(fullname),
                     handle=mitogen.core.GET_MODULE,
                     reply_to=self.router.add_handler(
                         lambda m: self._on_got_source(m, msg),
@@ -659,13 +929,106 @@ class ModuleForwarder(object):
                 )
             )
 
+    def _get_tuple(self, tup, sha, magic):
+        """Return `tup` as it should be sent to a requester with a cached copy
+        matching `sha` and interpreter magic `magic`."""
+        tup = _strip_code(tup, magic)
+        if tup and sha and hashlib.sha1(tup[2]).hexdigest() == sha:
+            return _omit_source(tup)
+        return tup
+
+    def _on_get_modules(self, msg):
+        """Satisfy a batch request entirely from the local cache, otherwise
+        forward it intact to our parent, which answers every name in one
+        reply."""
+        data, _ = _split_magic(msg.data)
+        names = [fullname for fullname, _ in _parse_request(data)]
+        cached = [self.importer._cache.get(name) for name in names]
+        if None in cached:
+            LOG.debug('%r._on_get_modules(): requesting %r', self, names)
+            self.parent_context.send(
+                mitogen.core.Message(
+                    data=self.importer._add_magic('\x00'.join(names)),
+                    handle=mitogen.core.GET_MODULE,
+                    reply_to=self.router.add_handler(
+                        lambda m: self._on_got_sources(m, msg),
+                        persist=False
+                    )
+                )
+            )
+            return
+
+        LOG.debug('%r._on_get_modules(): using cached %r', self, names)
+        self._reply_batch(msg, cached)
+
+    def _on_got_sources(self, msg, original_msg):
+        LOG.debug('%r._on_got_sources(%r, %r)', self, msg, original_msg)
+        tups = msg.unpickle()
+        data, _ = _split_magic(original_msg.data)
+        for (name, _), tup in zip(_parse_request(data), tups):
+            self._cache_tuple(name, tup)
+        self._reply_batch(original_msg, tups)
+
+    def _cache_tuple(self, fullname, tup):
+        self.importer._cache[fullname] = tup
+        if tup and self.importer._cache_dir:
+            self.importer._write_cached(fullname, tup[2])
+
+    def _reply_batch(self, msg, tups):
+        data, magic = _split_magic(msg.data)
+        requests = _parse_request(data)
+        sent = _get_sent_modules(self.router, self._sent_modules_by_id,
+                                 msg.src_id)
+        sent.update(name for name, _ in requests)
+        for (name, _), tup in zip(requests, tups):
+            if tup:
+                self._send_related(msg.src_id, name, tup, magic)
+        self.router.route(
+            mitogen.core.Message.pickled(
+                [self._get_tuple(tup, sha, magic)
+                 for (_, sha), tup in zip(requests, tups)],
+                dst_id=msg.src_id,
+                handle=msg.reply_to,
+            )
+        )
+
+    def _send_related(self, dst_id, fullname, tup, magic):
+        """Push any cached modules related to `fullname` that the requesting
+        child is known to lack."""
+        related = tup[3:] and tup[3] or ()
+        sent = _get_sent_modules(self.router, self._sent_modules_by_id,
+                                 dst_id)
+        for name in get_preload_names(fullname, related, sent):
+            cached = self.importer._cache.get(name)
+            if cached:
+                LOG.debug('%r: preloading %r into %r', self, name, dst_id)
+                self.router.route(
+                    mitogen.core.Message.pickled(
+                        (name,) + _strip_code(cached, magic),
+                        dst_id=dst_id,
+                        handle=mitogen.core.LOAD_MODULE,
+                    )
+                )
+                sent.add(name)
+        sent.add(fullname)
+
     def _on_got_source(self, msg, original_msg):
         LOG.debug('%r._on_got_source(%r, %r)', self, msg, original_msg)
-        fullname = original_msg.data
-        self.importer._cache[fullname] = msg.unpickle()
+        data, magic = _split_magic(original_msg.data)
+        [(fullname, sha)] = _parse_request(data)
+        tup = msg.unpickle()
+        self._cache_tuple(fullname, tup)
+        if tup:
+            # Any modules our parent pushed alongside tup are already cached.
+            self._send_related(original_msg.src_id, fullname, tup, magic)
+            if self._get_tuple(tup, sha, magic) is not tup:
+                msg = mitogen.core.Message.pickled(
+                    self._get_tuple(tup, sha, magic)
+                )
         self.router.route(
             mitogen.core.Message(
                 data=msg.data,
+                flags=msg.flags,
                 dst_id=original_msg.src_id,
                 handle=original_msg.reply_to,
             )
@@ -685,13 +1048,34 @@ class Stream(mitogen.core.Stream):
     #: True to cause context to write /tmp/mitogen.stats.<pid>.<thread>.log.
     profiling = False
 
+    #: If not ``None``, directory on the target machine in which the child
+    #: caches the bootstrap source and imported modules, keyed by their hash.
+    cache_dir = None
+
+    #: Number of threads in the child executing function calls concurrently.
+    max_workers = 1
+
+    #: True to compress large messages in both directions, for slow links.
+    compress = False
+
+    #: True to exchange messages through shared memory once the child is
+    #: running, if it is on the same machine. See :py:mod:`mitogen.shm`.
+    shm = False
+
+    #: True if the child reported a valid cached copy of :py:mod:`mitogen.core`.
+    _core_cached = False
+
     def construct(self, remote_name=None, python_path=None, debug=False,
-                  profiling=False, **kwargs):
+                  profiling=False, connect_timeout=None, cache_dir=None,
+                  max_workers=None, compress=False, shm=False,
+                  keepalive_interval=None, keepalive_count=None, **kwargs):
         """Get the named context running on the local machine, creating it if
         it does not exist."""
         super(Stream, self).construct(**kwargs)
         if python_path:
             self.python_path = python_path
+        if connect_timeout:
+            self.connect_timeout = connect_timeout
 
         if remote_name is None:
             remote_name = '%s@%s:%d'
@@ -699,9 +1083,22 @@ class Stream(mitogen.core.Stream):
         self.remote_name = remote_name
         self.debug = debug
         self.profiling = profiling
+        self.cache_dir = cache_dir
+        if max_workers:
+            self.max_workers = max_workers
+        self.compress = compress
+        self.shm = shm
+        if keepalive_interval:
+            self.keepalive_interval = keepalive_interval
+        if keepalive_count:
+            self.keepalive_count = keepalive_count
 
     def on_shutdown(self, broker):
         """Request the slave gracefully shut itself down."""
+        if self._connect_callback is not None:
+            # The child cannot receive messages yet.
+            return self.on_disconnect(broker)
+
         LOG.debug('%r closing CALL_FUNCTION channel', self)
         self.send(
             mitogen.core.Message(
@@ -713,7 +1110,10 @@ class Stream(mitogen.core.Stream):
 
     # base64'd and passed to 'python -c'. It forks, dups 0->100, creates a
     # pipe, then execs a new interpreter with a custom argv. 'CONTEXT_NAME' is
-    # replaced with the context name. Optimized for size.
+    # replaced with the context name, and CACHE_PATH with the quoted path to a
+    # cached copy of mitogen.core named for its SHA-1, or the empty string.
+    # When the cached copy is valid, "EC0H" is written instead of "EC0" and
+    # only the final line of the preamble is sent. Optimized for size.
     @staticmethod
     def _first_stage():
         import os,sys,zlib
@@ -726,8 +1126,22 @@ class Stream(mitogen.core.Stream):
             for f in R,r,W,w:os.close(f)
             os.environ['ARGV0']=e=sys.executable
             os.execv(e,['mitogen:CONTEXT_NAME'])
-        os.write(1,'EC0\n')
+        P=os.path.expanduser(CACHE_PATH)
+        K=''
+        if P:
+            import hashlib
+            try:K=open(P,'rb').read()
+            except IOError:pass
+            if hashlib.sha1(K).hexdigest()!=P[-40:]:K=''
+        os.write(1,K and'EC0H\n'or'EC0\n')
         C=zlib.decompress(sys.stdin.read(input()))
+        if K:C=K+C
+        elif P:
+            try:
+                D=os.path.dirname(P);T='%s.%d'%(P,os.getpid())
+                os.path.isdir(D)or os.makedirs(D,448)
+                open(T,'wb').write(C.rsplit('\n',2)[0]);os.rename(T,P)
+            except(IOError,OSError):pass
         os.fdopen(W,'w',0).write(C)
         os.fdopen(w,'w',0).write('%s\n'%len(C)+C)
         os.write(1,'EC1\n')
@@ -738,6 +1152,11 @@ class Stream(mitogen.core.Stream):
         source = textwrap.dedent('\n'.join(source.strip().split('\n')[2:]))
         source = source.replace('    ', '\t')
         source = source.replace('CONTEXT_NAME', self.remote_name)
+        cache_path = ''
+        if self.cache_dir:
+            digest = hashlib.sha1(self._get_core_source()).hexdigest()
+            cache_path = os.path.join(self.cache_dir, 'core-' + digest)
+        source = source.replace('CACHE_PATH', repr(cache_path))
         encoded = source.encode('zlib').encode('base64').replace('\n', '')
         # We can't use bytes.decode() in 3.x since it was restricted to always
         # return unicode, so codecs.decode() is used instead. In 3.x
@@ -750,42 +1169,176 @@ class Stream(mitogen.core.Stream):
             'exec(_(_("%s".encode(),"base64"),"zlib"))' % (encoded,)
         ]
 
+    def _get_core_source(self):
+        return get_core_preamble()[0]
+
     def get_preamble(self):
         parent_ids = mitogen.parent_ids[:]
         parent_ids.insert(0, mitogen.context_id)
-        source = inspect.getsource(mitogen.core)
-        source += '\nExternalContext().main%r\n' % ((
+        source = '\nExternalContext().main%r\n' % ((
             parent_ids,                # parent_ids
             self.remote_id,            # context_id
             self.debug,
             self.profiling,
             LOG.level or logging.getLogger().level or logging.INFO,
+            100,                       # in_fd
+            1,                         # out_fd
+            101,                       # core_src_fd
+            True,                      # setup_stdio
+            self.cache_dir,            # cache_dir
+            self.max_workers,          # max_workers
+            self.compress,             # compress
         ),)
-
-        compressed = zlib.compress(minimize_source(source))
+        if self._core_cached:
+            compressed = zlib.compress(source)
+        else:
+            _, compressed, compressor = get_core_preamble()
+            compressor = compressor.copy()
+            compressed += compressor.compress(source) + compressor.flush()
         return str(len(compressed)) + '\n' + compressed
 
     create_child = staticmethod(create_child)
 
+    #: Seconds to allow for the child to complete bootstrap.
+    connect_timeout = 10.0
+
+    #: While bootstrapping, function invoked as `callback(exc)` on completion.
+    _connect_callback = None
+
+    #: While bootstrapping, :py:class:`mitogen.core.Timer` failing the
+    #: connection after :py:attr:`connect_timeout`.
+    _connect_timer = None
+
     def connect(self):
-        LOG.debug('%r.connect()', self)
+        """Start the child and block until it has been bootstrapped. Must not
+        be called on the broker thread."""
+        latch = mitogen.core.Latch()
+        self.connect_async(latch.put)
+        exc = latch.get()
+        if exc is not None:
+            raise exc
+
+    def connect_async(self, callback):
+        """
+        Start the child and arrange for it to be bootstrapped by the broker
+        thread, without blocking. `callback(exc)` is invoked on the broker
+        thread once the child is ready to receive messages, where `exc` is
+        ``None`` on success, or the exception that caused failure.
+        """
+        LOG.debug('%r.connect_async()', self)
+        self._start_child()
+        LOG.debug('%r.connect_async(): child process stdin/stdout=%r',
+                  self, self.receive_side.fd)
+        self._connect_callback = callback
+        self._bootstrap_buf = ''
+        self._bootstrap_state = 'ec0'
+        self._router.broker.defer(self._start_bootstrap)
+
+    def _start_child(self):
         pid, fd = self.create_child(*self.get_boot_command())
         self.name = 'local.%s' % (pid,)
         self.receive_side = mitogen.core.Side(self, fd)
         self.transmit_side = mitogen.core.Side(self, os.dup(fd))
-        LOG.debug('%r.connect(): child process stdin/stdout=%r',
-                  self, self.receive_side.fd)
 
-        self._connect_bootstrap()
+    def _start_bootstrap(self):
+        broker = self._router.broker
+        broker.start_receive(self)
+        self._connect_timer = broker.timer(self.connect_timeout,
+                                           self._on_connect_timeout)
+
+    def _on_connect_timeout(self):
+        self._finish_connect(mitogen.core.TimeoutError(
+            'bootstrap timed out; last 300 bytes received: %r',
+            self._bootstrap_buf[-300:]
+        ))
+
+    def _finish_connect(self, exc=None):
+        callback = self._connect_callback
+        if callback is None:
+            return
+
+        LOG.debug('%r._finish_connect(%r)', self, exc)
+        self._connect_callback = None
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        self._preamble = None
+        if exc is not None:
+            self.on_disconnect(self._router.broker)
+        callback(exc)
+
+    def _on_bootstrap_output(self, buf):
+        """Inspect a chunk of child output received prior to ``EC0``, for
+        example to answer a password prompt. Exceptions fail the connection."""
+
+    def _bootstrap_receive(self, broker):
+        buf = self.receive_side.read()
+        if not buf:
+            raise mitogen.core.StreamError(
+                'EOF on stream; last 300 bytes received: %r',
+                self._bootstrap_buf[-300:]
+            )
 
-    def _ec0_received(self):
+        IOLOG.debug('%r._bootstrap_receive() -> %r', self, buf)
+        self._bootstrap_buf += buf
+        self._bootstrap_buf = self._bootstrap_buf[-mitogen.core.CHUNK_SIZE:]
+        if self._bootstrap_state == 'ec0':
+            if self._bootstrap_buf.endswith('EC0H\n'):
+                self._core_cached = True
+                self._ec0_received(broker)
+            elif self._bootstrap_buf.endswith('EC0\n'):
+                self._ec0_received(broker)
+            else:
+                self._on_bootstrap_output(buf)
+        elif self._bootstrap_buf.endswith('EC1\n'):
+            if self._bootstrap_state != 'ec1':
+                raise mitogen.core.StreamError('EC1 received before preamble '
+                                               'was fully written')
+            self._finish_connect()
+
+    def _ec0_received(self, broker):
         LOG.debug('%r._ec0_received()', self)
-        write_all(self.transmit_side.fd, self.get_preamble())
-        discard_until(self.receive_side.fd, 'EC1\n', time.time() + 10.0)
+        self._bootstrap_state = 'preamble'
+        self._bootstrap_buf = ''
+        self._preamble = self.get_preamble()
+        self._preamble_offset = 0
+        broker.start_transmit(self)
+
+    def _bootstrap_transmit(self, broker):
+        n = self.transmit_side.write(buffer(self._preamble,
+                                            self._preamble_offset))
+        if not n:
+            raise mitogen.core.StreamError('EOF on stream during write')
+
+        self._preamble_offset += n
+        if self._preamble_offset == len(self._preamble):
+            broker.stop_transmit(self)
+            self._preamble = None
+            self._bootstrap_state = 'ec1'
+
+    def on_receive(self, broker):
+        if self._connect_callback is None:
+            return super(Stream, self).on_receive(broker)
+
+        try:
+            self._bootstrap_receive(broker)
+        except Exception, e:
+            self._finish_connect(e)
+
+    def on_transmit(self, broker):
+        if self._connect_callback is None:
+            return super(Stream, self).on_transmit(broker)
 
-    def _connect_bootstrap(self):
-        discard_until(self.receive_side.fd, 'EC0\n', time.time() + 10.0)
-        self._ec0_received()
+        try:
+            self._bootstrap_transmit(broker)
+        except Exception, e:
+            self._finish_connect(e)
+
+    def on_disconnect(self, broker):
+        super(Stream, self).on_disconnect(broker)
+        self._finish_connect(mitogen.core.StreamError(
+            'stream disconnected during bootstrap'
+        ))
 
 
 class Broker(mitogen.core.Broker):
@@ -795,6 +1348,13 @@ class Broker(mitogen.core.Broker):
 class Context(mitogen.core.Context):
     via = None
 
+    #: Number of lists of items a remote iterable may send before
+    #: :py:meth:`call_iter` must acknowledge one.
+    iter_window = 4
+
+    #: Maximum number of items sent per message by a remote iterable.
+    iter_chunk_size = 100
+
     def on_disconnect(self, broker):
         """
         Override base behaviour of triggering Broker shutdown on parent stream
@@ -802,19 +1362,21 @@ class Context(mitogen.core.Context):
         """
         mitogen.core.fire(self, 'disconnect')
 
-    def call_async(self, fn, *args, **kwargs):
-        LOG.debug('%r.call_async(%r, *%r, **%r)',
-                  self, fn, args, kwargs)
-
+    def _get_call_tuple(self, fn, args, kwargs):
         if isinstance(fn, types.MethodType) and \
            isinstance(fn.im_self, (type, types.ClassType)):
             klass = fn.im_self.__name__
         else:
             klass = None
+        return (fn.__module__, klass, fn.__name__, args, kwargs)
+
+    def call_async(self, fn, *args, **kwargs):
+        LOG.debug('%r.call_async(%r, *%r, **%r)',
+                  self, fn, args, kwargs)
 
         recv = self.send_async(
             mitogen.core.Message.pickled(
-                (fn.__module__, klass, fn.__name__, args, kwargs),
+                self._get_call_tuple(fn, args, kwargs),
                 handle=mitogen.core.CALL_FUNCTION,
             )
         )
@@ -824,10 +1386,73 @@ class Context(mitogen.core.Context):
     def call(self, fn, *args, **kwargs):
         return self.call_async(fn, *args, **kwargs).get_data()
 
+    def call_many_async(self, calls):
+        LOG.debug('%r.call_many_async(%r)', self, calls)
+        recv = self.send_async(
+            mitogen.core.Message.pickled(
+                [self._get_call_tuple(fn, args, kwargs)
+                 for fn, args, kwargs in calls],
+                handle=mitogen.core.CALL_FUNCTION,
+            )
+        )
+        recv.raise_channelerror = False
+        return recv
+
+    def call_many(self, calls):
+        return self.call_many_async(calls).get_data()
+
+    def call_iter(self, fn, *args, **kwargs):
+        LOG.debug('%r.call_iter(%r, *%r, **%r)', self, fn, args, kwargs)
+        recv = mitogen.core.Receiver(self.router, respondent=self)
+        self.send(
+            mitogen.core.Message.pickled(
+                self._get_call_tuple(fn, args, kwargs) + (
+                    (self.iter_window, self.iter_chunk_size),
+                ),
+                handle=mitogen.core.CALL_FUNCTION,
+                reply_to=recv.handle,
+            )
+        )
+        return self._iter_results(recv)
+
+    def _iter_results(self, recv):
+        ack_handle = None
+        finished = False
+        try:
+            try:
+                ack_handle = recv.get_data()
+                while True:
+                    try:
+                        msg, chunk = recv.get()
+                    except mitogen.core.ChannelError, e:
+                        if e[0] != mitogen.core.ChannelError.remote_msg:
+                            raise
+                        break
+                    for item in chunk:
+                        yield item
+                    self.send(
+                        mitogen.core.Message.pickled(None, handle=ack_handle)
+                    )
+                finished = True
+            except mitogen.core.CallError:
+                finished = True
+                raise
+        finally:
+            self.router.del_handler(recv.handle)
+            if ack_handle is not None and not finished:
+                self.send(
+                    mitogen.core.Message.pickled(mitogen.core._DEAD,
+                                                 handle=ack_handle)
+                )
+
 
 def _local_method():
     return Stream
 
+def _fork_method():
+    import mitogen.fork
+    return mitogen.fork.Stream
+
 def _ssh_method():
     import mitogen.ssh
     return mitogen.ssh.Stream
@@ -839,6 +1464,7 @@ def _sudo_method():
 
 METHOD_NAMES = {
     'local': _local_method,
+    'fork': _fork_method,
     'ssh': _ssh_method,
     'sudo': _sudo_method,
 }
@@ -913,11 +1539,183 @@ class ChildIdAllocator(object):
         )
 
 
+class PendingConnect(object):
+    """
+    Represent a connection being established in the background by
+    :py:meth:`Router.connect_async`. Like :py:class:`mitogen.core.Receiver`,
+    instances may be added to a :py:class:`Select` to wait on many at once.
+    """
+    notify = None
+
+    def __init__(self, method_name, name, kwargs):
+        self.method_name = method_name
+        self.name = name
+        self.kwargs = kwargs
+        self._latch = mitogen.core.Latch()
+        self._result = None
+
+    def __repr__(self):
+        return 'PendingConnect(%r, %r)' % (self.method_name, self.name)
+
+    def _set_result(self, context=None, exc=None):
+        self._latch.put((context, exc))
+        if self.notify:
+            self.notify(self)
+
+    def empty(self):
+        return self._result is None and self._latch.empty()
+
+    def get(self, timeout=None, block=True):
+        """
+        Wait for the connection attempt to complete.
+
+        :returns:
+            The connected :py:class:`Context`.
+        :raises mitogen.core.TimeoutError:
+            The attempt did not complete before `timeout` expired.
+        :raises mitogen.core.Error:
+            The exception raised by the connection method, for example
+            :py:class:`mitogen.ssh.PasswordError`.
+        """
+        if self._result is None:
+            self._result = self._latch.get(timeout=timeout, block=block)
+        context, exc = self._result
+        if exc is not None:
+            raise exc
+        return context
+
+
+class ConnectPool(object):
+    """
+    Limit the number of connections bootstrapping at once to `size`, queueing
+    the remainder in submission order. Connections start in
+    :py:meth:`submit` when the pool has room, otherwise as earlier attempts
+    complete. Since starting a connection may fork a child, or for `via`
+    block on a call to the intermediary, neither of which may happen on the
+    broker thread, attempts completing there hand any queued attempts to a
+    short-lived thread. The pool is closed when the broker shuts down.
+    """
+    closed_msg = 'broker shut down before connection was attempted'
+
+    def __init__(self, router, size):
+        self.router = router
+        self.size = size
+        self._lock = threading.Lock()
+        self._queue = []
+        self._active = 0
+        self._closed = False
+        self._release = False
+        mitogen.core.listen(router.broker, 'shutdown', self.close)
+
+    def __repr__(self):
+        return 'ConnectPool(%r, size=%d)' % (self.router, self.size)
+
+    def submit(self, pending):
+        self._lock.acquire()
+        try:
+            self._queue.append(pending)
+        finally:
+            self._lock.release()
+        self._pump()
+
+    def close(self):
+        """Fail any requests that have not started yet, and any submitted
+        later."""
+        self._lock.acquire()
+        try:
+            self._closed = True
+        finally:
+            self._lock.release()
+        self._pump()
+
+    def release_when_idle(self):
+        """Stop listening for broker shutdown once no request is queued or in
+        progress, so a pool serving a single batch can be freed. Nothing may
+        be submitted afterwards."""
+        self._release = True
+        self._maybe_release()
+
+    def _maybe_release(self):
+        self._lock.acquire()
+        try:
+            if not self._release or self._queue or self._active:
+                return
+            self._release = False
+        finally:
+            self._lock.release()
+        mitogen.core.unlisten(self.router.broker, 'shutdown', self.close)
+
+    def _pump(self):
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._queue:
+                    break
+                if self._closed:
+                    pending = self._queue.pop(0)
+                    exc = mitogen.core.StreamError(self.closed_msg)
+                elif self._active < self.size:
+                    pending = self._queue.pop(0)
+                    self._active += 1
+                    exc = None
+                else:
+                    return
+            finally:
+                self._lock.release()
+
+            if exc is None:
+                exc = self._start(pending)
+            if exc is not None:
+                pending._set_result(exc=exc)
+
+        self._maybe_release()
+
+    def _start(self, pending):
+        def callback(context=None, exc=None):
+            pending._set_result(context, exc)
+            self._on_done()
+
+        try:
+            self.router._start_connect(pending, callback)
+        except Exception, e:
+            LOG.debug('%r: %r failed: %s', self, pending, e)
+            self._lock.acquire()
+            try:
+                self._active -= 1
+            finally:
+                self._lock.release()
+            return e
+
+    def _on_done(self):
+        self._lock.acquire()
+        try:
+            self._active -= 1
+            queued = bool(self._queue)
+        finally:
+            self._lock.release()
+
+        if not queued:
+            return self._maybe_release()
+        if threading.currentThread() is self.router.broker._thread:
+            thread = threading.Thread(target=self._pump,
+                                      name='mitogen-connect-pool')
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            self._pump()
+
+
 class Router(mitogen.core.Router):
     debug = False
 
     profiling = False
 
+    #: Maximum number of connections :py:meth:`connect_async` establishes
+    #: concurrently.
+    connect_concurrency = 16
+
+    _connect_pool = None
+
     def __init__(self, *args, **kwargs):
         super(Router, self).__init__(*args, **kwargs)
         self.id_allocator = IdAllocator(self)
@@ -950,32 +1748,91 @@ class Router(mitogen.core.Router):
     def local(self, **kwargs):
         return self.connect('local', **kwargs)
 
+    def fork(self, **kwargs):
+        return self.connect('fork', **kwargs)
+
     def sudo(self, **kwargs):
         return self.connect('sudo', **kwargs)
 
     def ssh(self, **kwargs):
         return self.connect('ssh', **kwargs)
 
-    def _connect(self, context_id, klass, name=None, **kwargs):
+    def _connect_async(self, context_id, klass, name, kwargs, callback):
         context = Context(self, context_id)
         stream = klass(self, context.context_id, **kwargs)
         if name is not None:
             stream.name = name
-        stream.connect()
-        context.name = stream.name
-        self.register(context, stream)
-        return context
 
-    def connect(self, method_name, name=None, **kwargs):
-        klass = METHOD_NAMES[method_name]()
+        def on_connect(exc):
+            # Runs on the broker thread, so the stream is registered before
+            # any message it receives can be routed.
+            if exc is not None:
+                return callback(exc=exc)
+            context.name = stream.name
+            self.register(context, stream)
+            stream.start_keepalive()
+            if stream.shm:
+                import mitogen.shm
+                mitogen.shm.upgrade(self, context, stream,
+                                    lambda: callback(context=context))
+            else:
+                callback(context=context)
+
+        stream.connect_async(on_connect)
+
+    def _connect(self, context_id, klass, name=None, **kwargs):
+        pending = PendingConnect(None, name, kwargs)
+        self._connect_async(context_id, klass, name, kwargs,
+                            pending._set_result)
+        return pending.get()
+
+    def _start_connect(self, pending, callback):
+        """Begin the connection described by `pending` without blocking,
+        invoking `callback(context=None, exc=None)` on completion."""
+        kwargs = dict(pending.kwargs)
         kwargs.setdefault('debug', self.debug)
         kwargs.setdefault('profiling', self.profiling)
 
         via = kwargs.pop('via', None)
         if via is not None:
-            return self.proxy_connect(via, method_name, name=name, **kwargs)
+            return self._proxy_connect_async(via, pending.method_name,
+                                             pending.name, kwargs, callback)
+
+        klass = METHOD_NAMES[pending.method_name]()
         context_id = self.allocate_id()
-        return self._connect(context_id, klass, name=name, **kwargs)
+        self._connect_async(context_id, klass, pending.name, kwargs, callback)
+
+    def connect(self, method_name, name=None, **kwargs):
+        pending = PendingConnect(method_name, name, kwargs)
+        self._start_connect(pending, pending._set_result)
+        return pending.get()
+
+    def _get_connect_pool(self):
+        if self._connect_pool is None:
+            self._connect_pool = ConnectPool(self, self.connect_concurrency)
+        return self._connect_pool
+
+    def connect_async(self, method_name, name=None, **kwargs):
+        pending = PendingConnect(method_name, name, kwargs)
+        self._get_connect_pool().submit(pending)
+        return pending
+
+    def connect_many(self, specs, concurrency=None):
+        if concurrency is None:
+            pool = self._get_connect_pool()
+        else:
+            pool = ConnectPool(self, concurrency)
+
+        pendings = []
+        for method_name, kwargs in specs:
+            kwargs = dict(kwargs)
+            pending = PendingConnect(method_name, kwargs.pop('name', None),
+                                     kwargs)
+            pool.submit(pending)
+            pendings.append(pending)
+        if pool is not self._connect_pool:
+            pool.release_when_idle()
+        return pendings
 
     def propagate_route(self, target, via):
         self.add_route(target.context_id, via.context_id)
@@ -993,21 +1850,40 @@ class Router(mitogen.core.Router):
             child = parent
             parent = parent.via
 
-    def proxy_connect(self, via_context, method_name, name=None, **kwargs):
+    def _proxy_connect_async(self, via_context, method_name, name, kwargs,
+                             callback):
         context_id = self.allocate_id()
         # Must be added prior to _proxy_connect() to avoid a race.
         self.add_route(context_id, via_context.context_id)
-        name = via_context.call(_proxy_connect,
+        recv = via_context.call_async(_proxy_connect,
             name, context_id, method_name, kwargs
         )
-        name = '%s.%s' % (via_context.name, name)
 
-        context = Context(self, context_id, name=name)
-        context.via = via_context
-        self._context_by_id[context.context_id] = context
+        def on_reply(recv):
+            try:
+                msg, remote_name = recv.get(block=False)
+            except mitogen.core.TimeoutError:
+                return  # Result was already consumed by the other caller.
+            except Exception, e:
+                return callback(exc=e)
+
+            name = '%s.%s' % (via_context.name, remote_name)
+            context = Context(self, context_id, name=name)
+            context.via = via_context
+            self._context_by_id[context.context_id] = context
+            self.propagate_route(context, via_context)
+            callback(context=context)
+
+        recv.notify = on_reply
+        # Avoid race by polling once after installation.
+        if not recv.empty():
+            on_reply(recv)
 
-        self.propagate_route(context, via_context)
-        return context
+    def proxy_connect(self, via_context, method_name, name=None, **kwargs):
+        pending = PendingConnect(method_name, name, kwargs)
+        self._proxy_connect_async(via_context, method_name, name, kwargs,
+                                  pending._set_result)
+        return pending.get()
 
 
 class ProcessMonitor(object):
@@ -0,0 +1,365 @@
+"""
+Shared memory transport for contexts running on the same machine.
+
+Once a child has been bootstrapped over its usual pipe or TTY, the parent
+creates a file in ``/dev/shm`` holding a ring buffer for each direction, plus a
+FIFO per direction used only to wake the reader or writer. The child maps the
+file, and both sides replace the original stream in the router with a
+:py:class:`Stream` reading and writing the rings. The original stream remains
+connected, so that the death of either process is still detected.
+"""
+
+import ctypes
+import errno
+import mmap
+import os
+import platform
+import tempfile
+
+import mitogen.core
+
+from mitogen.core import LOG
+
+
+#: Values of :py:func:`platform.machine` for processors that make stores
+#: visible to other processors in the order they were made. A ring's data must
+#: be visible before the counter advancing past it, and Python offers no
+#: memory barrier to ensure that elsewhere.
+ORDERED_MACHINES = ('x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686', 'x86')
+
+
+def is_supported():
+    """Return ``True`` if rings are safe to use on this machine."""
+    return platform.machine().lower() in ORDERED_MACHINES
+
+
+def _unlink(path):
+    for name in 'ring', 'p2c', 'c2p':
+        try:
+            os.unlink(os.path.join(path, name))
+        except OSError:
+            pass
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def create(ring_size):
+    """Create a directory containing a file large enough to hold two rings of
+    `ring_size` bytes, and the FIFOs used to signal activity on them, returning
+    the path to the directory."""
+    shm_dir = None
+    if os.path.isdir('/dev/shm'):
+        shm_dir = '/dev/shm'
+    path = tempfile.mkdtemp(prefix='mitogen_shm.', dir=shm_dir)
+    try:
+        fd = os.open(os.path.join(path, 'ring'),
+                     os.O_RDWR | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            os.ftruncate(fd, 2 * (Ring.HEADER_LEN + ring_size))
+        finally:
+            os.close(fd)
+        os.mkfifo(os.path.join(path, 'p2c'), 0600)
+        os.mkfifo(os.path.join(path, 'c2p'), 0600)
+    except:
+        _unlink(path)
+        raise
+    return path
+
+
+class Ring(object):
+    """
+    Single producer, single consumer byte queue occupying `size` bytes of the
+    writable buffer `buf` after a header at `offset` holding the total bytes
+    ever written and read. Each counter is only written by one side, so no
+    lock is needed, but it must be stored in one piece: the peer may read it
+    at any moment, and :py:func:`struct.pack_into` zeroes its target before
+    packing into it.
+    """
+    HEADER_LEN = 128
+
+    def __init__(self, buf, offset, size):
+        self._view = memoryview(buf)
+        self._head = ctypes.c_uint64.from_buffer(buf, offset)
+        self._tail = ctypes.c_uint64.from_buffer(buf,
+                                                 offset + self.HEADER_LEN / 2)
+        self._data_offset = offset + self.HEADER_LEN
+        self.size = size
+
+    def available(self):
+        """Return the number of bytes waiting to be read."""
+        return self._head.value - self._tail.value
+
+    def free(self):
+        """Return the number of bytes that may be written."""
+        return self.size - self.available()
+
+    def write(self, s):
+        """Copy as much of `s` as fits into the ring, returning the number of
+        bytes written."""
+        head = self._head.value
+        n = min(len(s), self.size - (head - self._tail.value))
+        if n:
+            src = memoryview(s)
+            pos = head % self.size
+            first = min(n, self.size - pos)
+            start = self._data_offset + pos
+            self._view[start:start+first] = src[:first]
+            if first < n:
+                start = self._data_offset
+                self._view[start:start+n-first] = src[first:n]
+            self._head.value = head + n
+        return n
+
+    def readinto(self, buf):
+        """Copy as many waiting bytes as fit into the writable buffer `buf`,
+        returning the number of bytes read."""
+        tail = self._tail.value
+        n = min(len(buf), self._head.value - tail)
+        if n:
+            pos = tail % self.size
+            first = min(n, self.size - pos)
+            start = self._data_offset + pos
+            buf[:first] = self._view[start:start+first]
+            if first < n:
+                start = self._data_offset
+                buf[first:n] = self._view[start:start+n-first]
+            self._tail.value = tail + n
+        return n
+
+
+class RingSide(mitogen.core.Side):
+    """
+    :py:class:`mitogen.core.Side` transferring data through a :py:class:`Ring`
+    rather than its file descriptor, which is a FIFO used only to learn when
+    the peer has written to or read from the ring.
+    """
+    def __init__(self, stream, fd, ring):
+        super(RingSide, self).__init__(stream, fd, keep_alive=False)
+        self.ring = ring
+
+    def _drain(self):
+        """Discard wakeups, returning ``False`` if the peer closed the FIFO."""
+        while True:
+            try:
+                if not os.read(self.fd, mitogen.core.CHUNK_SIZE):
+                    return False
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return True
+                raise
+
+    def wake(self):
+        """Write a wakeup to the peer. A full FIFO already holds one, and a
+        closed FIFO means the original stream is about to disconnect."""
+        try:
+            os.write(self.fd, '\x00')
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EPIPE):
+                raise
+
+    def readinto(self, buf):
+        if self.fd is None:
+            return 0
+        if not self._drain():
+            return 0
+        n = self.ring.readinto(buf)
+        if not n:
+            return None
+        self.stream.transmit_side.wake()
+        return n
+
+    def write(self, s):
+        if self.fd is None:
+            return None
+        n = self.ring.write(s)
+        if n:
+            self.wake()
+        return n
+
+
+class Stream(mitogen.core.Stream):
+    """
+    :py:class:`mitogen.core.Stream` exchanging messages through a pair of
+    :py:class:`Ring` in the shared file at `path`. `parent` is ``True`` in the
+    context that created the file.
+    """
+    #: Bytes of buffer space in each direction.
+    ring_size = 4 * 1024 * 1024
+
+    _mmap = None
+
+    def construct(self, path, parent):
+        fd = os.open(os.path.join(path, 'ring'), os.O_RDWR)
+        try:
+            self._mmap = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+        self.path = path
+        self.name = 'shm.%s' % (os.path.basename(path),)
+        size = (len(self._mmap) / 2) - Ring.HEADER_LEN
+        array = (ctypes.c_char * len(self._mmap)).from_buffer(self._mmap)
+        p2c = Ring(array, 0, size)
+        c2p = Ring(array, Ring.HEADER_LEN + size, size)
+
+        # The reading end of each FIFO is opened first, so opening the
+        # writing end cannot fail. The parent opens its writing end for
+        # reading too, since the child has not opened its reading end yet.
+        if parent:
+            rfd = os.open(os.path.join(path, 'c2p'), os.O_RDONLY|os.O_NONBLOCK)
+            wfd = os.open(os.path.join(path, 'p2c'), os.O_RDWR|os.O_NONBLOCK)
+            self.receive_side = RingSide(self, rfd, c2p)
+            self.transmit_side = RingSide(self, wfd, p2c)
+        else:
+            rfd = os.open(os.path.join(path, 'p2c'), os.O_RDONLY|os.O_NONBLOCK)
+            wfd = os.open(os.path.join(path, 'c2p'), os.O_WRONLY|os.O_NONBLOCK)
+            self.receive_side = RingSide(self, rfd, p2c)
+            self.transmit_side = RingSide(self, wfd, c2p)
+        mitogen.core.set_cloexec(rfd)
+        mitogen.core.set_cloexec(wfd)
+
+    def on_receive(self, broker):
+        """Read messages until the ring is empty, since wakeups for data
+        exceeding the receive buffer were already discarded. Resume
+        transmitting if the peer's reads made room in the output ring."""
+        ring = self.receive_side.ring
+        super(Stream, self).on_receive(broker)
+        while self.receive_side.fd is not None and ring.available():
+            super(Stream, self).on_receive(broker)
+        if self._output_buf_len and self.transmit_side.fd is not None:
+            broker.start_transmit(self)
+
+    def on_transmit(self, broker):
+        """Pause while the output ring is full, until :py:meth:`on_receive`
+        learns the peer has read from it."""
+        if self.transmit_side.ring.free():
+            super(Stream, self).on_transmit(broker)
+        else:
+            broker.stop_transmit(self)
+
+    def on_disconnect(self, broker):
+        super(Stream, self).on_disconnect(broker)
+        _unlink(self.path)
+
+    def close(self):
+        """Release the shared files of a stream that was never started."""
+        self.receive_side.close()
+        self.transmit_side.close()
+        _unlink(self.path)
+
+
+def _replace_stream(router, old, new, broker):
+    """Route messages previously sent via `old` via `new`, and disconnect
+    `new` when `old` disconnects. Keepalives on `old` stop, since replies now
+    arrive via `new`, and death of the peer is still seen as `old` closing."""
+    old.stop_keepalive()
+    for context_id, stream in router._stream_by_id.items():
+        if stream is old:
+            router._stream_by_id[context_id] = new
+    mitogen.core.listen(old, 'disconnect', lambda: new.on_disconnect(broker))
+
+
+def _send_when_flushed(stream, msg):
+    """Write `msg` to `stream` once every message already queued on it has
+    been written, so it cannot overtake fragments of a large message. Must be
+    called on the broker thread."""
+    state = {'sent': False}
+
+    def on_flushed():
+        if not state['sent']:
+            state['sent'] = True
+            stream._send(msg)
+
+    if stream._output_buf_len:
+        mitogen.core.listen(stream, 'flushed', on_flushed)
+    else:
+        on_flushed()
+
+
+@mitogen.core.takes_econtext
+def _attach(path, handle, econtext):
+    """
+    Run in the child to open the shared file created by :py:func:`upgrade`.
+    On the broker thread, a final message is written to `handle` via the
+    original stream before messages for the parent are routed via the new
+    stream instead, so the parent knows when to start reading it. The message
+    names a handle the parent writes to via the original stream once it has
+    written everything queued there, and only then is the new stream read.
+    """
+    router = econtext.router
+    stream = Stream(router, mitogen.parent_id, path=path, parent=False)
+    # Every process that needs the files has opened them.
+    _unlink(path)
+    latch = mitogen.core.Latch()
+
+    def on_fence(msg):
+        if msg != mitogen.core._DEAD:
+            econtext.broker.start_receive(stream)
+
+    def switch():
+        old = router._stream_by_id[mitogen.parent_id]
+        fence = router.add_handler(on_fence, persist=False)
+        router._async_route(
+            mitogen.core.Message.pickled(fence, dst_id=mitogen.parent_id,
+                                         handle=handle)
+        )
+        _replace_stream(router, old, stream, econtext.broker)
+        latch.put(None)
+
+    econtext.broker.defer(switch)
+    latch.get()
+
+
+def upgrade(router, context, stream, callback):
+    """
+    Arrange for messages exchanged with the newly connected `context` to pass
+    through shared memory rather than `stream`, invoking `callback()` on the
+    broker thread once they do, or once the attempt has failed, in which case
+    `stream` continues to be used. Must be called on the broker thread.
+    """
+    if not is_supported():
+        LOG.warning('%r: shared memory is unsupported on %s, continuing '
+                    'with %r', context, platform.machine(), stream)
+        return callback()
+
+    path = create(Stream.ring_size)
+    new = Stream(router, context.context_id, path=path, parent=True)
+    state = {'switched': False}
+
+    def on_message(msg):
+        if msg == mitogen.core._DEAD:
+            new.close()
+            router.del_handler(handle)
+            return callback()
+
+        data = msg.unpickle()
+        if isinstance(data, mitogen.core.CallError):
+            LOG.warning('%r: cannot use shared memory, continuing with %r: %s',
+                        context, stream, data)
+            new.close()
+            router.del_handler(handle)
+            callback()
+        elif not state['switched']:
+            # Written by _attach() to the original stream after everything it
+            # wrote there before switching. It names the handle to write to
+            # after everything this side queued there before switching.
+            state['switched'] = True
+            _replace_stream(router, stream, new, router.broker)
+            router.broker.start_receive(new)
+            _send_when_flushed(stream, mitogen.core.Message(
+                dst_id=context.context_id,
+                handle=data,
+            ))
+        else:
+            # _attach()'s return arrives via the new stream.
+            router.del_handler(handle)
+            callback()
+
+    handle = router.add_handler(on_message, persist=True, respondent=context)
+    call = ('mitogen.shm', None, '_attach', (path, handle), {})
+    context.send(
+        mitogen.core.Message.pickled(call, handle=mitogen.core.CALL_FUNCTION,
+                                     reply_to=handle)
+    )
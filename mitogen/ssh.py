@@ -4,7 +4,6 @@ Functionality to allow establishing new slave contexts over an SSH connection.
 
 import commands
 import logging
-import time
 
 import mitogen.master
 
@@ -64,8 +63,8 @@ class Stream(mitogen.master.Stream):
         base = super(Stream, self).get_boot_command()
         return bits + [commands.mkarg(s).strip() for s in base]
 
-    def connect(self):
-        super(Stream, self).connect()
+    def _start_child(self):
+        super(Stream, self)._start_child()
         self.name = 'ssh.' + self.hostname
         if self.port:
             self.name += ':%s' % (self.port,)
@@ -74,23 +73,18 @@ class Stream(mitogen.master.Stream):
     password_incorrect_msg = 'SSH password is incorrect'
     password_required_msg = 'SSH password was requested, but none specified'
 
-    def _connect_bootstrap(self):
-        password_sent = False
-        for buf in mitogen.master.iter_read(self.receive_side.fd,
-                                             time.time() + 10.0):
-            LOG.debug('%r: received %r', self, buf)
-            if buf.endswith('EC0\n'):
-                return self._ec0_received()
-            elif PERMDENIED_PROMPT in buf.lower():
-                if self.password is not None and password_sent:
-                    raise PasswordError(self.password_incorrect_msg)
-                else:
-                    raise PasswordError(self.auth_incorrect_msg)
-            elif PASSWORD_PROMPT in buf.lower():
-                if self.password is None:
-                    raise PasswordError(self.password_required_msg)
-                LOG.debug('sending password')
-                self.transmit_side.write(self.password + '\n')
-                password_sent = True
-        else:
-            raise mitogen.core.StreamError('bootstrap failed')
+    _password_sent = False
+
+    def _on_bootstrap_output(self, buf):
+        LOG.debug('%r: received %r', self, buf)
+        if PERMDENIED_PROMPT in buf.lower():
+            if self.password is not None and self._password_sent:
+                raise PasswordError(self.password_incorrect_msg)
+            else:
+                raise PasswordError(self.auth_incorrect_msg)
+        elif PASSWORD_PROMPT in buf.lower():
+            if self.password is None:
+                raise PasswordError(self.password_required_msg)
+            LOG.debug('sending password')
+            self.transmit_side.write(self.password + '\n')
+            self._password_sent = True
@@ -1,7 +1,5 @@
 
 import logging
-import os
-import time
 
 import mitogen.core
 import mitogen.master
@@ -52,8 +50,8 @@ class Stream(mitogen.master.Stream):
         if password:
             self.password = password
 
-    def connect(self):
-        super(Stream, self).connect()
+    def _start_child(self):
+        super(Stream, self)._start_child()
         self.name = 'sudo.' + self.username
 
     def get_boot_command(self):
@@ -65,20 +63,15 @@ class Stream(mitogen.master.Stream):
     password_incorrect_msg = 'sudo password is incorrect'
     password_required_msg = 'sudo password is required'
 
-    def _connect_bootstrap(self):
-        password_sent = False
-        for buf in mitogen.master.iter_read(self.receive_side.fd,
-                                             time.time() + 10.0):
-            LOG.debug('%r: received %r', self, buf)
-            if buf.endswith('EC0\n'):
-                return self._ec0_received()
-            elif PASSWORD_PROMPT in buf.lower():
-                if self.password is None:
-                    raise PasswordError(self.password_required_msg)
-                if password_sent:
-                    raise PasswordError(self.password_incorrect_msg)
-                LOG.debug('sending password')
-                os.write(self.transmit_side.fd, self.password + '\n')
-                password_sent = True
-        else:
-            raise mitogen.core.StreamError('bootstrap failed')
+    _password_sent = False
+
+    def _on_bootstrap_output(self, buf):
+        LOG.debug('%r: received %r', self, buf)
+        if PASSWORD_PROMPT in buf.lower():
+            if self.password is None:
+                raise PasswordError(self.password_required_msg)
+            if self._password_sent:
+                raise PasswordError(self.password_incorrect_msg)
+            LOG.debug('sending password')
+            self.transmit_side.write(self.password + '\n')
+            self._password_sent = True
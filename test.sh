@@ -1,14 +1,25 @@
 #!/bin/bash
-timeout 05.0 python tests/call_function_test.py
+timeout 05.0 python tests/broker_test.py
+timeout 10.0 python tests/cache_dir_test.py
+timeout 10.0 python tests/call_function_test.py
 timeout 05.0 python tests/channel_test.py
+timeout 30.0 python tests/connect_async_test.py
 timeout 05.0 python tests/first_stage_test.py
+timeout 10.0 python tests/fork_test.py
 timeout 05.0 python tests/id_allocation_test.py
 timeout 05.0 python tests/importer_test.py
+timeout 10.0 python tests/keepalive_test.py
+timeout 05.0 python tests/latch_test.py
 timeout 05.0 python tests/local_test.py
 timeout 05.0 python tests/master_test.py
+timeout 05.0 python tests/message_test.py
 timeout 05.0 python tests/module_finder_test.py
 timeout 05.0 python tests/nested_test.py
+timeout 05.0 python tests/poller_test.py
 timeout 05.0 python tests/responder_test.py
+timeout 10.0 python tests/shm_test.py
+timeout 10.0 python tests/stats_test.py
+timeout 10.0 python tests/stream_test.py
 timeout 05.0 python tests/utils_test.py
 timeout 20.0 python tests/select_test.py
 timeout 20.0 python tests/ssh_test.py
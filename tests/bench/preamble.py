@@ -0,0 +1,43 @@
+"""
+Measure the cost of building the bootstrap preamble for many children, with
+the minimized and compressed mitogen.core body built once per process, versus
+rebuilding it for every child as was done previously.
+"""
+
+import inspect
+import time
+import zlib
+
+import mitogen.core
+import mitogen.master
+
+COUNT = 1000
+
+
+def uncached(stream):
+    source = mitogen.master.minimize_source(inspect.getsource(mitogen.core))
+    return zlib.compress(source + '\nExternalContext().main%r\n' % (
+        (stream.remote_id,),
+    ))
+
+
+def run(func, stream):
+    t0 = time.time()
+    for i in xrange(COUNT):
+        stream.remote_id = i
+        func(stream)
+    return time.time() - t0
+
+
+broker = mitogen.master.Broker()
+try:
+    router = mitogen.master.Router(broker)
+    stream = mitogen.master.Stream(router, 0)
+    before = run(uncached, stream)
+    after = run(mitogen.master.Stream.get_preamble, stream)
+finally:
+    broker.shutdown()
+
+print 'Rebuilt per child: %.2fms per child' % (before * 1000 / COUNT,)
+print 'Cached body:       %.2fms per child' % (after * 1000 / COUNT,)
+print 'Speedup:           %.1fx' % (before / after,)
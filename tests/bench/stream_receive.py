@@ -0,0 +1,59 @@
+"""
+Measure mitogen.core.Stream receive throughput as message size grows. Each
+size is fed through a socketpair by a writer thread, and parsed by calling
+Stream.on_receive() directly, so only framing cost is measured.
+"""
+
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+import mitogen.core
+
+TOTAL = 256 * 1048576
+SIZES = [1024 << (2 * i) for i in range(9)]  # 1 KiB .. 64 MiB
+
+
+class Router(object):
+    def __init__(self):
+        self.count = 0
+
+    def _async_route(self, msg, stream):
+        self.count += 1
+
+
+def write_all(sock, pkt, count):
+    for _ in xrange(count):
+        sock.sendall(pkt)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def run(size):
+    count = max(1, TOTAL // size)
+    rsock, wsock = socket.socketpair()
+    router = Router()
+    stream = mitogen.core.Stream(router, 1)
+    stream.receive_side = mitogen.core.Side(stream, rsock.fileno())
+    stream.on_disconnect = lambda broker: None
+
+    body = 'x' * size
+    pkt = struct.pack(stream.HEADER_FMT, 1, 0, 100, 0, 0, size) + body
+    thread = threading.Thread(target=write_all, args=(wsock, pkt, count))
+
+    t0 = time.time()
+    thread.start()
+    while router.count < count:
+        select.select([rsock], [], [])
+        stream.on_receive(None)
+    t1 = time.time()
+    thread.join()
+    rsock.close()
+    wsock.close()
+    return (size * count) / (t1 - t0) / 1048576.0
+
+
+for size in SIZES:
+    print '%10d bytes: %8.1f MiB/s' % (size, run(size))
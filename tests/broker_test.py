@@ -0,0 +1,66 @@
+import time
+import unittest
+
+import mitogen.core
+import mitogen.master
+
+import testlib
+
+
+class TimerTest(testlib.TestCase):
+    def setUp(self):
+        super(TimerTest, self).setUp()
+        self.broker = mitogen.master.Broker()
+
+    def tearDown(self):
+        self.broker.shutdown()
+        self.broker.join()
+        super(TimerTest, self).tearDown()
+
+    def test_fires(self):
+        latch = mitogen.core.Latch()
+        t0 = time.time()
+        self.broker.timer(0.1, lambda: latch.put(time.time()))
+        self.assertTrue(latch.get(timeout=5.0) - t0 >= 0.1)
+
+    def test_order(self):
+        latch = mitogen.core.Latch()
+        self.broker.timer(0.2, lambda: latch.put(2))
+        self.broker.timer(0.1, lambda: latch.put(1))
+        self.assertEquals(1, latch.get(timeout=5.0))
+        self.assertEquals(2, latch.get(timeout=5.0))
+
+    def test_cancel(self):
+        latch = mitogen.core.Latch()
+        timer = self.broker.timer(0.1, lambda: latch.put(1))
+        self.broker.timer(0.2, lambda: latch.put(2))
+        timer.cancel()
+        self.assertEquals(2, latch.get(timeout=5.0))
+        self.assertTrue(latch.empty())
+
+    def test_cancelled_timer_does_not_shorten_wait(self):
+        timer = mitogen.core.Timer(0, None)
+        timer.cancel()
+        self.broker._timers.append((0, 0, timer))
+        self.assertEquals(None, self.broker._get_timeout(None))
+        self.assertEquals([], self.broker._timers)
+
+    def test_crash_does_not_stop_broker(self):
+        latch = mitogen.core.Latch()
+        self.broker.timer(0, lambda: 1 / 0)
+        self.broker.timer(0.1, lambda: latch.put(1))
+        self.assertEquals(1, latch.get(timeout=5.0))
+
+
+class ConnectTimerTest(testlib.RouterMixin, testlib.TestCase):
+    def test_cancelled_on_connect(self):
+        context = self.router.local()
+        [stream] = [s for s in self.router._stream_by_id.values()
+                    if s.remote_id == context.context_id]
+        self.assertEquals(None, stream._connect_timer)
+        self.assertTrue(all(timer.cancelled
+                            for _, _, timer in self.broker._timers))
+
+
+if __name__ == '__main__':
+    unittest.main()
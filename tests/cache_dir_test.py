@@ -0,0 +1,142 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+import mock
+
+import mitogen.core
+import mitogen.master
+import testlib
+
+import simple_pkg.a
+
+
+def import_simple_pkg():
+    import mitogen
+    import simple_pkg.a
+    return (simple_pkg.a.subtract_one_add_two(2),
+            sorted(mitogen.__loader__._disk_index or ()))
+
+
+class CacheDirMixin(object):
+    def setUp(self):
+        super(CacheDirMixin, self).setUp()
+        self.cache_dir = tempfile.mkdtemp(prefix='cache_dir_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        super(CacheDirMixin, self).tearDown()
+
+
+class ImporterTest(CacheDirMixin, testlib.TestCase):
+    data = zlib.compress('data = 4\n')
+    sha = hashlib.sha1(data).hexdigest()
+    modname = 'cache_dir_test_mod'
+
+    def setUp(self):
+        super(ImporterTest, self).setUp()
+        self.router = mock.Mock()
+        self.context = mock.Mock()
+        self.importer = mitogen.core.Importer(self.router, self.context, '',
+                                              self.cache_dir)
+
+    def tearDown(self):
+        sys.modules.pop(self.modname, None)
+        super(ImporterTest, self).tearDown()
+
+    def test_source_saved(self):
+        self.context.send_await.return_value = (None, 'x.py', self.data, [])
+        self.importer.load_module(self.modname)
+        self.assertEquals(['%s.%s' % (self.modname, self.sha)],
+                          os.listdir(self.cache_dir))
+
+    def test_source_loaded_when_omitted(self):
+        self.importer._write_cached(self.modname, self.data)
+        self.importer._disk_index = None
+        self.context.send_await.return_value = (None, 'x.py', None, [])
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals(4, mod.data)
+        [call] = self.context.send_await.mock_calls
+        self.assertEquals(
+            self.importer._add_magic(self.modname + '\x01' + self.sha),
+            call[1][0].data
+        )
+
+    def test_corrupt_copy_refetched(self):
+        self.importer._write_cached(self.modname, self.data)
+        path = os.path.join(self.cache_dir, '%s.%s' % (self.modname, self.sha))
+        open(path, 'wb').write('junk')
+        self.context.send_await.side_effect = [
+            (None, 'x.py', None, []),
+            (None, 'x.py', self.data, []),
+        ]
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals(4, mod.data)
+        self.assertEquals(self.importer._add_magic(self.modname),
+                          self.context.send_await.mock_calls[1][1][0].data)
+
+
+class ResponderTest(testlib.TestCase):
+    def setUp(self):
+        super(ResponderTest, self).setUp()
+        self.router = mock.Mock()
+        self.responder = mitogen.master.ModuleResponder(self.router)
+
+    def request(self, data):
+        self.router.route.reset_mock()
+        self.responder._on_get_module(
+            mitogen.core.Message(data=data, src_id=5, reply_to=50)
+        )
+        return self.router.route.mock_calls[-1][1][0].unpickle()
+
+    def test_source_omitted_on_match(self):
+        tup = self.request('plain_old_module')
+        self.assertTrue(tup[2])
+        sha = hashlib.sha1(tup[2]).hexdigest()
+        self.assertEquals(None, self.request('plain_old_module\x01' + sha)[2])
+
+    def test_source_sent_on_mismatch(self):
+        tup = self.request('plain_old_module\x01' + ('0' * 40))
+        self.assertTrue(tup[2])
+
+    def test_batch(self):
+        sha = hashlib.sha1(self.request('simple_pkg')[2]).hexdigest()
+        tups = self.request('simple_pkg\x01%s\x00simple_pkg.b' % (sha,))
+        self.assertEquals(None, tups[0][2])
+        self.assertTrue(tups[1][2])
+
+
+class ConnectTest(CacheDirMixin, testlib.RouterMixin, testlib.TestCase):
+    def test_core_cached(self):
+        context = self.router.local(cache_dir=self.cache_dir)
+        stream = self.router._stream_by_id[context.context_id]
+        self.assertFalse(stream._core_cached)
+        core_names = [name for name in os.listdir(self.cache_dir)
+                      if name.startswith('core-')]
+        self.assertEquals(1, len(core_names))
+
+        context = self.router.local(cache_dir=self.cache_dir)
+        stream = self.router._stream_by_id[context.context_id]
+        self.assertTrue(stream._core_cached)
+        self.assertEquals(3, context.call(import_simple_pkg)[0])
+
+    def test_modules_cached(self):
+        # This module is fetched from the master to run import_simple_pkg().
+        context = self.router.local(cache_dir=self.cache_dir)
+        result, names = context.call(import_simple_pkg)
+        self.assertEquals(3, result)
+        self.assertTrue(__name__ in names)
+        self.assertTrue(any(name.startswith(__name__ + '.')
+                            for name in os.listdir(self.cache_dir)))
+
+        context = self.router.local(cache_dir=self.cache_dir)
+        result, names = context.call(import_simple_pkg)
+        self.assertEquals(3, result)
+
+
+if __name__ == '__main__':
+    unittest.main()
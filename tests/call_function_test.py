@@ -1,4 +1,5 @@
 import logging
+import os
 import time
 import unittest
 
@@ -87,5 +88,176 @@ class CallFunctionTest(testlib.RouterMixin, testlib.TestCase):
         assert context.name == self.local.name
 
 
+class CallManyTest(testlib.RouterMixin, testlib.TestCase):
+    def setUp(self):
+        super(CallManyTest, self).setUp()
+        self.local = self.router.local()
+
+    def test_results_in_order(self):
+        results = self.local.call_many([
+            (function_that_adds_numbers, (1, 2), {}),
+            (function_that_adds_numbers, (), {'x': 3, 'y': 4}),
+            (os.getpid, (), {}),
+        ])
+        self.assertEquals(3, results[0])
+        self.assertEquals(7, results[1])
+        self.assertTrue(isinstance(results[2], int))
+
+    def test_errors_isolated(self):
+        results = self.local.call_many([
+            (function_that_fails, (), {}),
+            (function_that_adds_numbers, (1, 2), {}),
+        ])
+        self.assertTrue(isinstance(results[0], mitogen.core.CallError))
+        self.assertTrue(str(results[0]).startswith('exceptions.ValueError'))
+        self.assertEquals(3, results[1])
+
+    def test_empty(self):
+        self.assertEquals([], self.local.call_many([]))
+
+
+produced = []
+closed = []
+
+
+def func_counts(n):
+    try:
+        for x in range(n):
+            produced.append(x)
+            yield x
+    finally:
+        closed.append(True)
+
+
+def func_get_progress():
+    return len(produced), bool(closed)
+
+
+def func_fails_midway():
+    yield 1
+    raise ValueError('midway')
+
+
+@mitogen.core.takes_econtext
+def func_fires_parent_disconnect(econtext):
+    econtext.broker.defer(mitogen.core.fire, econtext.parent, 'disconnect')
+
+
+class CallIterTest(testlib.RouterMixin, testlib.TestCase):
+    def setUp(self):
+        super(CallIterTest, self).setUp()
+        self.local = self.router.local(max_workers=2)
+
+    def test_items_chunked(self):
+        self.local.iter_chunk_size = 7
+        self.assertEquals(range(250), list(self.local.call_iter(func_counts,
+                                                                250)))
+
+    def test_empty(self):
+        self.assertEquals([], list(self.local.call_iter(func_counts, 0)))
+
+    def test_plain_iterable(self):
+        self.assertEquals(range(5), list(self.local.call_iter(range, 5)))
+
+    def test_error_after_items(self):
+        self.local.iter_chunk_size = 1
+        it = self.local.call_iter(func_fails_midway)
+        self.assertEquals(1, it.next())
+        exc = self.assertRaises(mitogen.core.CallError, it.next)
+        self.assertTrue(str(exc).startswith('exceptions.ValueError: midway'))
+
+    def test_invoke_error(self):
+        it = self.local.call_iter(function_that_fails)
+        self.assertRaises(mitogen.core.CallError, it.next)
+
+    def test_backpressure_and_close(self):
+        self.local.iter_window = 2
+        self.local.iter_chunk_size = 1
+        it = self.local.call_iter(func_counts, 1000)
+        self.assertEquals(0, it.next())
+        time.sleep(0.2)
+        count, is_closed = self.local.call(func_get_progress)
+        # The chunk being consumed, the window, and one awaiting a free slot.
+        self.assertTrue(count <= 4, count)
+        self.assertFalse(is_closed)
+
+        it.close()
+        self.wait_closed()
+
+    def test_paused_consumer_does_not_block_calls(self):
+        local = self.router.local()
+        it = local.call_iter(func_counts, 1000)
+        self.assertEquals(0, it.next())
+        time.sleep(0.2)
+        pid = local.call_async(os.getpid).get_data(timeout=5.0)
+        self.assertTrue(pid > 0)
+        it.close()
+
+    def wait_closed(self):
+        is_closed = False
+        deadline = time.time() + 5.0
+        while not is_closed and time.time() < deadline:
+            time.sleep(0.05)
+            count, is_closed = self.local.call(func_get_progress)
+        self.assertTrue(is_closed)
+
+    def test_released_on_caller_disconnect(self):
+        self.local.iter_window = 1
+        self.local.iter_chunk_size = 1
+        it = self.local.call_iter(func_counts, 1000)
+        self.assertEquals(0, it.next())
+        self.local.call(func_fires_parent_disconnect)
+        self.wait_closed()
+
+
+def func_sleeps_returns_thread_name(secs):
+    import threading
+    time.sleep(secs)
+    return threading.currentThread().getName()
+
+
+class ConcurrentCallTest(testlib.RouterMixin, testlib.TestCase):
+    def test_calls_overlap(self):
+        local = self.router.local(max_workers=3)
+        t0 = time.time()
+        recvs = [local.call_async(func_sleeps_returns_thread_name, 0.5)
+                 for x in range(3)]
+        names = [recv.get_data() for recv in recvs]
+        self.assertTrue(time.time() - t0 < 1.0)
+        self.assertEquals(3, len(set(names)))
+
+    def test_limit_respected(self):
+        local = self.router.local(max_workers=2)
+        t0 = time.time()
+        recvs = [local.call_async(time.sleep, 0.3) for x in range(4)]
+        for recv in recvs:
+            recv.get()
+        self.assertTrue(0.6 <= time.time() - t0 < 0.9)
+
+    def test_default_is_serial(self):
+        local = self.router.local()
+        t0 = time.time()
+        recvs = [local.call_async(time.sleep, 0.2) for x in range(2)]
+        for recv in recvs:
+            recv.get()
+        self.assertTrue(time.time() - t0 >= 0.4)
+
+    def test_workers_exit_on_shutdown(self):
+        local = self.router.local(max_workers=4)
+        pid = local.call(os.getpid)
+        self.broker.shutdown()
+        self.broker.join()
+        deadline = time.time() + 5.0
+        while time.time() < deadline:
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    break
+            except OSError:
+                break  # Already reaped.
+            time.sleep(0.05)
+        else:
+            self.fail('child did not exit')
+
+
 if __name__ == '__main__':
     unittest.main()
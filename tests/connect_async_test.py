@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+import unittest
+
+import mitogen.core
+import mitogen.master
+
+import testlib
+
+
+class ConnectAsyncTest(testlib.RouterMixin, testlib.TestCase):
+    def test_local(self):
+        pending = self.router.connect_async('local')
+        context = pending.get(timeout=10.0)
+        self.assertTrue(isinstance(context, mitogen.master.Context))
+        self.assertEquals('local.%d' % (context.call(os.getpid),),
+                          context.name)
+        # Result is retained for subsequent calls.
+        self.assertTrue(pending.get() is context)
+
+    def test_failure_reported(self):
+        pending = self.router.connect_async('local',
+                                            python_path='/nonexistent')
+        self.assertRaises(mitogen.core.StreamError,
+                          lambda: pending.get(timeout=15.0))
+
+    def test_select(self):
+        pendings = [self.router.connect_async('local') for x in range(3)]
+        select = mitogen.master.Select(pendings)
+        contexts = [context for pending, context in select]
+        self.assertEquals(3, len(set(c.context_id for c in contexts)))
+
+
+class ConnectManyTest(testlib.RouterMixin, testlib.TestCase):
+    def test_concurrent(self):
+        specs = [('local', {'remote_name': 'ctx%d' % (i,)})
+                 for i in range(4)]
+        pendings = self.router.connect_many(specs, concurrency=4)
+        contexts = [pending.get(timeout=10.0) for pending in pendings]
+        self.assertEquals(4, len(set(c.context_id for c in contexts)))
+        for context in contexts:
+            self.assertEquals(os.getpid(), context.call(os.getppid))
+
+    def test_no_threads(self):
+        before = threading.activeCount()
+        pendings = self.router.connect_many([('local', {})] * 4)
+        self.assertEquals(before, threading.activeCount())
+        for pending in pendings:
+            pending.get(timeout=10.0)
+
+    def test_queued_local(self):
+        pendings = self.router.connect_many([('local', {})] * 3,
+                                            concurrency=1)
+        contexts = [pending.get(timeout=10.0) for pending in pendings]
+        self.assertEquals(3, len(set(c.context_id for c in contexts)))
+
+    def test_queued_via(self):
+        # Attempts started as earlier ones complete must not run on the
+        # broker thread, where a call to the intermediary is impossible.
+        via = self.router.local()
+        pendings = self.router.connect_many([('local', {'via': via})] * 2,
+                                            concurrency=1)
+        for pending in pendings:
+            context = pending.get(timeout=10.0)
+            self.assertEquals(via.call(os.getpid), context.call(os.getppid))
+
+    def test_batch_pools_released(self):
+        def count_listeners():
+            return len(vars(self.broker)['_signals']['shutdown'])
+        before = count_listeners()
+        for x in range(3):
+            pendings = self.router.connect_many([('local', {})] * 2,
+                                                concurrency=1)
+            for pending in pendings:
+                pending.get(timeout=10.0)
+        # Each pool is released just after its final result is delivered.
+        deadline = time.time() + 5.0
+        while count_listeners() != before and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEquals(before, count_listeners())
+
+    def test_per_host_failure(self):
+        pendings = self.router.connect_many([
+            ('local', {}),
+            ('local', {'python_path': '/nonexistent'}),
+        ])
+        self.assertTrue(isinstance(pendings[0].get(timeout=10.0),
+                                   mitogen.master.Context))
+        self.assertRaises(mitogen.core.StreamError,
+                          lambda: pendings[1].get(timeout=15.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,30 @@ import optparse
 import os
 import shlex
 import sys
+import time
 
 parser = optparse.OptionParser()
 parser.add_option('--user', '-l', action='store')
+parser.add_option('-o', dest='options', action='append')
+parser.add_option('-p', dest='port', action='store')
+parser.add_option('-i', dest='identity_file', action='store')
 parser.disable_interspersed_args()
 
 opts, args = parser.parse_args(sys.argv[1:])
+
+if os.environ.get('FAKESSH_HANG'):
+    while True:
+        time.sleep(1)
+
+password = os.environ.get('FAKESSH_PASSWORD')
+if password:
+    sys.stdout.write('Password: ')
+    sys.stdout.flush()
+    if sys.stdin.readline().rstrip('\r\n') != password:
+        sys.stdout.write('Permission denied.\n')
+        sys.stdout.flush()
+        sys.exit(1)
+
 args.pop(0)  # hostname
 args = [''.join(shlex.split(s)) for s in args]
 print args
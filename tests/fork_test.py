@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+import mitogen.core
+import mitogen.fork
+
+import testlib
+
+
+def get_ids():
+    return mitogen.context_id, mitogen.parent_id, mitogen.is_master
+
+
+def preload(name):
+    __import__(name)
+
+
+def is_module_loaded(name):
+    return name in sys.modules
+
+
+class ForkTest(testlib.RouterMixin, testlib.TestCase):
+    def test_fork_master(self):
+        context = self.router.fork()
+        pid = context.call(os.getpid)
+        self.assertNotEqual(os.getpid(), pid)
+        self.assertEquals('fork.%d' % (pid,), context.name)
+        self.assertEquals((context.context_id, 0, False),
+                          context.call(get_ids))
+
+    def test_contexts_distinct(self):
+        c1 = self.router.fork()
+        c2 = self.router.fork()
+        self.assertNotEqual(c1.context_id, c2.context_id)
+        self.assertNotEqual(c1.call(os.getpid), c2.call(os.getpid))
+
+    def test_fork_via_zygote(self):
+        zygote = self.router.local()
+        zygote.call(preload, 'plain_old_module')
+        context = self.router.fork(via=zygote)
+        self.assertEquals((context.context_id, zygote.context_id, False),
+                          context.call(get_ids))
+        self.assertTrue(context.call(is_module_loaded, 'plain_old_module'))
+        self.assertNotEqual(zygote.call(os.getpid), context.call(os.getpid))
+
+    def test_disconnect(self):
+        context = self.router.fork()
+        latch = mitogen.core.Latch()
+        mitogen.core.listen(context, 'disconnect', lambda: latch.put(None))
+        context.call_async(os._exit, 0)
+        latch.get(timeout=5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 
 import email.utils
+import imp
+import marshal
 import sys
 import types
 import unittest
@@ -18,7 +20,7 @@ class ImporterMixin(testlib.RouterMixin):
     def setUp(self):
         super(ImporterMixin, self).setUp()
         self.context = mock.Mock()
-        self.importer = mitogen.core.Importer(self.context, '')
+        self.importer = mitogen.core.Importer(self.router, self.context, '')
 
     def tearDown(self):
         sys.modules.pop(self.modname, None)
@@ -115,6 +117,97 @@ class LoadModulePackageTest(ImporterMixin, testlib.TestCase):
         self.assertEquals(mod.func.__module__, self.modname)
 
 
+class LoadBytecodeTest(ImporterMixin, testlib.TestCase):
+    data = zlib.compress("data = 'source'\n")
+    path = 'fake_module.py'
+    modname = 'fake_module'
+
+    def response(self, magic):
+        code = compile("data = 'bytecode'\n", 'master:' + self.path, 'exec')
+        return (None, self.path, self.data, [],
+                (magic, zlib.compress(marshal.dumps(code))))
+
+    def test_magic_sent(self):
+        self.context.send_await.return_value = None
+        self.assertRaises(ImportError,
+            lambda: self.importer.load_module(self.modname))
+        [call] = self.context.send_await.mock_calls
+        self.assertEquals('fake_module\x02' + imp.get_magic().encode('hex'),
+                          call[1][0].data)
+
+    def test_bytecode_used(self):
+        self.context.send_await.return_value = self.response(imp.get_magic())
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals('bytecode', mod.data)
+
+    def test_other_magic_ignored(self):
+        self.context.send_await.return_value = self.response('nope')
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals('source', mod.data)
+
+
+class PreloadedModuleTest(ImporterMixin, testlib.TestCase):
+    data = zlib.compress("data = 2\n\n")
+    path = 'fake_module.py'
+    modname = 'fake_module'
+
+    def setUp(self):
+        super(PreloadedModuleTest, self).setUp()
+        self._old_parent_ids = mitogen.parent_ids
+        mitogen.parent_ids = [0]
+
+    def tearDown(self):
+        mitogen.parent_ids = self._old_parent_ids
+        super(PreloadedModuleTest, self).tearDown()
+
+    def push(self, src_id):
+        self.importer._on_load_module(
+            mitogen.core.Message.pickled(
+                (self.modname, None, self.path, self.data, []),
+                src_id=src_id,
+            )
+        )
+
+    def test_loaded_without_request(self):
+        self.push(src_id=mitogen.parent_ids[0])
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals(2, mod.data)
+        self.assertFalse(self.context.send_await.called)
+
+    def test_non_parent_ignored(self):
+        self.push(src_id=1234)
+        self.assertFalse(self.modname in self.importer._cache)
+
+
+class PrefetchTest(ImporterMixin, testlib.TestCase):
+    data = zlib.compress("data = 3\n\n")
+    modname = 'fake_module'
+
+    def test_one_request(self):
+        self.context.send_await.return_value = [
+            (None, 'fake_module.py', self.data),
+            None,
+        ]
+        self.importer.prefetch(['fake_module', 'fake_missing'])
+        [call] = self.context.send_await.mock_calls
+        self.assertEquals(self.importer._add_magic('fake_module\x00fake_missing'),
+                          call[1][0].data)
+
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals(3, mod.data)
+        self.assertRaises(ImportError,
+            lambda: self.importer.load_module('fake_missing'))
+        self.assertEquals(1, len(self.context.send_await.mock_calls))
+
+    def test_cached_names_skipped(self):
+        self.importer._cache['a'] = (None, 'a.py', self.data)
+        self.context.send_await.return_value = [None, None]
+        self.importer.prefetch(['a', 'b', 'c'])
+        [call] = self.context.send_await.mock_calls
+        self.assertEquals(self.importer._add_magic('b\x00c'),
+                          call[1][0].data)
+
+
 class EmailParseAddrSysTest(testlib.RouterMixin, testlib.TestCase):
     @pytest.fixture(autouse=True)
     def initdir(self, caplog):
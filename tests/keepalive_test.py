@@ -0,0 +1,58 @@
+import os
+import signal
+import time
+import unittest
+
+import mitogen.core
+import mitogen.master
+
+import testlib
+
+
+def get_stream(router, context):
+    return router._stream_by_id[context.context_id]
+
+
+class KeepaliveTest(testlib.RouterMixin, testlib.TestCase):
+    def test_idle_context_survives(self):
+        context = self.router.local(keepalive_interval=0.1)
+        pid = context.call(os.getpid)
+        time.sleep(0.6)
+        self.assertEquals(pid, context.call(os.getpid))
+        self.assertTrue(get_stream(self.router, context).last_receive >
+                        time.time() - 0.3)
+
+    def test_disabled_by_default(self):
+        context = self.router.local()
+        self.assertEquals(None, get_stream(self.router, context)._keepalive_timer)
+
+    def test_stopped_context_disconnected(self):
+        context = self.router.local(keepalive_interval=0.1, keepalive_count=2)
+        stream = get_stream(self.router, context)
+        pid = context.call(os.getpid)
+        os.kill(pid, signal.SIGSTOP)
+        try:
+            t0 = time.time()
+            self.assertRaises(mitogen.core.ChannelError,
+                              lambda: context.call(os.getpid))
+            self.assertTrue(time.time() - t0 < 2.0)
+            self.assertFalse(stream in self.router._stream_by_id.values())
+        finally:
+            os.kill(pid, signal.SIGKILL)
+
+
+class RoutePurgeTest(testlib.RouterMixin, testlib.TestCase):
+    def test_forwarded_routes_removed(self):
+        context = self.router.local()
+        stream = get_stream(self.router, context)
+        self.router.add_route(1234, context.context_id)
+        latch = mitogen.core.Latch()
+        mitogen.core.listen(context, 'disconnect', lambda: latch.put(None))
+        self.broker.defer(stream.on_disconnect, self.broker)
+        latch.get(timeout=5.0)
+        self.assertFalse(1234 in self.router._stream_by_id)
+        self.assertFalse(context.context_id in self.router._stream_by_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import threading
+import time
+import unittest
+
+import mitogen.core
+
+import testlib
+
+
+class GetTest(testlib.TestCase):
+    klass = mitogen.core.Latch
+
+    def test_empty_noblock(self):
+        latch = self.klass()
+        self.assertTrue(latch.empty())
+        self.assertRaises(mitogen.core.TimeoutError,
+                          lambda: latch.get(block=False))
+
+    def test_empty_zero_timeout(self):
+        latch = self.klass()
+        self.assertRaises(mitogen.core.TimeoutError,
+                          lambda: latch.get(timeout=0))
+
+    def test_fifo(self):
+        latch = self.klass()
+        latch.put(1)
+        latch.put(2)
+        self.assertFalse(latch.empty())
+        self.assertEquals(1, latch.get())
+        self.assertEquals(2, latch.get(block=False))
+        self.assertTrue(latch.empty())
+
+    def test_timeout_is_exact(self):
+        latch = self.klass()
+        t0 = time.time()
+        self.assertRaises(mitogen.core.TimeoutError,
+                          lambda: latch.get(timeout=0.1))
+        elapsed = time.time() - t0
+        self.assertTrue(0.1 <= elapsed < 0.3, elapsed)
+
+
+class ThreadedGetTest(testlib.TestCase):
+    klass = mitogen.core.Latch
+
+    def setUp(self):
+        super(ThreadedGetTest, self).setUp()
+        self.results = []
+        self.excs = []
+        self.threads = []
+
+    def _worker(self, func):
+        try:
+            self.results.append(func())
+        except Exception, e:
+            self.excs.append(e)
+
+    def start_one(self, func):
+        thread = threading.Thread(target=self._worker, args=(func,))
+        thread.start()
+        self.threads.append(thread)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def test_wakes_promptly(self):
+        latch = self.klass()
+        self.start_one(lambda: (latch.get(timeout=3.0), time.time()))
+        time.sleep(0.1)
+        t0 = time.time()
+        latch.put('x')
+        self.join()
+        [(obj, t1)] = self.results
+        self.assertEquals('x', obj)
+        self.assertTrue((t1 - t0) < 0.1, t1 - t0)
+
+    def test_each_sleeper_gets_one(self):
+        latch = self.klass()
+        for x in xrange(5):
+            self.start_one(lambda: latch.get(timeout=3.0))
+        time.sleep(0.1)
+        for x in xrange(5):
+            latch.put(x)
+        self.join()
+        self.assertEquals([], self.excs)
+        self.assertEquals(range(5), sorted(self.results))
+
+    def test_sleeper_times_out(self):
+        latch = self.klass()
+        self.start_one(lambda: latch.get(timeout=0.1))
+        self.join()
+        self.assertEquals(1, len(self.excs))
+        self.assertTrue(isinstance(self.excs[0], mitogen.core.TimeoutError))
+
+
+if __name__ == '__main__':
+    unittest.main()
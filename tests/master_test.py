@@ -2,6 +2,7 @@
 import subprocess
 import time
 import unittest
+import zlib
 
 import testlib
 import mitogen.master
@@ -16,11 +17,43 @@ class ScanCodeImportsTest(unittest.TestCase):
             (-1, 'subprocess', ()),
             (-1, 'time', ()),
             (-1, 'unittest', ()),
+            (-1, 'zlib', ()),
             (-1, 'testlib', ()),
             (-1, 'mitogen.master', ()),
         ])
 
 
+class GetPreambleTest(testlib.RouterMixin, unittest.TestCase):
+    def decompress(self, preamble):
+        size, _, compressed = preamble.partition('\n')
+        self.assertEquals(int(size), len(compressed))
+        return zlib.decompress(compressed)
+
+    def test_core_built_once(self):
+        mitogen.master.get_core_preamble()
+        stream = mitogen.master.Stream(self.router, 1234)
+        minimize = mitogen.master.minimize_source
+        mitogen.master.minimize_source = None
+        try:
+            first = self.decompress(stream.get_preamble())
+            stream.remote_id = 5678
+            second = self.decompress(stream.get_preamble())
+        finally:
+            mitogen.master.minimize_source = minimize
+
+        source = mitogen.master.get_core_preamble()[0]
+        self.assertTrue(first.startswith(source))
+        self.assertTrue(second.startswith(source))
+        self.assertTrue('1234' in first[len(source):])
+        self.assertTrue('5678' in second[len(source):])
+
+    def test_core_cached(self):
+        stream = mitogen.master.Stream(self.router, 1234)
+        stream._core_cached = True
+        tail = self.decompress(stream.get_preamble())
+        self.assertTrue(tail.startswith('\nExternalContext().main'))
+
+
 class IterReadTest(unittest.TestCase):
     func = staticmethod(mitogen.master.iter_read)
 
@@ -0,0 +1,50 @@
+import unittest
+
+import mitogen.core
+
+import testlib
+
+
+class PickledTest(testlib.TestCase):
+    klass = mitogen.core.Message
+
+    def test_str_is_raw(self):
+        msg = self.klass.pickled('abc')
+        self.assertEquals('abc', msg.data)
+        self.assertTrue(msg.flags & mitogen.core.FLAG_RAW)
+        self.assertEquals('abc', msg.unpickle())
+
+    def test_unicode_is_pickled(self):
+        msg = self.klass.pickled(u'abc')
+        self.assertFalse(msg.flags & mitogen.core.FLAG_RAW)
+        self.assertEquals(u'abc', msg.unpickle())
+
+    def test_object_is_pickled(self):
+        msg = self.klass.pickled(('abc', 1))
+        self.assertFalse(msg.flags & mitogen.core.FLAG_RAW)
+        self.assertEquals(('abc', 1), msg.unpickle())
+
+    def test_dead_is_pickled(self):
+        msg = self.klass.pickled(mitogen.core._DEAD)
+        self.assertFalse(msg.flags & mitogen.core.FLAG_RAW)
+        self.assertEquals(mitogen.core._DEAD, msg.unpickle())
+
+
+class RawRoundTripTest(testlib.RouterMixin, testlib.TestCase):
+    def test_sender_raw(self):
+        l1 = self.router.local()
+        recv = mitogen.core.Receiver(self.router)
+        l1.call(send_back, recv.handle, 'x' * 100000)
+        msg, data = recv.get()
+        self.assertTrue(msg.flags & mitogen.core.FLAG_RAW)
+        self.assertEquals('x' * 100000, data)
+
+
+@mitogen.core.takes_econtext
+def send_back(handle, s, econtext):
+    sender = mitogen.core.Sender(econtext.master, handle)
+    sender.put(s)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,15 @@ import unittest
 import testlib
 
 
+def prefetch_and_import():
+    import mitogen
+    names = ['simple_pkg', 'simple_pkg.a', 'simple_pkg.b']
+    mitogen.__loader__.prefetch(names)
+    cached = [name in mitogen.__loader__._cache for name in names]
+    import simple_pkg.a
+    return cached, simple_pkg.a.subtract_one_add_two(2)
+
+
 class NestedTest(testlib.RouterMixin, testlib.TestCase):
     def test_nested(self):
         context = None
@@ -14,6 +23,13 @@ class NestedTest(testlib.RouterMixin, testlib.TestCase):
         pid = context.call(os.getpid)
         self.assertTrue(isinstance(pid, int))
 
+    def test_prefetch_via_forwarder(self):
+        parent = self.router.local()
+        context = self.router.local(via=parent)
+        cached, result = context.call(prefetch_and_import)
+        self.assertEquals([True, True, True], cached)
+        self.assertEquals(3, result)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+import os
+import select
+import unittest
+
+import mitogen.core
+
+import testlib
+
+
+class PollerMixin(object):
+    klass = None
+
+    def setUp(self):
+        super(PollerMixin, self).setUp()
+        self.p = self.klass()
+        self.rfd, self.wfd = os.pipe()
+
+    def tearDown(self):
+        self.p.close()
+        os.close(self.rfd)
+        os.close(self.wfd)
+        super(PollerMixin, self).tearDown()
+
+    def test_empty_timeout(self):
+        self.assertEquals([], list(self.p.poll(0)))
+
+    def test_receive(self):
+        self.p.start_receive(self.rfd, 'r')
+        self.assertEquals([], list(self.p.poll(0)))
+        os.write(self.wfd, 'x')
+        self.assertEquals(['r'], list(self.p.poll(0)))
+
+    def test_stop_receive(self):
+        self.p.start_receive(self.rfd, 'r')
+        os.write(self.wfd, 'x')
+        self.p.stop_receive(self.rfd)
+        self.assertEquals([], list(self.p.poll(0)))
+        self.assertEquals([], self.p.readers)
+
+    def test_transmit(self):
+        self.p.start_transmit(self.wfd, 'w')
+        self.assertEquals(['w'], list(self.p.poll(0)))
+        self.p.stop_transmit(self.wfd)
+        self.assertEquals([], list(self.p.poll(0)))
+
+    def test_same_fd_both_directions(self):
+        self.p.start_receive(self.rfd, 'r')
+        self.p.start_transmit(self.rfd, 'w')
+        self.p.stop_transmit(self.rfd)
+        os.write(self.wfd, 'x')
+        self.assertEquals(['r'], list(self.p.poll(0)))
+
+    def test_stop_unregistered(self):
+        self.p.stop_receive(self.rfd)
+        self.p.stop_transmit(self.wfd)
+        self.assertEquals([], list(self.p.poll(0)))
+
+    def test_stop_during_iteration(self):
+        self.p.start_receive(self.rfd, 'r')
+        self.p.start_transmit(self.wfd, 'w')
+        os.write(self.wfd, 'x')
+        seen = []
+        for data in self.p.poll(0):
+            seen.append(data)
+            self.p.stop_receive(self.rfd)
+            self.p.stop_transmit(self.wfd)
+        self.assertEquals(1, len(seen))
+
+
+class PollerTest(PollerMixin, testlib.TestCase):
+    klass = mitogen.core.Poller
+
+
+if hasattr(select, 'poll'):
+    class PollPollerTest(PollerMixin, testlib.TestCase):
+        klass = mitogen.core.PollPoller
+
+
+if hasattr(select, 'epoll'):
+    class EpollPollerTest(PollerMixin, testlib.TestCase):
+        klass = mitogen.core.EpollPoller
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,14 @@
 
+import imp
+import marshal
 import mock
+import os
+import shutil
 import subprocess
-import unittest
 import sys
+import tempfile
+import unittest
+import zlib
 
 import mitogen.master
 import testlib
@@ -11,6 +17,25 @@ import plain_old_module
 import simple_pkg.a
 
 
+@mitogen.core.takes_econtext
+def get_forwarder_sent_ids(econtext):
+    persist, fn = econtext.router._handle_map[mitogen.core.GET_MODULE]
+    return fn.im_self._sent_modules_by_id.keys()
+
+
+@mitogen.core.takes_econtext
+def wait_for_disconnect(context_id, econtext):
+    latch = mitogen.core.Latch()
+    def check():
+        stream = econtext.router._stream_by_id.get(context_id)
+        if stream is None:
+            latch.put(None)
+        else:
+            mitogen.core.listen(stream, 'disconnect', lambda: latch.put(None))
+    econtext.broker.defer(check)
+    latch.get(timeout=5.0)
+
+
 class GoodModulesTest(testlib.RouterMixin, unittest.TestCase):
     def test_plain_old_module(self):
         # The simplest case: a top-level module with no interesting imports or
@@ -33,6 +58,166 @@ class GoodModulesTest(testlib.RouterMixin, unittest.TestCase):
         self.assertEquals(output, "['__main__', 50]\n")
 
 
+class DisconnectTest(testlib.RouterMixin, testlib.TestCase):
+    def test_responder_forgets_context(self):
+        context = self.router.local()
+        context.call(plain_old_module.pow, 2, 8)
+        sent_by_id = self.router.responder._sent_modules_by_id
+        self.assertTrue(context.context_id in sent_by_id)
+        latch = mitogen.core.Latch()
+        mitogen.core.listen(context, 'disconnect', lambda: latch.put(None))
+        context.call_async(os._exit, 0)
+        latch.get(timeout=5.0)
+        self.assertFalse(context.context_id in sent_by_id)
+
+    def test_forwarder_forgets_context(self):
+        parent = self.router.local()
+        child = self.router.local(via=parent)
+        child.call(plain_old_module.pow, 2, 8)
+        self.assertEquals([child.context_id],
+                          parent.call(get_forwarder_sent_ids))
+        child.call_async(os._exit, 0)
+        parent.call(wait_for_disconnect, child.context_id)
+        self.assertEquals([], parent.call(get_forwarder_sent_ids))
+
+
+class PreloadTest(testlib.TestCase):
+    def setUp(self):
+        super(PreloadTest, self).setUp()
+        self.router = mock.Mock()
+        self.responder = mitogen.master.ModuleResponder(self.router)
+
+    def request(self, fullname):
+        self.router.route.reset_mock()
+        self.responder._on_get_module(
+            mitogen.core.Message(data=fullname, src_id=5, reply_to=50)
+        )
+        return [call[1][0] for call in self.router.route.mock_calls]
+
+    def test_package_not_loaded_from_us(self):
+        # Child may already have simple_pkg, so nothing can be assumed.
+        msgs = self.request('simple_pkg.a')
+        self.assertEquals([50], [msg.handle for msg in msgs])
+
+    def test_submodule_deps_pushed(self):
+        self.request('simple_pkg')
+        msgs = self.request('simple_pkg.a')
+        self.assertEquals([mitogen.core.LOAD_MODULE, 50],
+                          [msg.handle for msg in msgs])
+        tup = msgs[0].unpickle()
+        self.assertEquals('simple_pkg.b', tup[0])
+        self.assertEquals(5, msgs[0].dst_id)
+
+    def test_not_pushed_twice(self):
+        self.request('simple_pkg')
+        self.request('simple_pkg.a')
+        msgs = self.request('simple_pkg.b')
+        self.assertEquals([50], [msg.handle for msg in msgs])
+
+
+class BatchTest(PreloadTest):
+    def test_one_reply(self):
+        msgs = self.request('simple_pkg\x00simple_pkg.a\x00missing_module')
+        # simple_pkg.b is a dependency of simple_pkg.a, so it is pushed first.
+        self.assertEquals([mitogen.core.LOAD_MODULE, 50],
+                          [msg.handle for msg in msgs])
+        msg = msgs[-1]
+        tups = msg.unpickle()
+        self.assertEquals(3, len(tups))
+        self.assertTrue(tups[0][1].endswith('simple_pkg/__init__.py'))
+        self.assertTrue(tups[1][1].endswith('simple_pkg/a.py'))
+        self.assertEquals(None, tups[2])
+
+    def test_related_pushed_once(self):
+        msgs = self.request('simple_pkg\x00simple_pkg.a\x00simple_pkg.b')
+        self.assertEquals([50], [msg.handle for msg in msgs])
+        msgs = self.request('simple_pkg\x00simple_pkg.a')
+        self.assertEquals([50], [msg.handle for msg in msgs])
+
+
+class BytecodeTest(testlib.TestCase):
+    def setUp(self):
+        super(BytecodeTest, self).setUp()
+        self.router = mock.Mock()
+        self.responder = mitogen.master.ModuleResponder(self.router)
+
+    def request(self, fullname, magic=None):
+        if magic is not None:
+            fullname = '%s\x02%s' % (fullname, magic.encode('hex'))
+        self.responder._on_get_module(
+            mitogen.core.Message(data=fullname, src_id=5, reply_to=50)
+        )
+        [msg] = [call[1][0] for call in self.router.route.mock_calls]
+        return msg.unpickle()
+
+    def test_same_magic(self):
+        tup = self.request('plain_old_module', imp.get_magic())
+        self.assertEquals(imp.get_magic(), tup[4][0])
+        code = marshal.loads(zlib.decompress(tup[4][1]))
+        self.assertTrue(code.co_filename.endswith('plain_old_module.py'))
+        self.assertTrue(tup[2] is not None)
+
+    def test_other_magic(self):
+        tup = self.request('plain_old_module', 'nope')
+        self.assertEquals(None, tup[4])
+        self.assertTrue(tup[2] is not None)
+
+    def test_no_magic(self):
+        tup = self.request('plain_old_module')
+        self.assertEquals(None, tup[4])
+
+    def test_disabled(self):
+        self.responder.send_bytecode = False
+        tup = self.request('plain_old_module', imp.get_magic())
+        self.assertEquals(None, tup[4])
+
+
+class CacheTest(testlib.TestCase):
+    def setUp(self):
+        super(CacheTest, self).setUp()
+        self.router = mock.Mock()
+        self.responder = mitogen.master.ModuleResponder(self.router)
+        self.tmpdir = tempfile.mkdtemp(prefix='responder_test')
+        self.path = os.path.join(self.tmpdir, 'responder_cache_mod.py')
+        self.write('x = 1\n', 1000)
+        sys.path.insert(0, self.tmpdir)
+
+    def tearDown(self):
+        sys.path.remove(self.tmpdir)
+        shutil.rmtree(self.tmpdir)
+        super(CacheTest, self).tearDown()
+
+    def write(self, source, mtime):
+        fp = open(self.path, 'w')
+        try:
+            fp.write(source)
+        finally:
+            fp.close()
+        os.utime(self.path, (mtime, mtime))
+
+    def request(self):
+        self.router.route.reset_mock()
+        self.responder._on_get_module(
+            mitogen.core.Message(data='responder_cache_mod', src_id=5,
+                                 reply_to=50)
+        )
+        [msg] = [call[1][0] for call in self.router.route.mock_calls]
+        return zlib.decompress(msg.unpickle()[2])
+
+    def test_hit(self):
+        self.assertEquals('x = 1\n', self.request())
+        self.assertEquals('x = 1\n', self.request())
+        self.assertEquals(1, self.responder.cache_misses)
+        self.assertEquals(1, self.responder.cache_hits)
+
+    def test_invalidated_by_mtime(self):
+        self.assertEquals('x = 1\n', self.request())
+        self.write('x = 2\n', 2000)
+        self.assertEquals('x = 2\n', self.request())
+        self.assertEquals(2, self.responder.cache_misses)
+        self.assertEquals(0, self.responder.cache_hits)
+
+
 class BrokenModulesTest(unittest.TestCase):
     def test_obviously_missing(self):
         # Ensure we don't crash in the case of a module legitimately being
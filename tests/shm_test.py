@@ -0,0 +1,153 @@
+import mmap
+import os
+import unittest
+
+import mitogen.core
+import mitogen.master
+import mitogen.shm
+
+import testlib
+
+
+def make_string(size):
+    return 'x' * size
+
+
+received = []
+
+
+def record(s):
+    received.append(len(s))
+
+
+def get_received():
+    return received
+
+
+@mitogen.core.takes_econtext
+def get_parent_stream_type(econtext):
+    stream = econtext.router._stream_by_id[mitogen.parent_id]
+    return type(stream).__module__
+
+
+class RingTest(testlib.TestCase):
+    def setUp(self):
+        super(RingTest, self).setUp()
+        self.mem = bytearray(mitogen.shm.Ring.HEADER_LEN + 10)
+        self.ring = mitogen.shm.Ring(self.mem, 0, 10)
+
+    def read(self, n):
+        buf = bytearray(n)
+        return str(buf[:self.ring.readinto(buf)])
+
+    def test_empty(self):
+        self.assertEquals(0, self.ring.available())
+        self.assertEquals(10, self.ring.free())
+        self.assertEquals('', self.read(5))
+
+    def test_write_limited_to_free(self):
+        self.assertEquals(6, self.ring.write('abcdef'))
+        self.assertEquals(4, self.ring.write('ghijkl'))
+        self.assertEquals(0, self.ring.write('m'))
+        self.assertEquals('abcdefghij', self.read(20))
+
+    def test_wraps(self):
+        for x in range(5):
+            self.assertEquals(7, self.ring.write(str(x) * 7))
+            self.assertEquals(str(x) * 3, self.read(3))
+            self.assertEquals(str(x) * 4, self.read(4))
+        self.assertEquals(0, self.ring.available())
+
+    def test_buffer_written(self):
+        self.ring.write(buffer('abcdef', 2, 3))
+        self.assertEquals('cde', self.read(10))
+
+
+class CreateTest(testlib.TestCase):
+    def test_files_removed_once_attached(self):
+        path = mitogen.shm.create(100)
+        try:
+            self.assertEquals(['c2p', 'p2c', 'ring'], sorted(os.listdir(path)))
+            self.assertEquals(2 * (mitogen.shm.Ring.HEADER_LEN + 100),
+                              os.path.getsize(os.path.join(path, 'ring')))
+        finally:
+            mitogen.shm._unlink(path)
+        self.assertFalse(os.path.exists(path))
+
+
+class ConnectTest(testlib.RouterMixin, testlib.TestCase):
+    def test_local(self):
+        local = self.router.local(shm=True)
+        stream = self.router._stream_by_id[local.context_id]
+        self.assertTrue(isinstance(stream, mitogen.shm.Stream))
+        self.assertEquals('mitogen.shm', local.call(get_parent_stream_type))
+        self.assertFalse(os.path.exists(stream.path))
+
+    def test_messages_larger_than_ring(self):
+        local = self.router.local(shm=True)
+        stream = self.router._stream_by_id[local.context_id]
+        size = 3 * mitogen.shm.Stream.ring_size
+        data = 'x' * size
+        self.assertEquals(size, local.call(len, data))
+        self.assertEquals(data, local.call(make_string, size))
+
+    def test_falls_back_when_attach_fails(self):
+        construct = mitogen.shm.Stream.construct
+        def construct_and_remove(stream, path, parent):
+            construct(stream, path, parent)
+            os.unlink(os.path.join(path, 'ring'))
+        mitogen.shm.Stream.construct = construct_and_remove
+        try:
+            local = self.router.local(shm=True)
+        finally:
+            mitogen.shm.Stream.construct = construct
+        stream = self.router._stream_by_id[local.context_id]
+        self.assertFalse(isinstance(stream, mitogen.shm.Stream))
+        self.assertEquals('mitogen.core', local.call(get_parent_stream_type))
+
+    def test_parent_messages_kept_in_order(self):
+        # A message larger than the pipe buffer is still queued on the original
+        # stream when the parent switches, and must not be overtaken by one
+        # sent via the new stream.
+        replace_stream = mitogen.shm._replace_stream
+        big = 'x' * (1024 * 1024)
+        def replace_and_send(router, old, new, broker):
+            context = mitogen.core.Context(router, new.remote_id)
+            recv = mitogen.core.Receiver(router)
+            for s in big, 'y':
+                call = (__name__, None, 'record', (s,), {})
+                context.send(mitogen.core.Message.pickled(call,
+                    handle=mitogen.core.CALL_FUNCTION,
+                    reply_to=recv.handle,
+                ))
+                if s is big:
+                    replace_stream(router, old, new, broker)
+        mitogen.shm._replace_stream = replace_and_send
+        try:
+            local = self.router.local(shm=True)
+        finally:
+            mitogen.shm._replace_stream = replace_stream
+        self.assertEquals([len(big), 1], local.call(get_received))
+
+    def test_unsupported_machine(self):
+        is_supported = mitogen.shm.is_supported
+        mitogen.shm.is_supported = lambda: False
+        try:
+            local = self.router.local(shm=True)
+        finally:
+            mitogen.shm.is_supported = is_supported
+        stream = self.router._stream_by_id[local.context_id]
+        self.assertFalse(isinstance(stream, mitogen.shm.Stream))
+        self.assertEquals('mitogen.core', local.call(get_parent_stream_type))
+
+    def test_disconnect(self):
+        local = self.router.local(shm=True)
+        latch = mitogen.core.Latch()
+        mitogen.core.listen(local, 'disconnect', lambda: latch.put(None))
+        local.call_async(os._exit, 0)
+        latch.get(timeout=5.0)
+        self.assertFalse(local.context_id in self.router._stream_by_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
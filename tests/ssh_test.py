@@ -1,4 +1,6 @@
 
+import os
+import time
 import unittest
 
 import mitogen
@@ -9,7 +11,7 @@ import testlib
 import plain_old_module
 
 
-class FakeSshTest(testlib.RouterMixin, unittest.TestCase):
+class FakeSshTest(testlib.RouterMixin, testlib.TestCase):
     def test_okay(self):
         context = self.router.ssh(
                 hostname='hostname',
@@ -20,6 +22,41 @@ class FakeSshTest(testlib.RouterMixin, unittest.TestCase):
         #context.call(mitogen.utils.disable_site_packages)
         self.assertEquals(3, context.call(plain_old_module.add, 1, 2))
 
+    def fake_ssh(self, env, **kwargs):
+        old = os.environ.copy()
+        os.environ.update(env)
+        try:
+            return self.router.ssh(
+                hostname='hostname',
+                ssh_path=testlib.data_path('fakessh.py'),
+                **kwargs
+            )
+        finally:
+            os.environ.clear()
+            os.environ.update(old)
+
+    def test_password_sent(self):
+        context = self.fake_ssh({'FAKESSH_PASSWORD': 'pw'}, password='pw')
+        self.assertEquals(3, context.call(plain_old_module.add, 1, 2))
+
+    def test_password_required(self):
+        e = self.assertRaises(mitogen.ssh.PasswordError,
+            lambda: self.fake_ssh({'FAKESSH_PASSWORD': 'pw'}))
+        self.assertEquals(mitogen.ssh.Stream.password_required_msg, str(e))
+
+    def test_password_incorrect(self):
+        e = self.assertRaises(mitogen.ssh.PasswordError,
+            lambda: self.fake_ssh({'FAKESSH_PASSWORD': 'pw'},
+                                  password='wrong'))
+        self.assertEquals(mitogen.ssh.Stream.password_incorrect_msg, str(e))
+
+    def test_connect_timeout(self):
+        t0 = time.time()
+        self.assertRaises(mitogen.core.TimeoutError,
+            lambda: self.fake_ssh({'FAKESSH_HANG': '1'},
+                                  connect_timeout=0.5))
+        self.assertTrue((time.time() - t0) < 5.0)
+
 
 class SshTest(testlib.DockerMixin, unittest.TestCase):
     stream_class = mitogen.ssh.Stream
@@ -0,0 +1,102 @@
+import os
+import unittest
+
+import mitogen.core
+import mitogen.master
+
+import testlib
+
+
+def make_string(size):
+    return 'x' * size
+
+
+def get_stream_stats(stats, remote_id):
+    [stream_stats] = [s for s in stats['streams']
+                      if s['remote_id'] == remote_id]
+    return stream_stats
+
+
+class RouterStatsTest(testlib.RouterMixin, testlib.TestCase):
+    def test_stream_counters(self):
+        context = self.router.local()
+        before = get_stream_stats(self.router.get_stats(), context.context_id)
+        context.call(os.getpid)
+        after = get_stream_stats(self.router.get_stats(), context.context_id)
+        self.assertTrue(after['messages_out'] > before['messages_out'])
+        self.assertTrue(after['messages_in'] > before['messages_in'])
+        self.assertTrue(after['bytes_out'] > before['bytes_out'])
+        self.assertTrue(after['bytes_in'] > before['bytes_in'])
+        self.assertTrue(after['output_peak'] > 0)
+        self.assertEquals(0, after['output_queued'])
+
+    def test_handle_counts(self):
+        context = self.router.local()
+        recv = mitogen.core.Receiver(self.router)
+        context.call(os.getpid)
+        before = self.router.get_stats()['handles']['dynamic']
+        for x in range(3):
+            self.router.route(
+                mitogen.core.Message.pickled(x, dst_id=mitogen.context_id,
+                                             handle=recv.handle)
+            )
+            recv.get()
+        handles = self.router.get_stats()['handles']
+        self.assertEquals(before + 3, handles['dynamic'])
+        self.assertFalse(recv.handle in handles)
+
+    def test_reply_handles_not_kept(self):
+        context = self.router.local()
+        context.call(os.getpid)
+        count = len(self.router.get_stats()['handles'])
+        for x in range(20):
+            context.call(os.getpid)
+        self.assertEquals(count, len(self.router.get_stats()['handles']))
+
+    def test_fragmented_message_counted_once(self):
+        context = self.router.local()
+        context.call(make_string, 1)
+        stream = self.router._stream_by_id[context.context_id]
+        before = get_stream_stats(self.router.get_stats(), context.context_id)
+        size = 4 * stream.frame_size
+        self.assertEquals(size, len(context.call(make_string, size)))
+        after = get_stream_stats(self.router.get_stats(), context.context_id)
+        self.assertEquals(1, after['messages_in'] - before['messages_in'])
+        self.assertEquals(1, after['messages_out'] - before['messages_out'])
+
+    def test_write_blocked(self):
+        context = self.router.local()
+        stream = self.router._stream_by_id[context.context_id]
+        latch = mitogen.core.Latch()
+
+        def transmit():
+            stream._write_blocked_since = 0
+            stream.on_transmit(self.broker)
+            latch.put(None)
+
+        self.broker.defer(transmit)
+        latch.get(timeout=5.0)
+        self.assertTrue(stream.write_blocked_secs > 0)
+        self.assertEquals(None, stream._write_blocked_since)
+
+
+class ContextStatsTest(testlib.RouterMixin, testlib.TestCase):
+    def test_remote_stats(self):
+        context = self.router.local()
+        context.call(os.getpid)
+        stats = context.get_stats()
+        self.assertEquals(context.context_id, stats['context_id'])
+        parent = get_stream_stats(stats, mitogen.context_id)
+        self.assertTrue(parent['messages_in'] > 0)
+        self.assertTrue(parent['messages_out'] > 0)
+        self.assertTrue(stats['handles'][mitogen.core.CALL_FUNCTION] >= 1)
+
+    def test_via_intermediary(self):
+        child = self.router.local()
+        grandchild = self.router.local(via=child)
+        stats = grandchild.get_stats()
+        self.assertEquals(grandchild.context_id, stats['context_id'])
+
+
+if __name__ == '__main__':
+    unittest.main()
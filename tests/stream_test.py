@@ -0,0 +1,455 @@
+
+import os
+import select
+import signal
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import mitogen.core
+
+import testlib
+
+
+def make_string(size):
+    return 'x' * size
+
+
+class FakeRouter(object):
+    def __init__(self):
+        self.msgs = []
+
+    def _async_route(self, msg, stream):
+        self.msgs.append(msg)
+
+
+class ReceiveTest(testlib.TestCase):
+    def setUp(self):
+        super(ReceiveTest, self).setUp()
+        self.rsock, self.wsock = socket.socketpair()
+        self.router = FakeRouter()
+        self.stream = mitogen.core.Stream(self.router, 1)
+        self.stream.receive_side = mitogen.core.Side(self.stream,
+                                                     self.rsock.fileno())
+
+    def tearDown(self):
+        self.rsock.close()
+        self.wsock.close()
+        super(ReceiveTest, self).tearDown()
+
+    def pack(self, data, handle=100, flags=0):
+        return struct.pack(self.stream.HEADER_FMT, 1, 0, handle, 0, flags,
+                           len(data)) + data
+
+    def feed(self, s):
+        self.wsock.sendall(s)
+        while select.select([self.rsock], [], [], 0)[0]:
+            self.stream.on_receive(None)
+
+    def test_split_header(self):
+        pkt = self.pack('hello')
+        self.feed(pkt[:3])
+        self.assertEquals(self.router.msgs, [])
+        self.feed(pkt[3:])
+        self.assertEquals(['hello'], [m.data for m in self.router.msgs])
+
+    def test_many_per_read(self):
+        self.feed(''.join(self.pack(str(i), handle=i) for i in range(10)))
+        self.assertEquals(map(str, range(10)),
+                          [m.data for m in self.router.msgs])
+        self.assertEquals(range(10), [m.handle for m in self.router.msgs])
+
+    def test_data_is_str(self):
+        self.feed(self.pack('abc'))
+        self.assertTrue(type(self.router.msgs[0].data) is str)
+
+    def test_flags(self):
+        self.feed(self.pack('abc', flags=mitogen.core.FLAG_RAW))
+        msg, = self.router.msgs
+        self.assertEquals(mitogen.core.FLAG_RAW, msg.flags)
+        self.assertEquals('abc', msg.unpickle())
+
+    def test_large_message_grows_then_shrinks(self):
+        data = 'x' * (self.stream.input_buf_max * 2)
+        pkt = self.pack(data) + self.pack('small')
+        for i in xrange(0, len(pkt), 65536):
+            self.feed(pkt[i:i+65536])
+        self.assertEquals(2, len(self.router.msgs))
+        self.assertTrue(self.router.msgs[0].data == data)
+        self.assertEquals('small', self.router.msgs[1].data)
+        self.feed(self.pack('after'))
+        self.assertEquals(self.stream.input_buf_size,
+                          len(self.stream._input_buf))
+
+    def test_disconnect(self):
+        disconnected = []
+        self.stream.on_disconnect = disconnected.append
+        self.wsock.sendall(self.pack('last'))
+        self.wsock.shutdown(socket.SHUT_WR)
+        self.stream.on_receive('broker')
+        self.stream.on_receive('broker')
+        self.assertEquals(['last'], [m.data for m in self.router.msgs])
+        self.assertEquals(['broker'], disconnected)
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.transmitting = set()
+
+    def start_transmit(self, stream):
+        self.transmitting.add(stream)
+
+    def stop_transmit(self, stream):
+        self.transmitting.discard(stream)
+
+
+class FakeSide(object):
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.writes = []
+
+    def write(self, s):
+        s = str(s)[:self.limit]
+        self.writes.append(s)
+        return len(s)
+
+
+class TransmitTest(testlib.TestCase):
+    def setUp(self):
+        super(TransmitTest, self).setUp()
+        self.router = FakeRouter()
+        self.router.broker = FakeBroker()
+        self.stream = mitogen.core.Stream(self.router, 1)
+
+    def send(self, data, handle=100):
+        self.stream._send(mitogen.core.Message(dst_id=1, src_id=0,
+                                               handle=handle, data=data))
+
+    def expected(self, *datas):
+        return ''.join(
+            struct.pack(self.stream.HEADER_FMT, 1, 0, 100, 0, 0, len(d)) + d
+            for d in datas
+        )
+
+    def test_small_messages_coalesced(self):
+        side = self.stream.transmit_side = FakeSide()
+        for i in range(100):
+            self.send(str(i))
+        self.stream.on_transmit(self.router.broker)
+        self.assertEquals(1, len(side.writes))
+        self.assertEquals(self.expected(*map(str, range(100))), side.writes[0])
+        self.assertEquals(0, self.stream._output_buf_len)
+        self.assertFalse(self.router.broker.transmitting)
+
+    def test_partial_writes(self):
+        side = self.stream.transmit_side = FakeSide(limit=7)
+        self.send('a' * 10)
+        self.send('b' * 30)
+        while self.router.broker.transmitting:
+            self.stream.on_transmit(self.router.broker)
+        self.assertEquals(self.expected('a' * 10, 'b' * 30),
+                          ''.join(side.writes))
+        self.assertTrue(all(len(s) <= 7 for s in side.writes))
+
+    def test_large_body_not_copied(self):
+        side = self.stream.transmit_side = FakeSide()
+        data = 'x' * (self.stream.gather_size * 2)
+        self.stream.frame_size = len(data)
+        self.send(data)
+        self.stream.on_transmit(self.router.broker)
+        self.stream.on_transmit(self.router.broker)
+        self.assertEquals(self.expected(data), ''.join(side.writes))
+        self.assertEquals(self.stream.gather_size, len(side.writes[0]))
+
+
+class PriorityTest(testlib.TestCase):
+    def setUp(self):
+        super(PriorityTest, self).setUp()
+        self.router = FakeRouter()
+        self.router.broker = FakeBroker()
+        self.stream = mitogen.core.Stream(self.router, 1)
+
+    send = TransmitTest.__dict__['send']
+
+    def handles_written(self, side):
+        data = ''.join(side.writes)
+        handles = []
+        while data:
+            (_, _, handle, _, _, size) = struct.unpack_from(
+                self.stream.HEADER_FMT, data)
+            handles.append(handle)
+            data = data[self.stream.HEADER_LEN + size:]
+        return handles
+
+    def test_priority_overtakes_bulk(self):
+        side = self.stream.transmit_side = FakeSide()
+        big = 'x' * self.stream.gather_size
+        for x in range(3):
+            self.send(big, handle=200 + x)
+        self.stream.on_transmit(self.router.broker)
+        self.send('', handle=mitogen.core.SHUTDOWN)
+        self.send('', handle=mitogen.core.ADD_ROUTE)
+        while self.router.broker.transmitting:
+            self.stream.on_transmit(self.router.broker)
+        self.assertEquals([200, mitogen.core.SHUTDOWN, mitogen.core.ADD_ROUTE,
+                           201, 202], self.handles_written(side))
+
+    def test_order_kept_within_class(self):
+        side = self.stream.transmit_side = FakeSide()
+        for handle in 200, mitogen.core.FORWARD_LOG, 201, 202:
+            self.send('x', handle=handle)
+            self.send('y', handle=mitogen.core.FORWARD_LOG)
+        while self.router.broker.transmitting:
+            self.stream.on_transmit(self.router.broker)
+        self.assertEquals([mitogen.core.FORWARD_LOG] * 5 + [200, 201, 202],
+                          self.handles_written(side))
+
+
+class FragmentTest(testlib.TestCase):
+    def setUp(self):
+        super(FragmentTest, self).setUp()
+        self.router = FakeRouter()
+        self.router.broker = FakeBroker()
+        self.stream = mitogen.core.Stream(self.router, 1)
+        self.stream.frame_size = 100
+        self.side = self.stream.transmit_side = FakeSide()
+
+    send = TransmitTest.__dict__['send']
+
+    def frames_written(self):
+        while self.router.broker.transmitting:
+            self.stream.on_transmit(self.router.broker)
+        data = ''.join(self.side.writes)
+        frames = []
+        while data:
+            (_, _, handle, _, flags, size) = struct.unpack_from(
+                self.stream.HEADER_FMT, data)
+            start = self.stream.HEADER_LEN
+            frames.append((handle, flags, data[start:start + size]))
+            data = data[start + size:]
+        return frames
+
+    def test_large_message_fragmented(self):
+        data = ''.join(chr(i % 256) for i in range(350))
+        self.send(data)
+        frames = self.frames_written()
+        self.assertEquals([100, 100, 100, 50],
+                          [len(d) for _, _, d in frames])
+        self.assertEquals([mitogen.core.FLAG_MORE] * 3 + [0],
+                          [flags for _, flags, _ in frames])
+        self.assertEquals(data, ''.join(d for _, _, d in frames))
+        self.assertEquals(0, self.stream._output_buf_len)
+
+    def test_small_message_not_fragmented(self):
+        self.send('x' * 100)
+        self.assertEquals([(100, 0, 'x' * 100)], self.frames_written())
+
+    def test_handles_interleaved(self):
+        self.send('a' * 250, handle=200)
+        self.send('b' * 250, handle=201)
+        self.send('c', handle=202)
+        self.assertEquals([200, 200, 201, 200, 202, 201, 201],
+                          [handle for handle, _, _ in self.frames_written()])
+
+    def test_small_messages_kept_in_order(self):
+        # e.g. LOAD_MODULE pushes must arrive before the GET_MODULE reply
+        # that follows them.
+        for i in range(4):
+            self.send('push%d' % (i,), handle=mitogen.core.LOAD_MODULE)
+        self.send('reply', handle=1000)
+        self.send('exit', handle=1001)
+        self.assertEquals(['push0', 'push1', 'push2', 'push3', 'reply', 'exit'],
+                          [d for _, _, d in self.frames_written()])
+
+    def test_small_message_overtakes_large(self):
+        self.send('a' * 250, handle=200)
+        self.send('b', handle=201)
+        self.send('c', handle=202)
+        self.assertEquals([(200, 'a'), (200, 'a'), (201, 'b'), (200, 'a'),
+                           (202, 'c')],
+                          [(h, d[:1]) for h, _, d in self.frames_written()])
+
+    def test_same_handle_kept_in_order(self):
+        self.send('a' * 150, handle=200)
+        self.send('b' * 150, handle=200)
+        self.assertEquals('a' * 150 + 'b' * 150,
+                          ''.join(d for _, _, d in self.frames_written()))
+
+
+class FragmentRouteTest(testlib.RouterMixin, testlib.TestCase):
+    def test_large_call_reassembled(self):
+        local = self.router.local()
+        size = 5 * mitogen.core.Stream.frame_size + 3
+        data = 'x' * size
+        self.assertEquals(size, local.call(len, data))
+        self.assertEquals(data, local.call(make_string, size))
+        self.assertEquals({}, self.router._fragments)
+
+
+class CompressTest(testlib.TestCase):
+    def setUp(self):
+        super(CompressTest, self).setUp()
+        self.router = FakeRouter()
+        self.router.broker = FakeBroker()
+        self.stream = mitogen.core.Stream(self.router, 1)
+        self.stream.compress = True
+        self.side = self.stream.transmit_side = FakeSide()
+        self.rsock, self.wsock = socket.socketpair()
+        self.peer = mitogen.core.Stream(self.router, 0)
+        self.peer.receive_side = mitogen.core.Side(self.peer,
+                                                   self.rsock.fileno())
+
+    def tearDown(self):
+        self.rsock.close()
+        self.wsock.close()
+        super(CompressTest, self).tearDown()
+
+    send = TransmitTest.__dict__['send']
+    frames_written = FragmentTest.__dict__['frames_written']
+
+    def deliver(self):
+        self.wsock.sendall(''.join(self.side.writes))
+        while select.select([self.rsock], [], [], 0)[0]:
+            self.peer.on_receive(None)
+        return [msg.data for msg in self.router.msgs]
+
+    def test_small_message_not_compressed(self):
+        self.send('x' * (self.stream.compress_threshold - 1))
+        [(_, flags, _)] = self.frames_written()
+        self.assertEquals(0, flags)
+        self.assertEquals(0, self.stream.compress_bytes_in)
+
+    def test_round_trip(self):
+        datas = ['abc' * 1000, 'x', 'abc' * 1000]
+        for data in datas:
+            self.send(data)
+        frames = self.frames_written()
+        self.assertEquals([mitogen.core.FLAG_COMPRESSED, 0,
+                           mitogen.core.FLAG_COMPRESSED],
+                          [flags for _, flags, _ in frames])
+        # The second copy is compressed against the first.
+        self.assertTrue(len(frames[2][2]) < len(frames[0][2]))
+        self.assertEquals(datas, self.deliver())
+        self.assertEquals([0, 0, 0], [m.flags for m in self.router.msgs])
+        self.assertEquals(6000, self.stream.compress_bytes_in)
+        self.assertEquals(self.stream.compress_bytes_out,
+                          self.peer.decompress_bytes_in)
+        self.assertEquals(6000, self.peer.decompress_bytes_out)
+
+    def test_fragments_compressed_in_write_order(self):
+        self.stream.frame_size = 1000
+        self.send('a' * 2500, handle=200)
+        self.send('b' * 2500, handle=201)
+        self.frames_written()
+        self.assertEquals(['a' * 1000, 'a' * 1000, 'b' * 1000, 'a' * 500,
+                           'b' * 1000, 'b' * 500], self.deliver())
+
+
+class CompressRouteTest(testlib.RouterMixin, testlib.TestCase):
+    def test_large_call_compressed(self):
+        local = self.router.local(compress=True)
+        stream = self.router._stream_by_id[local.context_id]
+        data = 'x' * 100000
+        self.assertEquals(len(data), local.call(len, data))
+        self.assertEquals(data, local.call(make_string, len(data)))
+        self.assertTrue(stream.compress_bytes_in >= len(data))
+        self.assertTrue(stream.compress_bytes_out <
+                        stream.compress_bytes_in / 2)
+        self.assertTrue(stream.decompress_bytes_out >= len(data))
+
+
+class FlowControlTest(testlib.TestCase):
+    def setUp(self):
+        super(FlowControlTest, self).setUp()
+        self.router = FakeRouter()
+        self.router.broker = FakeBroker()
+        self.stream = mitogen.core.Stream(self.router, 1)
+        self.stream.output_high_water = 100
+        self.stream.output_low_water = 50
+        self.side = self.stream.transmit_side = FakeSide(limit=30)
+
+    send = TransmitTest.__dict__['send']
+
+    def test_pending_bytes(self):
+        self.send('x' * 10)
+        self.assertEquals(self.stream.HEADER_LEN + 10,
+                          self.stream.pending_bytes)
+
+    def test_not_throttled_below_high_water(self):
+        self.send('x' * 50)
+        self.assertFalse(self.stream._throttled)
+        self.stream.wait_drained(timeout=0)
+
+    def test_throttled_until_low_water(self):
+        drained = []
+        mitogen.core.listen(self.stream, 'drain', lambda: drained.append(1))
+        self.send('x' * 150)
+        self.assertTrue(self.stream._throttled)
+        self.assertRaises(mitogen.core.TimeoutError,
+                          lambda: self.stream.wait_drained(timeout=0.05))
+
+        self.stream.on_transmit(self.router.broker)
+        self.stream.on_transmit(self.router.broker)
+        self.stream.on_transmit(self.router.broker)
+        self.assertTrue(self.stream.pending_bytes > 50)
+        self.assertEquals([], drained)
+        self.stream.on_transmit(self.router.broker)
+        self.assertTrue(self.stream.pending_bytes <= 50)
+        self.assertEquals([1], drained)
+        self.stream.wait_drained(timeout=0)
+
+    def test_blocked_thread_woken(self):
+        self.send('x' * 150)
+        woken = []
+        thread = threading.Thread(
+            target=lambda: woken.append(self.stream.wait_drained(timeout=5.0))
+        )
+        thread.start()
+        time.sleep(0.05)
+        self.assertEquals([], woken)
+        while self.router.broker.transmitting:
+            self.stream.on_transmit(self.router.broker)
+        thread.join()
+        self.assertEquals([None], woken)
+
+    def test_disabled(self):
+        self.stream.output_high_water = None
+        self.send('x' * 150)
+        self.assertFalse(self.stream._throttled)
+
+
+class RouteFlowControlTest(testlib.RouterMixin, testlib.TestCase):
+    def test_sender_blocks_while_child_stopped(self):
+        local = self.router.local()
+        stream = self.router._stream_by_id[local.context_id]
+        stream.output_high_water = 16 * mitogen.core.CHUNK_SIZE
+        stream.output_low_water = 4 * mitogen.core.CHUNK_SIZE
+        pid = local.call(os.getpid)
+        data = 'x' * (4 * mitogen.core.CHUNK_SIZE)
+
+        recvs = []
+        def sender():
+            for x in xrange(64):
+                recvs.append(local.call_async(len, data))
+
+        os.kill(pid, signal.SIGSTOP)
+        try:
+            thread = threading.Thread(target=sender)
+            thread.start()
+            time.sleep(0.5)
+            self.assertTrue(thread.isAlive())
+            self.assertTrue(len(recvs) < 64)
+            self.assertTrue(stream.pending_bytes <=
+                            stream.output_high_water + len(data) + 100)
+        finally:
+            os.kill(pid, signal.SIGCONT)
+
+        thread.join()
+        self.assertEquals([len(data)] * 64,
+                          [recv.get_data() for recv in recvs])
+
+
+if __name__ == '__main__':
+    unittest.main()